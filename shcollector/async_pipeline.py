@@ -0,0 +1,189 @@
+from __future__ import annotations
+from datetime import datetime
+from functools import partial
+from typing import Any, Callable, Dict, List, Tuple
+import asyncio
+import logging
+from manager import Manager
+from sdr import MessageParser, SignalReader
+from sources import Source
+from utils.cron import Job, timezone
+
+logger = logging.getLogger('async')
+
+RESTART_DELAY = 10
+# Longest rtl_433 line, asyncio's default of 64 KiB would stop the reader on a longer one
+LINE_LIMIT = 1024 * 1024
+
+
+# Single threaded alternative to SignalReader + CronScheduler: rtl_433 is read,
+# dispatched and scheduled from one asyncio event loop.
+class AsyncPipeline():
+
+    def __init__(self: AsyncPipeline, manager: Manager, sections: List[str],
+                 create_parser: Callable[[str], MessageParser], supervise: bool,
+                 queue_size: int = 0):
+        self.manager: Manager = manager
+        self.parsers: Dict[str, MessageParser] = {section: create_parser(section)
+                                                  for section in sections}
+        self.supervise: bool = supervise
+        # Readers wait for room in a full queue, pushing back on rtl_433's pipe
+        self.queue_size: int = queue_size
+        self.processes: Dict[str, asyncio.subprocess.Process] = {}
+        self.sources: Dict[str, Source] = {}
+        self.jobs: List[Tuple[Job, bool]] = []
+
+    def schedule(self: AsyncPipeline, job: Job, blocking: bool) -> None:
+        # Blocking jobs (database I/O) run in the loop executor not to stall the reader
+        self.jobs.append((job, blocking))
+
+    async def read(self: AsyncPipeline, section: str,
+                   message_queue: asyncio.Queue[Dict[str, Any]]) -> None:
+        parser = self.parsers[section]
+        command_line = SignalReader.get_command_line(section)
+        logger.info(f"[{section}] Starting sub process " + ' '.join(command_line))
+        process = await asyncio.create_subprocess_exec(*command_line,
+                                                       stdout=asyncio.subprocess.PIPE,
+                                                       stderr=asyncio.subprocess.STDOUT,
+                                                       limit=LINE_LIMIT)
+        self.processes[section] = process
+        assert process.stdout is not None
+
+        recorder = SignalReader.create_recorder(section)
+        overrun = False
+        try:
+            while True:
+                try:
+                    line = await process.stdout.readline()
+                except ValueError:
+                    if not overrun:
+                        logger.warning(f"[{section}] Dropped a line longer than {LINE_LIMIT} "
+                                       f"bytes")
+                    overrun = True
+                    continue
+                if not line:
+                    break
+                if overrun:
+                    overrun = False
+                    if not line.startswith(b"{"):
+                        # End of the dropped line
+                        continue
+                try:
+                    if recorder is not None:
+                        recorder.write(line)
+                    message = parser.parse(line)
+                except Exception:
+                    logger.exception(f"[{section}] Unable to handle line {line!r}")
+                    continue
+                if message is not None:
+                    await message_queue.put(message)
+        finally:
+            if recorder is not None:
+                recorder.close()
+
+        return_code = await process.wait()
+        logger.error(f'[{section}] Return code from RTL_433 [{process.pid}]: {return_code}')
+
+    async def replay(self: AsyncPipeline, section: str,
+                     message_queue: asyncio.Queue[Dict[str, Any]]) -> None:
+        # Recordings are read and paced by a blocking source in the loop executor
+        loop = asyncio.get_running_loop()
+        parser = self.parsers[section]
+        source = SignalReader.create_source(section)
+        self.sources[section] = source
+
+        def pump() -> None:
+            for line in source.lines():
+                try:
+                    message = parser.parse(line)
+                except Exception:
+                    logger.exception(f"[{section}] Unable to handle line {line!r}")
+                    continue
+                if message is not None:
+                    asyncio.run_coroutine_threadsafe(message_queue.put(message), loop).result()
+
+        await loop.run_in_executor(None, pump)
+
+    async def receive(self: AsyncPipeline, section: str,
+                      message_queue: asyncio.Queue[Dict[str, Any]]) -> None:
+        if len(SignalReader.option(section, 'replay')) > 0:
+            await self.replay(section, message_queue)
+            # Let the dispatcher catch up before the pipeline stops
+            await message_queue.join()
+            return
+        while True:
+            try:
+                await self.read(section, message_queue)
+            except Exception:
+                logger.exception(f"[{section}] Reader failed")
+                await self.kill(section)
+            if not self.supervise:
+                break
+            logger.warning(f"[{section}] Restarting reader in {RESTART_DELAY}s")
+            await asyncio.sleep(RESTART_DELAY)
+
+    async def kill(self: AsyncPipeline, section: str) -> None:
+        # rtl_433 is left running by a failed reader
+        process = self.processes.get(section)
+        if process is not None and process.returncode is None:
+            process.kill()
+            await process.wait()
+
+    async def dispatch(self: AsyncPipeline,
+                       message_queue: asyncio.Queue[Dict[str, Any]]) -> None:
+        while True:
+            message = await message_queue.get()
+            try:
+                self.manager.dispatch_message(message)
+            except Exception:
+                logger.exception(f"Unable to dispatch message {message}")
+            finally:
+                message_queue.task_done()
+
+    async def run_job(self: AsyncPipeline, job: Job, blocking: bool) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            now = timezone.localize(datetime.now())
+            run_date = job.next_run(now)
+            logger.debug(f"Scheduling {job.name} run at {str(run_date)}")
+            await asyncio.sleep((run_date - now).total_seconds())
+
+            kwargs = job.args.copy()
+            if job.inject_run_date:
+                kwargs['run_date'] = run_date
+            try:
+                if blocking:
+                    await loop.run_in_executor(None, partial(job.execute, **kwargs))
+                else:
+                    job.execute(**kwargs)
+            except Exception:
+                logger.exception(f"Job {job.name} failed")
+
+    async def main(self: AsyncPipeline) -> None:
+        message_queue: asyncio.Queue[Dict[str, Any]] = asyncio.Queue(self.queue_size)
+        tasks = [asyncio.create_task(self.dispatch(message_queue))]
+        tasks.extend(asyncio.create_task(self.run_job(job, blocking))
+                     for job, blocking in self.jobs)
+
+        # The pipeline lives as long as its readers
+        await asyncio.gather(*(self.receive(section, message_queue) for section in self.parsers))
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def run(self: AsyncPipeline) -> None:
+        asyncio.run(self.main())
+
+    def log_stats(self: AsyncPipeline) -> None:
+        for section, parser in self.parsers.items():
+            logger.debug(f"[{section}] {parser.stats()}")
+
+    def close(self: AsyncPipeline) -> None:
+        # Terminate subprocesses
+        self.supervise = False
+        for source in self.sources.values():
+            source.close()
+        for process in self.processes.values():
+            if process.returncode is None:
+                process.terminate()
@@ -6,20 +6,31 @@ import logging
 import sys
 import argparse
 import signal
+import threading
+from datetime import datetime
+from functools import partial
 from queue import Queue
-from typing import Any, Dict, NoReturn, List, Callable, Optional
+from typing import Any, Dict, NoReturn, List, Callable, Optional, Set
 
 from reporters.database import Database
+from reporters.rollup import Rollups
 from sensors.measure import Measure
 from manager import Manager
+from async_pipeline import AsyncPipeline
+from streaming import StreamingPipeline
+from multiprocess import MultiprocessPipeline
 from utils.cron import CronScheduler, Job
-from sdr import SignalReader
+from utils.dedup import DuplicateFilter
+from utils.instrumentation import MetricsServer, registry
+from utils.profiling import MemoryTracer, SamplingProfiler
+from utils.queues import BoundedQueue, create_queue
+from sdr import MessageParser, SignalReader
 import cfg
 
 
 logger = logging.getLogger('main')
 kill_callback: List[Callable[[], None]] = []
-close_callback: List[Callable[[], None]] = []
+close_callback: List[Callable[[], object]] = []
 
 
 def close_all() -> NoReturn:
@@ -33,13 +44,22 @@ def close_all() -> NoReturn:
     sys.exit(0)
 
 
+def ignore_stop_signals() -> None:
+    # A second signal (Ctrl-C and timeout signal the whole process group) would interrupt
+    # the callbacks half-way, possibly within a join which then never returns
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
 def interrup_signal_handler(sig: int, frame: Any) -> NoReturn:
+    ignore_stop_signals()
     logger.warning("SIGINT signal received")
     close_all()
     sys.exit(0)
 
 
 def termination_signal_handler(sig: int, frame: Any) -> NoReturn:
+    ignore_stop_signals()
     logger.warning("SIGTERM signal received")
 
     # On appelle tous les callback de fermture
@@ -50,7 +70,8 @@ def termination_signal_handler(sig: int, frame: Any) -> NoReturn:
     sys.exit(0)
 
 
-def run(debug: bool, config_file: Optional[str]) -> None:
+def run(debug: bool, config_file: Optional[str], replay: Optional[str] = None,
+        speed: Optional[str] = None) -> None:
     # Handle signals
     signal.signal(signal.SIGINT, interrup_signal_handler)
     signal.signal(signal.SIGTERM, termination_signal_handler)
@@ -59,70 +80,378 @@ def run(debug: bool, config_file: Optional[str]) -> None:
     if config_file is not None:
         cfg.config.set_config_file(config_file)
     cfg.config.set_debug(debug)
+    if replay is not None:
+        cfg.config.set('RTL433', 'replay', replay)
+    if speed is not None:
+        cfg.config.set('RTL433', 'replay_speed', speed)
 
     # Create queues
-    message_queue: Queue[Dict[str, Any]] = Queue()
-    measure_queue: Queue[Measure] = Queue()
-
-    # Initialize CronScheduler
-    cron: CronScheduler = CronScheduler()
-    kill_callback.append(cron.cancel)
+    # Bounded so that a stuck database or a noisy band cannot exhaust memory
+    message_queue: BoundedQueue[Dict[str, Any]] = create_queue(
+        'messages',
+        cfg.config.getint('Queues', 'messages_size'),
+        cfg.config.get('Queues', 'messages_policy'),
+        lambda message: message.get('radio_id'),
+        cfg.config.getfloat('Queues', 'high_water'))
+    measure_queue: BoundedQueue[Measure] = create_queue(
+        'measures',
+        cfg.config.getint('Queues', 'measures_size'),
+        cfg.config.get('Queues', 'measures_policy'),
+        lambda measure: (measure.database_id, measure.metric_name()),
+        cfg.config.getfloat('Queues', 'high_water'))
 
     # Initialize database
     database: Database = Database(measure_queue)
+    kill_callback.append(database.close)
 
     # Initialize sensor manager
     manager = Manager(message_queue, measure_queue)
+    mode = cfg.config.get('Pipeline', 'mode')
+    # Streaming publishes each message as it arrives, whatever the replay speed
+    if mode != 'streaming' and any(len(SignalReader.option(section, 'replay')) > 0
+                                   for section in SignalReader.receiver_sections()):
+        manager.publish_on_recorded_time(cfg.config.get('Cron', 'process_data_cron'))
+
+    # Update database structure
+    database.check_structure()
+    database.check_sensors_definition(manager)
+    database.load_latest_values(manager)
+
+    # Rollups and retention run as jobs whatever the pipeline mode
+    jobs: List[Job] = []
+    if cfg.config.getboolean('Rollup', 'enabled'):
+        rollups = Rollups(database)
+        kill_callback.append(rollups.close)
+        rollups.check_structure()
+        jobs.append(Job('update_rollups',
+                        cfg.config.get('Rollup', 'rollup_cron'),
+                        5,
+                        rollups.update,
+                        {},
+                        False))
+        jobs.append(Job('apply_retention',
+                        cfg.config.get('Rollup', 'retention_cron'),
+                        6,
+                        rollups.apply_retention,
+                        {},
+                        False))
+
+    # The writer process and the streaming pipeline flush their own measures
+    if mode not in ('multiprocess', 'streaming'):
+        close_callback.append(database.write_measures)
+
+    # Radio ids kept by the readers, others are dropped before decoding
+    known_radio_ids: Optional[Set[str]] = None
+    if cfg.config.getboolean('RTL433', 'drop_unknown'):
+        known_radio_ids = set(manager.sensors.keys())
+
+    # Repeated transmissions of a frame are only dispatched once, possibly across receivers
+    def create_duplicate_filter() -> Optional[DuplicateFilter]:
+        if not cfg.config.getboolean('Dedup', 'enabled'):
+            return None
+        return DuplicateFilter(cfg.config.getfloat('Dedup', 'window'),
+                               cfg.config.getint('Dedup', 'max_entries'))
+
+    shared_duplicates = create_duplicate_filter()
+
+    def create_parser(section: str) -> MessageParser:
+        if cfg.config.getboolean('Dedup', 'across_receivers'):
+            duplicates = shared_duplicates
+        else:
+            duplicates = create_duplicate_filter()
+        parser = MessageParser(known_radio_ids, duplicates, SignalReader.recorded_time(section))
+        register_parser_metrics(section, parser)
+        return parser
+
+    install_profiling_handlers(message_queue, measure_queue)
+    register_metrics(manager, database, message_queue, measure_queue)
+    if cfg.config.getboolean('Metrics', 'enabled'):
+        metrics_server = MetricsServer(cfg.config.get('Metrics', 'address'),
+                                       cfg.config.getint('Metrics', 'port'))
+        kill_callback.append(metrics_server.close)
+        metrics_server.start()
+
+    if mode == 'asyncio':
+        run_async(manager, database, create_parser, jobs)
+    elif mode == 'multiprocess':
+        run_multiprocess(manager, database, create_parser, jobs)
+    else:
+        run_cron(manager, database, message_queue, create_parser, mode == 'streaming', jobs)
+
+
+def install_profiling_handlers(message_queue: Queue[Dict[str, Any]],
+                               measure_queue: Queue[Measure]) -> None:
+    directory = cfg.config.get('Profiling', 'directory')
+    profiler = SamplingProfiler(directory, cfg.config.getfloat('Profiling', 'interval') / 1000)
+    memory_tracer = MemoryTracer(directory, cfg.config.getint('Profiling', 'memory_top'))
+
+    # SIGUSR1 starts then stops a sampling session across all threads
+    def profile_signal_handler(sig: int, frame: Any) -> None:
+        try:
+            profiler.toggle()
+        except OSError as error:
+            logger.error(f"Unable to write the profile in {directory} : {error}")
+
+    # SIGUSR2 reports queue depths and starts then dumps memory tracing
+    def memory_signal_handler(sig: int, frame: Any) -> None:
+        logger.warning(f"Queue depths : {message_queue.qsize()} messages, "
+                       f"{measure_queue.qsize()} measures")
+        try:
+            memory_tracer.toggle()
+        except OSError as error:
+            logger.error(f"Unable to write the memory snapshot in {directory} : {error}")
+
+    signal.signal(signal.SIGUSR1, profile_signal_handler)
+    signal.signal(signal.SIGUSR2, memory_signal_handler)
+
+
+def register_metrics(manager: Manager, database: Database,
+                     message_queue: BoundedQueue[Dict[str, Any]],
+                     measure_queue: BoundedQueue[Measure]) -> None:
+    registry.callback('shcollector_message_queue_size', 'Messages waiting to be dispatched',
+                      'gauge', message_queue.qsize)
+    registry.callback('shcollector_measure_queue_size', 'Measures waiting to be written',
+                      'gauge', measure_queue.qsize)
+    for queue in (message_queue, measure_queue):
+        registry.callback('shcollector_queue_dropped', 'Items dropped or coalesced by full queues',
+                          'counter', partial(getattr, queue, 'dropped'), {'queue': queue.name})
+        registry.callback('shcollector_queue_max_depth', 'Highest depth reached by queues',
+                          'gauge', partial(getattr, queue, 'max_depth'), {'queue': queue.name})
+    registry.callback('shcollector_fields_invalid', 'Message fields skipped as not convertible',
+                      'counter', lambda: sum(sensor.invalid for sensor in manager.sensors.values()))
+    registry.callback('shcollector_measures_published', 'Measures published by the manager',
+                      'counter', lambda: manager.published)
+    registry.callback('shcollector_measures_suppressed', 'Measures suppressed by the deadband',
+                      'counter', lambda: manager.suppressed)
+    registry.callback('shcollector_measures_rejected', 'Measures rejected as outliers',
+                      'counter', lambda: sum(manager.rejected.values()))
+    registry.callback('shcollector_rows_rejected', 'Rows rejected by the database',
+                      'counter', lambda: database.rejected_rows)
+    spool = database.spool
+    if spool is not None:
+        registry.callback('shcollector_spool_replayed_rows', 'Measures replayed from the spool',
+                          'counter', lambda: spool.replayed_rows)
+
+
+def register_parser_metrics(section: str, parser: MessageParser) -> None:
+    labels = {'reader': section}
+    registry.callback('shcollector_lines_read', 'Lines read from rtl_433',
+                      'counter', lambda: parser.lines, labels)
+    registry.callback('shcollector_messages_parsed', 'Messages decoded from rtl_433',
+                      'counter', lambda: parser.messages, labels)
+    registry.callback('shcollector_lines_invalid', 'Lines which are not JSON or lack a model',
+                      'counter', lambda: parser.invalid, labels)
+    registry.callback('shcollector_messages_unknown_emitter',
+                      'Lines dropped before decoding as coming from unknown emitters',
+                      'counter', lambda: sum(parser.unknown_emitters.values()), labels)
+    duplicates = parser.duplicates
+    if duplicates is not None:
+        # A filter shared by all readers is reported once
+        if cfg.config.getboolean('Dedup', 'across_receivers'):
+            labels = {}
+        registry.callback('shcollector_messages_duplicated', 'Repeated frames suppressed',
+                          'counter', lambda: duplicates.suppressed, labels)
+
+
+def run_cron(manager: Manager, database: Database, message_queue: Queue[Dict[str, Any]],
+             create_parser: Callable[[str], MessageParser], streaming: bool,
+             jobs: List[Job]) -> None:
+    # Initialize CronScheduler
+    cron: CronScheduler = CronScheduler(cfg.config.getint('Cron', 'workers'),
+                                        cfg.config.get('Cron', 'missed_runs'),
+                                        cfg.config.getfloat('Cron', 'misfire_grace'))
+    kill_callback.append(cron.cancel)
 
-    # Initialize SDR reader
-    reader = SignalReader(message_queue)
+    # Initialize SDR readers, one per receiver
+    readers: Dict[str, SignalReader] = {}
+    for section in SignalReader.receiver_sections():
+        readers[section] = SignalReader(section, message_queue, create_parser(section))
 
     # Close function
-    def close_reader() -> None:
-        reader.close()
-        reader.join()
+    def close_readers() -> None:
+        for reader in readers.values():
+            reader.close()
+            reader.join()
 
-    kill_callback.append(close_reader)
+    kill_callback.append(close_readers)
 
-    # check function
-    def check_reader() -> None:
-        if not reader.is_alive():
-            close_all()
+    # Jobs may run on worker threads, they leave stopping to the main thread
+    stopping = threading.Event()
+    replay_done = threading.Event()
 
-    # Update database structure
-    database.check_structure()
-    database.check_sensors_definition(manager)
+    # check function
+    def check_readers() -> None:
+        for section, reader in readers.items():
+            logger.debug(f"[{section}] {reader.parser.stats()}")
+            if reader.is_alive():
+                continue
+            if not reader.source.restartable:
+                # Replays stop the collector once every recording was read
+                if not any(other.is_alive() for other in readers.values()):
+                    logger.warning("Replay done, stopping")
+                    replay_done.set()
+                    stopping.set()
+                continue
+            if not cfg.config.getboolean('RTL433', 'supervise'):
+                stopping.set()
+                return
+            logger.warning(f"[{section}] Restarting reader")
+            readers[section] = reader.restart()
 
     # Schedule jobs
-    check_reader_job: Job = Job('check_reader',
+    check_reader_job: Job = Job('check_readers',
                                 cfg.config.get('Cron', 'process_data_cron'),
                                 1,
-                                check_reader,
+                                check_readers,
                                 {},
                                 False)
     cron.schedule(check_reader_job)
 
-    process_messages_job: Job = Job('process_messages',
+    if streaming:
+        # Measures are published and stored as messages arrive instead of by cron jobs
+        pipeline = StreamingPipeline(manager,
+                                     database,
+                                     message_queue,
+                                     cfg.config.getint('Streaming', 'flush_size'),
+                                     cfg.config.getfloat('Streaming', 'flush_latency'))
+        # Its last flush needs the database
+        kill_callback.insert(kill_callback.index(database.close), pipeline.close)
+        pipeline.start()
+    else:
+        process_messages_job: Job = Job('process_messages',
+                                        cfg.config.get('Cron', 'process_data_cron'),
+                                        2,
+                                        manager.messages_to_measures,
+                                        {},
+                                        True)
+        cron.schedule(process_messages_job)
+
+        store_measures_job: Job = Job('store_measures',
+                                      cfg.config.get('Cron', 'write_data_cron'),
+                                      3,
+                                      database.write_measures,
+                                      {},
+                                      False)
+        cron.schedule(store_measures_job)
+
+    close_connection_job: Job = Job('close_idle_connection',
                                     cfg.config.get('Cron', 'process_data_cron'),
-                                    2,
-                                    manager.messages_to_measures,
+                                    4,
+                                    database.pool.close_idle,
                                     {},
-                                    True)
-    cron.schedule(process_messages_job)
+                                    False)
+    cron.schedule(close_connection_job)
+    for job in jobs:
+        cron.schedule(job)
 
-    store_measures_job: Job = Job('store_measures',
-                                  cfg.config.get('Cron', 'write_data_cron'),
-                                  3,
-                                  database.write_measures,
-                                  {},
-                                  False)
-    cron.schedule(store_measures_job)
+    # Launch processes
+    for reader in readers.values():
+        reader.start()
+    run_until_stopped(cron, stopping)
+    if replay_done.is_set():
+        flush_and_close(manager, database)
+    close_all()
 
-    close_callback.append(database.write_measures)
 
-    # Launch processes
-    reader.start()
-    cron.start()
+def run_async(manager: Manager, database: Database,
+              create_parser: Callable[[str], MessageParser], jobs: List[Job]) -> None:
+    pipeline = AsyncPipeline(manager,
+                             SignalReader.receiver_sections(),
+                             create_parser,
+                             cfg.config.getboolean('RTL433', 'supervise'),
+                             cfg.config.getint('Queues', 'messages_size'))
+    kill_callback.append(pipeline.close)
+
+    # Messages are dispatched as they arrive, only publishing is periodic
+    pipeline.schedule(Job('publish_measures',
+                          cfg.config.get('Cron', 'process_data_cron'),
+                          2,
+                          manager.messages_to_measures,
+                          {},
+                          True), False)
+    pipeline.schedule(Job('store_measures',
+                          cfg.config.get('Cron', 'write_data_cron'),
+                          3,
+                          database.write_measures,
+                          {},
+                          False), True)
+    pipeline.schedule(Job('close_idle_connection',
+                          cfg.config.get('Cron', 'process_data_cron'),
+                          4,
+                          database.pool.close_idle,
+                          {},
+                          False), True)
+    pipeline.schedule(Job('log_reader_stats',
+                          cfg.config.get('Cron', 'process_data_cron'),
+                          1,
+                          pipeline.log_stats,
+                          {},
+                          False), False)
+    for job in jobs:
+        pipeline.schedule(job, True)
+
+    # Returns once every rtl_433 exited or every recording was replayed
+    pipeline.run()
+    flush_and_close(manager, database)
+
+
+def run_multiprocess(manager: Manager, database: Database,
+                     create_parser: Callable[[str], MessageParser], jobs: List[Job]) -> None:
+    cron: CronScheduler = CronScheduler(cfg.config.getint('Cron', 'workers'),
+                                        cfg.config.get('Cron', 'missed_runs'),
+                                        cfg.config.getfloat('Cron', 'misfire_grace'))
+    kill_callback.append(cron.cancel)
+
+    # Readers, processing and writer run in their own processes, this one supervises them
+    pipeline = MultiprocessPipeline(manager,
+                                    database,
+                                    SignalReader.receiver_sections(),
+                                    create_parser,
+                                    cfg.config.getboolean('RTL433', 'supervise'))
+    kill_callback.append(pipeline.close)
+
+    stopping = threading.Event()
+
+    def check_processes() -> None:
+        if not pipeline.check_processes():
+            stopping.set()
+
+    cron.schedule(Job('check_processes',
+                      cfg.config.get('Cron', 'process_data_cron'),
+                      1,
+                      check_processes,
+                      {},
+                      False))
+    for job in jobs:
+        cron.schedule(job)
+
+    pipeline.start()
+    run_until_stopped(cron, stopping)
+    close_all()
+
+
+def run_until_stopped(cron: CronScheduler, stopping: threading.Event) -> None:
+    # The scheduler runs on its own thread, the main thread keeps handling signals
+    def schedule() -> None:
+        try:
+            cron.start()
+        finally:
+            stopping.set()
+
+    scheduler = threading.Thread(target=schedule, name="scheduler")
+    scheduler.start()
+    stopping.wait()
+    # Runs in progress complete before anything is flushed or closed from here
+    cron.cancel(wait=True)
+    scheduler.join()
+
+
+def flush_and_close(manager: Manager, database: Database) -> NoReturn:
+    # Publish and store what was received since the last jobs ran
+    manager.dispatch_messages()
+    manager.publish_measures(datetime.now().astimezone())
+    database.write_measures()
+    close_all()
 
 
 if __name__ == '__main__':
@@ -130,6 +459,9 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--debug", help="Activer les logs de debug", action="store_true")
     parser.add_argument("-c", "--config", help="Spécifier un fichier de configuration")
+    parser.add_argument("-r", "--replay",
+                        help="Rejouer des enregistrements (fichier, répertoire ou - pour stdin)")
+    parser.add_argument("-s", "--speed", help="Vitesse de rejeu : realtime, x10, fast")
     args = parser.parse_args()
 
-    run(args.debug, args.config)
+    run(args.debug, args.config, args.replay, args.speed)
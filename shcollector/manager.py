@@ -1,86 +1,183 @@
 from __future__ import annotations
-from typing import Dict, Any
-from sensors.lacrossetx29it import LaCrosseTX29IT
-from sensors.lacrossetx35 import LaCrosseTX35
-from sensors.thermoprotx2c import ThermoProTX2C
+from typing import Counter, Dict, Any, List, Optional, Set, Tuple
 from queue import Queue
-from sensors.sensor import Sensor
+from croniter import croniter
+from sensors.sensor import Sensor, AGGREGATES
+from sensors.registry import load_models
 from sensors.measure import Measure
-from datetime import datetime
+from sensors.metrics import Types
+from utils.outlier import RollingOutlierFilter
+from utils.instrumentation import registry
+from datetime import datetime, timedelta
 import logging
 import cfg
 
 
 logger = logging.getLogger('manager')
 
+dispatched_messages = registry.counter('shcollector_messages_dispatched',
+                                       'Messages dispatched to a configured sensor')
+unknown_messages = registry.counter('shcollector_messages_unknown',
+                                    'Messages from unconfigured radio ids reaching the manager')
+
 
 class Manager:
 
     def __init__(self, message_queue: Queue[Dict[str, Any]], measure_queue: Queue[Measure]):
         self.sensors: Dict[str, Sensor] = {}
+        # Rolling outlier filter (window, k) of each sensor, by database id
+        self.outlier_settings: Dict[str, Tuple[int, float]] = {}
         self.build_sensors()
         self.message_queue: Queue[Dict[str, Any]] = message_queue
         self.measure_queue: Queue[Measure] = measure_queue
-        self.latest_values: Dict[int, Measure] = {}
+        self.latest_values: Dict[Tuple[str, str], Measure] = {}
+        # Aggregate of each window published as the metric's value, and additional ones
+        self.primary_aggregate: str = cfg.config.get('Aggregation', 'primary')
+        self.extra_aggregates: List[str] = [aggregate.strip() for aggregate
+                                            in cfg.config.get('Aggregation', 'extra').split(',')
+                                            if len(aggregate.strip()) > 0]
+        for aggregate in [self.primary_aggregate] + self.extra_aggregates:
+            if aggregate not in AGGREGATES:
+                raise ValueError(f"Unknown aggregate {aggregate}, expected one of {AGGREGATES}")
+        # Change-only reporting : values within the deadband of the latest stored one are skipped
+        # until the heartbeat expires
+        self.deadband_enabled: bool = cfg.config.getboolean('Deadband', 'enabled')
+        self.deadband: Dict[Types, float] = {
+            metric: cfg.config.getfloat('Deadband', metric.name, fallback=metric.deadband())
+            for metric in Types}
+        self.heartbeat: timedelta = timedelta(seconds=cfg.config.getfloat('Deadband', 'heartbeat'))
+        self.published: int = 0
+        self.suppressed: int = 0
+        # Rejected values are counted by sensor and optionally stored in a quarantine table
+        self.outlier_filters: Dict[Tuple[str, str], RollingOutlierFilter] = {}
+        self.outlier_recovery: int = cfg.config.getint('Outlier', 'recovery')
+        self.quarantine: bool = cfg.config.getboolean('Outlier', 'quarantine')
+        self.rejected: Counter[str] = Counter()
+        # Replays publish windows of recorded time, see publish_on_recorded_time
+        self.window_cron: Optional[str] = None
+        self.window_ends: Dict[str, datetime] = {}
 
     def build_sensors(self: Manager) -> None:
+        models = load_models()
         for section_name in cfg.config.sections():
             if section_name.startswith("sensor:"):
                 section = cfg.config[section_name]
                 sensor_type = section['type']
-                if sensor_type == LaCrosseTX29IT.SENSOR_TYPE_NAME:
-                    sensor = LaCrosseTX29IT(
-                        section['radio_id'],
-                        section['database_id'],
-                        section['name'],
-                        section['location'])
-                    self.sensors[section['radio_id']] = sensor
-                    logger.debug(f"Registered sensor : {section['name']}")
-                elif sensor_type == LaCrosseTX35.SENSOR_TYPE_NAME:
-                    sensor = LaCrosseTX35(
-                        section['radio_id'],
-                        section['database_id'],
-                        section['name'],
-                        section['location'])
-                    self.sensors[section['radio_id']] = sensor
-                    logger.debug(f"Registered sensor : {section['name']}")
-                elif sensor_type == ThermoProTX2C.SENSOR_TYPE_NAME:
-                    sensor = ThermoProTX2C(
-                        section['radio_id'],
-                        section['database_id'],
-                        section['name'],
-                        section['location'])
-                    self.sensors[section['radio_id']] = sensor
-                    logger.debug(f"Registered sensor : {section['name']}")
-                else:
+                if sensor_type not in models:
                     logger.warning(f"Unknown sensor config {section_name} with type {sensor_type}")
                     continue
-            else:
-                pass
+                self.sensors[section['radio_id']] = Sensor(models[sensor_type],
+                                                           section['radio_id'],
+                                                           section['database_id'],
+                                                           section['name'],
+                                                           section['location'])
+                window = section.getint('outlier_window', cfg.config.getint('Outlier', 'window'))
+                # Filters are created on the first measures, settings are checked right away
+                RollingOutlierFilter.check(window, cfg.config.getint('Outlier', 'recovery'))
+                self.outlier_settings[section['database_id']] = (
+                    window, section.getfloat('outlier_k', cfg.config.getfloat('Outlier', 'k')))
+                logger.debug(f"Registered sensor : {section['name']}")
 
     def dispatch_messages(self: Manager) -> None:
         while not self.message_queue.empty():
-            message: Dict[str, Any] = self.message_queue.get()
-            if 'radio_id' not in message:
-                logger.error(f"Message without radio_id : {message}")
-            elif message['radio_id'] in self.sensors.keys():
-                sensor = self.sensors[message['radio_id']]
-                sensor.process_incoming_message(message)
-            else:
-                logger.debug(f"Unknown message from {message['radio_id']}")
+            self.dispatch_message(self.message_queue.get())
+
+    def dispatch_message(self: Manager, message: Dict[str, Any]) -> Optional[Sensor]:
+        if 'radio_id' not in message:
+            logger.error(f"Message without radio_id : {message}")
+        elif message['radio_id'] in self.sensors.keys():
+            sensor = self.sensors[message['radio_id']]
+            if self.window_cron is not None:
+                self.close_recorded_window(sensor, message['acquisition_date'])
+            sensor.process_incoming_message(message)
+            dispatched_messages.inc()
+            return sensor
+        else:
+            unknown_messages.inc()
+            logger.debug(f"Unknown message from {message['radio_id']}")
+        return None
+
+    def publish_on_recorded_time(self: Manager, expression: str) -> None:
+        # A fast replay would be merged into a few wall clock windows: each sensor's window
+        # is published once one of its messages is dated after the window end instead
+        self.window_cron = expression
+
+    def close_recorded_window(self: Manager, sensor: Sensor, acquisition_date: datetime) -> None:
+        assert self.window_cron is not None
+        window_end = self.window_ends.get(sensor.database_id)
+        if window_end is not None and acquisition_date < window_end:
+            return
+        if window_end is not None:
+            self.publish_sensor_measures(sensor, window_end)
+        self.window_ends[sensor.database_id] = croniter(self.window_cron,
+                                                        acquisition_date).get_next(datetime)
+
+    def publish_window(self: Manager, run_date: datetime) -> None:
+        # Scheduled publishing, replays publish their windows as messages are dispatched
+        if self.window_cron is None:
+            self.publish_measures(run_date)
 
     def publish_measures(self: Manager, timestamp: datetime) -> None:
         for sensor in self.sensors.values():
-            measures = sensor.get_measures(timestamp)
-            for measure in measures:
-                latest_val = self.latest_values.get(measure.get_cache_key())
-                if latest_val and abs(latest_val.data - measure.data) > measure.metric.threshold():
-                    logger.info(f"Incoherent value (Δ > {measure.metric.threshold()}) : {measure}")
-                else:
-                    logger.info(f"{measure}")
+            # Windows still open at the end of a replay end at their recorded time
+            self.publish_sensor_measures(sensor,
+                                         self.window_ends.pop(sensor.database_id, timestamp))
+
+        if self.deadband_enabled and self.suppressed > 0 and logger.isEnabledFor(logging.DEBUG):
+            total = self.published + self.suppressed
+            logger.debug(f"Deadband suppressed {self.suppressed} of {total} values "
+                         f"({self.suppressed / total:.0%})")
+
+    def publish_sensor_measures(self: Manager, sensor: Sensor, timestamp: datetime) -> None:
+        measures = sensor.get_measures(timestamp, self.primary_aggregate, self.extra_aggregates)
+        skipped: Set[Types] = set()
+        for measure in measures:
+            if measure.aggregate is not None:
+                # Secondary aggregates follow the fate of the metric's value
+                if measure.metric not in skipped:
                     self.measure_queue.put(measure)
-                    self.latest_values[measure.get_cache_key()] = measure
+                continue
+            latest_val = self.latest_values.get(measure.get_cache_key())
+            if not self.get_outlier_filter(measure).accept(measure.data):
+                logger.info(f"Incoherent value : {measure}")
+                self.rejected[measure.database_id] += 1
+                skipped.add(measure.metric)
+                if self.quarantine:
+                    measure.quarantined = True
+                    self.measure_queue.put(measure)
+            elif latest_val and self.within_deadband(latest_val, measure):
+                logger.debug(f"Unchanged value : {measure}")
+                self.suppressed += 1
+                skipped.add(measure.metric)
+            else:
+                logger.info(f"{measure}")
+                self.published += 1
+                self.measure_queue.put(measure)
+                self.latest_values[measure.get_cache_key()] = measure
+
+    def seed_latest_values(self: Manager, measures: List[Measure]) -> None:
+        # Latest stored values of a previous run, so that the first readings get checked too
+        for measure in measures:
+            self.latest_values[measure.get_cache_key()] = measure
+            self.get_outlier_filter(measure).seed([measure.data])
+        logger.info(f"Seeded {len(measures)} latest values")
+
+    def get_outlier_filter(self: Manager, measure: Measure) -> RollingOutlierFilter:
+        key = measure.get_cache_key()
+        if key not in self.outlier_filters:
+            window, k = self.outlier_settings[measure.database_id]
+            self.outlier_filters[key] = RollingOutlierFilter(window,
+                                                             k,
+                                                             measure.metric.threshold() / 10,
+                                                             measure.metric.threshold(),
+                                                             self.outlier_recovery)
+        return self.outlier_filters[key]
+
+    def within_deadband(self: Manager, latest_val: Measure, measure: Measure) -> bool:
+        return (self.deadband_enabled
+                and abs(latest_val.data - measure.data) <= self.deadband[measure.metric]
+                and measure.time - latest_val.time < self.heartbeat)
 
     def messages_to_measures(self: Manager, run_date: datetime) -> None:
         self.dispatch_messages()
-        self.publish_measures(run_date)
+        self.publish_window(run_date)
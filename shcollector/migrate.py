@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# vim: set fileencoding=utf-8 :
+# Copies the measures of sensors_data (schema v1) to sensors_data_v2 in small batches,
+# while the collector keeps running with [Database] schema_version = 2.
+# Progress is saved with each batch, an interrupted migration resumes where it stopped.
+
+import argparse
+import logging
+import sys
+import time
+from queue import Queue
+from typing import Any, List, Optional, Tuple
+
+from psycopg2.extras import execute_values
+from psycopg2.extensions import cursor
+import psycopg2
+
+from reporters.database import Database
+from reporters.rollup import LEVELS
+import cfg
+
+
+logger = logging.getLogger('migrate')
+
+MIGRATION = 'sensors_data_v2'
+
+
+def create_progress_table(database: Database, db_cursor: cursor) -> None:
+    db_cursor.execute(
+        "CREATE TABLE IF NOT EXISTS " + database.schema + ".migrations ("
+        "  \"name\" text PRIMARY KEY,"
+        "  \"time\" timestamp with time zone,"
+        "  \"idsensor\" text,"
+        "  \"metric\" text,"
+        "  \"rows\" bigint NOT NULL DEFAULT 0"
+        ");")
+    db_cursor.execute(
+        "INSERT INTO " + database.schema + ".migrations (name) VALUES (%(name)s)"
+        "  ON CONFLICT (name) DO NOTHING;", {'name': MIGRATION})
+
+
+def load_progress(database: Database, db_cursor: cursor) -> Tuple[Optional[Tuple[Any, ...]], int]:
+    db_cursor.execute(
+        "SELECT time, idsensor, metric, rows FROM " + database.schema + ".migrations"
+        "  WHERE name = %(name)s;", {'name': MIGRATION})
+    row = db_cursor.fetchone()
+    assert row is not None
+    last_time, idsensor, metric, rows = row
+    if last_time is None:
+        return None, rows
+    return (last_time, idsensor, metric), rows
+
+
+def read_batch(database: Database, db_cursor: cursor, position: Optional[Tuple[Any, ...]],
+               batch_size: int) -> List[Tuple[Any, ...]]:
+    # Walks the v1 primary key, each batch is a single index range scan
+    query = ("SELECT time, idsensor, metric, data FROM " + database.schema + ".sensors_data"
+             + ("" if position is None else " WHERE (time, idsensor, metric) > %(position)s") +
+             "  ORDER BY time, idsensor, metric"
+             "  LIMIT %(limit)s;")
+    db_cursor.execute(query, {'position': position, 'limit': batch_size})
+    return db_cursor.fetchall()
+
+
+def add_metrics(database: Database, db_cursor: cursor, names: List[str]) -> None:
+    # Metrics written by former versions of the collector
+    logger.info(f"Adding metrics {', '.join(names)}")
+    db_cursor.execute(
+        "INSERT INTO " + database.schema + ".metrics (name)"
+        "  SELECT unnest(%(names)s)"
+        "  ON CONFLICT (name) DO NOTHING;", {'names': names})
+    database.load_keys(db_cursor)
+
+
+def copy_batch(database: Database, db_cursor: cursor, rows: List[Tuple[Any, ...]]) -> int:
+    unknown_metrics = sorted(set(metric for _, _, metric, _ in rows) - database.metric_ids.keys())
+    if len(unknown_metrics) > 0:
+        add_metrics(database, db_cursor, unknown_metrics)
+    if any(idsensor not in database.sensor_keys for _, idsensor, _, _ in rows):
+        # Sensors defined since the migration started
+        database.load_keys(db_cursor)
+    if database.partitioned:
+        database.ensure_partitions(db_cursor, (row[0] for row in rows))
+
+    values = [(time, database.sensor_keys[idsensor], database.metric_ids[metric], data)
+              for time, idsensor, metric, data in rows]
+    # Measures already written by the collector are kept
+    execute_values(db_cursor,
+                   "INSERT INTO " + database.schema + ".sensors_data_v2"
+                   "  (time, sensorkey, idmetric, data) VALUES %s"
+                   "  ON CONFLICT (sensorkey, idmetric, time) DO NOTHING;",
+                   values,
+                   page_size=len(values))
+    inserted: int = db_cursor.rowcount
+    # Rollups already computed by the collector cover the copied history again
+    if rollup_watermarks(database, db_cursor):
+        db_cursor.execute(database.lower_watermarks,
+                          {'time': min(row[0] for row in rows),
+                           'names': database.rollup_watermarks})
+    return inserted
+
+
+def rollup_watermarks(database: Database, db_cursor: cursor) -> bool:
+    # Rollups may be enabled while the migration runs
+    if len(database.rollup_watermarks) == 0:
+        db_cursor.execute("SELECT to_regclass(%(table)s) IS NOT NULL;",
+                          {'table': database.schema + ".rollup_watermarks"})
+        row = db_cursor.fetchone()
+        if row is not None and row[0]:
+            database.rollup_watermarks = [f"sensors_data_v2_{level}" for level, _ in LEVELS]
+    return len(database.rollup_watermarks) > 0
+
+
+def save_progress(database: Database, db_cursor: cursor, position: Tuple[Any, ...],
+                  rows: int) -> None:
+    db_cursor.execute(
+        "UPDATE " + database.schema + ".migrations"
+        "  SET time = %(time)s, idsensor = %(idsensor)s, metric = %(metric)s, rows = %(rows)s"
+        "  WHERE name = %(name)s;",
+        {'time': position[0], 'idsensor': position[1], 'metric': position[2], 'rows': rows,
+         'name': MIGRATION})
+
+
+def run(debug: bool, config_file: Optional[str], batch_size: int, pause: float) -> None:
+    if config_file is not None:
+        cfg.config.set_config_file(config_file)
+    cfg.config.set_debug(debug)
+    cfg.config.set('Database', 'schema_version', '2')
+    cfg.config.set('Spool', 'enabled', 'false')
+
+    database = Database(Queue())
+    database.check_structure()
+    with database.pool.connection() as db_connection, db_connection.cursor() as db_cursor:
+        create_progress_table(database, db_cursor)
+        database.load_keys(db_cursor)
+        position, copied = load_progress(database, db_cursor)
+        db_connection.commit()
+    if position is not None:
+        logger.info(f"Resuming after {position[0]}, {copied} rows copied so far")
+
+    start = time.monotonic()
+    while True:
+        with database.pool.connection() as db_connection, db_connection.cursor() as db_cursor:
+            rows = read_batch(database, db_cursor, position, batch_size)
+            if len(rows) == 0:
+                db_connection.rollback()
+                break
+            inserted = copy_batch(database, db_cursor, rows)
+            position = rows[-1][:3]
+            copied += len(rows)
+            save_progress(database, db_cursor, position, copied)
+            # A batch and its progress are committed together
+            db_connection.commit()
+        logger.info(f"Copied {len(rows)} rows up to {position[0]} ({inserted} new), "
+                    f"{copied} in total, {copied / (time.monotonic() - start):.0f} rows/s")
+        # Leaves room to the collector and other clients
+        time.sleep(pause)
+
+    logger.info(f"Migration done, {copied} rows copied. sensors_data can be dropped once "
+                f"the collector runs with schema_version = 2")
+    database.close()
+
+
+if __name__ == '__main__':
+    # handle flags
+    parser = argparse.ArgumentParser(description="Migration de sensors_data vers le schéma v2")
+    parser.add_argument("-d", "--debug", help="Activer les logs de debug", action="store_true")
+    parser.add_argument("-c", "--config", help="Spécifier un fichier de configuration")
+    parser.add_argument("-b", "--batch", type=int, default=5000,
+                        help="Nombre de lignes copiées par transaction")
+    parser.add_argument("-p", "--pause", type=float, default=0.1,
+                        help="Pause en secondes entre deux lots")
+    args = parser.parse_args()
+
+    try:
+        run(args.debug, args.config, args.batch, args.pause)
+    except psycopg2.DatabaseError as error:
+        Database.log_psycopg2_exception(error)
+        sys.exit(1)
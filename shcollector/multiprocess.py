@@ -0,0 +1,312 @@
+from __future__ import annotations
+from datetime import datetime, timedelta, timezone as fixed_timezone
+from multiprocessing.connection import Connection, wait
+from typing import Callable, Dict, List, Optional, Tuple
+import multiprocessing
+import os
+import signal
+import struct
+import threading
+import time
+import logging
+from manager import Manager
+from reporters.database import Database
+from sdr import MessageParser, SignalReader
+from sensors.measure import Measure
+from sensors.metrics import Types
+from utils.cron import Job, timezone
+from utils.instrumentation import Snapshot, registry
+import cfg
+
+logger = logging.getLogger('multiprocess')
+
+# Frames exchanged between processes start with their kind
+FRAME_LINE = b'L'
+FRAME_MEASURES = b'M'
+FRAME_STOP = b'S'
+# Reception time of a line
+LINE_HEADER = struct.Struct('!d')
+# Time, UTC offset in seconds, value and quarantine flag of a measure, followed by its
+# database id, metric and aggregate as length-prefixed strings
+MEASURE_HEADER = struct.Struct('!did?')
+TEXT_LENGTH = struct.Struct('!H')
+
+JOIN_TIMEOUT = 30
+
+
+def encode_line(line: bytes) -> bytes:
+    return FRAME_LINE + LINE_HEADER.pack(time.time()) + line
+
+
+def decode_line(frame: bytes) -> Tuple[datetime, bytes]:
+    (received,) = LINE_HEADER.unpack_from(frame, 1)
+    return datetime.fromtimestamp(received).astimezone(), frame[1 + LINE_HEADER.size:]
+
+
+def encode_measures(measures: List[Measure]) -> bytes:
+    parts = [FRAME_MEASURES]
+    for measure in measures:
+        offset = measure.time.utcoffset() or timedelta(0)
+        parts.append(MEASURE_HEADER.pack(measure.time.timestamp(),
+                                         int(offset.total_seconds()),
+                                         measure.data,
+                                         measure.quarantined))
+        for text in (measure.database_id, measure.metric.name, measure.aggregate or ''):
+            encoded = text.encode()
+            parts.append(TEXT_LENGTH.pack(len(encoded)))
+            parts.append(encoded)
+    return b''.join(parts)
+
+
+def decode_measures(frame: bytes) -> List[Measure]:
+    measures: List[Measure] = []
+    position = 1
+    while position < len(frame):
+        timestamp, offset, data, quarantined = MEASURE_HEADER.unpack_from(frame, position)
+        position += MEASURE_HEADER.size
+        texts: List[str] = []
+        for _ in range(3):
+            (length,) = TEXT_LENGTH.unpack_from(frame, position)
+            position += TEXT_LENGTH.size
+            texts.append(frame[position:position + length].decode())
+            position += length
+        measure = Measure(datetime.fromtimestamp(timestamp,
+                                                 fixed_timezone(timedelta(seconds=offset))),
+                          texts[0],
+                          Types[texts[1]],
+                          data,
+                          texts[2] or None)
+        measure.quarantined = quarantined
+        measures.append(measure)
+    return measures
+
+
+def detach_signals() -> None:
+    # The parent stops its children in order: Ctrl-C and a SIGTERM sent to the whole process
+    # group are left to it, processing and writer only stop on its FRAME_STOP, once flushed
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+def seconds_until(run_date: datetime) -> float:
+    return max(0.0, (run_date - timezone.localize(datetime.now())).total_seconds())
+
+
+# Reader, processing and writer processes connected by pipes, supervised by the main process:
+# readers only forward rtl_433 lines, so that neither decoding nor database work can make
+# rtl_433 block on a full pipe, and the three stages run on separate cores.
+class MultiprocessPipeline():
+
+    def __init__(self: MultiprocessPipeline, manager: Manager, database: Database,
+                 sections: List[str], create_parser: Callable[[str], MessageParser],
+                 supervise: bool):
+        self.context = multiprocessing.get_context('fork')
+        self.manager: Manager = manager
+        self.database: Database = database
+        self.sections: List[str] = sections
+        self.create_parser: Callable[[str], MessageParser] = create_parser
+        self.supervise: bool = supervise
+        self.parent: int = os.getpid()
+        # One pipe per reader, a control pipe to the processing process, one to the writer
+        self.lines: Dict[str, Tuple[Connection, Connection]] = {
+            section: self.context.Pipe(duplex=False) for section in sections}
+        self.control: Tuple[Connection, Connection] = self.context.Pipe(duplex=False)
+        self.measures: Tuple[Connection, Connection] = self.context.Pipe(duplex=False)
+        # Metrics of the processing and writer processes are forwarded to the exporter
+        self.forward_metrics: bool = cfg.config.getboolean('Metrics', 'enabled')
+        self.stats: Dict[str, Tuple[Connection, Connection]] = {
+            name: self.context.Pipe(duplex=False) for name in ('processing', 'writer')}
+        self.stats_receiver: Optional[threading.Thread] = None
+        self.stats_stopped = threading.Event()
+        self.readers: Dict[str, multiprocessing.process.BaseProcess] = {}
+        self.processing: Optional[multiprocessing.process.BaseProcess] = None
+        self.writer: Optional[multiprocessing.process.BaseProcess] = None
+        self.stopping: bool = False
+
+    def start(self: MultiprocessPipeline) -> None:
+        # Children open their own database connection
+        self.database.pool.close()
+        self.writer = self.start_process('writer', self.write)
+        self.processing = self.start_process('processing', self.process)
+        for section in self.sections:
+            self.readers[section] = self.start_process(section, self.read, section)
+        if self.forward_metrics:
+            self.stats_receiver = threading.Thread(target=self.receive_stats, name="stats",
+                                                   daemon=True)
+            self.stats_receiver.start()
+
+    def start_process(self: MultiprocessPipeline, name: str, target: Callable[..., None],
+                      *args: str) -> multiprocessing.process.BaseProcess:
+        process = self.context.Process(target=target, name=name, args=args)
+        process.start()
+        logger.info(f"Started {name} process [{process.pid}]")
+        return process
+
+    def orphaned(self: MultiprocessPipeline) -> bool:
+        return os.getppid() != self.parent
+
+    def keep(self: MultiprocessPipeline, *kept: Connection) -> None:
+        # Forked children close the pipe ends they do not use, so that a reader blocked on a
+        # full pipe gets an error once the processes draining it are gone
+        ends = [end for pipe in self.lines.values() for end in pipe]
+        ends.extend(self.control + self.measures)
+        ends.extend(end for pipe in self.stats.values() for end in pipe)
+        for end in ends:
+            if end not in kept:
+                end.close()
+
+    def read(self: MultiprocessPipeline, section: str) -> None:
+        detach_signals()
+        sender = self.lines[section][1]
+        self.keep(sender)
+        source = SignalReader.create_source(section)
+        signal.signal(signal.SIGTERM, lambda sig, frame: source.close())
+        logger.info(f"[{section}] Starting reader process")
+        send = sender.send_bytes
+        for line in source.lines():
+            send(encode_line(line))
+
+    def process(self: MultiprocessPipeline) -> None:
+        detach_signals()
+        baseline = registry.snapshot()
+        receivers = [self.lines[section][0] for section in self.sections]
+        self.keep(*receivers, self.control[0], self.measures[1], self.stats['processing'][1])
+        parsers = {receiver: self.create_parser(section)
+                   for receiver, section in zip(receivers, self.sections)}
+        job = Job('publish_measures', cfg.config.get('Cron', 'process_data_cron'), 2,
+                  self.manager.publish_window, {}, True)
+        run_date = job.next_run(timezone.localize(datetime.now()))
+
+        while not self.orphaned():
+            for connection in wait(receivers + [self.control[0]],
+                                   min(seconds_until(run_date), 1.0)):
+                if connection is self.control[0]:
+                    # Lines already sent by the stopped readers are processed first
+                    for receiver, parser in parsers.items():
+                        while receiver.poll():
+                            self.parse(parser, receiver.recv_bytes())
+                    self.manager.publish_measures(timezone.localize(datetime.now()))
+                    self.send_measures()
+                    self.measures[1].send_bytes(FRAME_STOP)
+                    self.send_stats('processing', baseline)
+                    return
+                self.parse(parsers[connection], connection.recv_bytes())  # type: ignore
+            if seconds_until(run_date) == 0:
+                try:
+                    self.manager.publish_window(run_date)
+                except Exception:
+                    logger.exception(f"Unable to publish measures of {str(run_date)}")
+                self.send_measures()
+                self.send_stats('processing', baseline)
+                run_date = job.next_run(timezone.localize(datetime.now()))
+
+    def parse(self: MultiprocessPipeline, parser: MessageParser, frame: bytes) -> None:
+        # A failing line is skipped, restarting the process would lose every open window
+        try:
+            received, line = decode_line(frame)
+            message = parser.parse(line, received)
+            if message is not None:
+                self.manager.dispatch_message(message)
+        except Exception:
+            logger.exception(f"Unable to process line {frame[1 + LINE_HEADER.size:]!r}")
+
+    def send_measures(self: MultiprocessPipeline) -> None:
+        measures: List[Measure] = []
+        while not self.manager.measure_queue.empty():
+            measures.append(self.manager.measure_queue.get_nowait())
+        if len(measures) > 0:
+            self.measures[1].send_bytes(encode_measures(measures))
+
+    def write(self: MultiprocessPipeline) -> None:
+        detach_signals()
+        baseline = registry.snapshot()
+        receiver = self.measures[0]
+        self.keep(receiver, self.stats['writer'][1])
+        job = Job('store_measures', cfg.config.get('Cron', 'write_data_cron'), 3,
+                  self.database.write_measures, {}, False)
+        run_date = job.next_run(timezone.localize(datetime.now()))
+
+        while not self.orphaned():
+            if receiver.poll(min(seconds_until(run_date), 1.0)):
+                frame = receiver.recv_bytes()
+                if frame[:1] == FRAME_STOP:
+                    break
+                for measure in decode_measures(frame):
+                    self.database.measure_queue.put(measure)
+            if seconds_until(run_date) == 0:
+                self.database.write_measures()
+                self.database.pool.close_idle()
+                self.send_stats('writer', baseline)
+                run_date = job.next_run(timezone.localize(datetime.now()))
+        self.database.write_measures()
+        self.database.close()
+        self.send_stats('writer', baseline)
+
+    def send_stats(self: MultiprocessPipeline, name: str, baseline: Snapshot) -> None:
+        # Metrics left as forked are the parent's own, only those changed here are sent
+        if self.forward_metrics:
+            self.stats[name][1].send({key: value for key, value in registry.snapshot().items()
+                                      if baseline.get(key) != value})
+
+    def receive_stats(self: MultiprocessPipeline) -> None:
+        # Drained as they come so that children never block on a full pipe
+        receivers = [pipe[0] for pipe in self.stats.values()]
+        while not self.stats_stopped.is_set():
+            for connection in wait(receivers, 1.0):
+                registry.merge(connection.recv())  # type: ignore
+
+    def drain_stats(self: MultiprocessPipeline) -> None:
+        # Final metrics sent by the stopped processes
+        self.stats_stopped.set()
+        if self.stats_receiver is not None:
+            self.stats_receiver.join()
+        for receiver, _ in self.stats.values():
+            while receiver.poll():
+                registry.merge(receiver.recv())
+
+    def check_processes(self: MultiprocessPipeline) -> bool:
+        # Restarts dead processes, returns False once the collector has to stop
+        if self.stopping:
+            return False
+        if self.writer is not None and not self.writer.is_alive():
+            logger.error(f"Writer process exited with {self.writer.exitcode}, restarting it")
+            self.writer = self.start_process('writer', self.write)
+        if self.processing is not None and not self.processing.is_alive():
+            logger.error(f"Processing process exited with {self.processing.exitcode}, "
+                         f"restarting it")
+            self.processing = self.start_process('processing', self.process)
+
+        for section, reader in self.readers.items():
+            if reader.is_alive() or len(SignalReader.option(section, 'replay')) > 0:
+                continue
+            if not self.supervise:
+                logger.error(f"[{section}] Reader process exited with {reader.exitcode}")
+                return False
+            logger.warning(f"[{section}] Restarting reader process")
+            self.readers[section] = self.start_process(section, self.read, section)
+
+        if not any(reader.is_alive() for reader in self.readers.values()):
+            # Replays stop the collector once every recording was read
+            logger.warning("Replay done, stopping")
+            return False
+        return True
+
+    def close(self: MultiprocessPipeline) -> None:
+        if self.stopping or os.getpid() != self.parent:
+            return
+        self.stopping = True
+        # Readers first, then what they sent is published and written
+        for reader in self.readers.values():
+            if reader.is_alive():
+                reader.terminate()
+        for reader in self.readers.values():
+            reader.join(JOIN_TIMEOUT)
+        self.control[1].send_bytes(FRAME_STOP)
+        for process in (self.processing, self.writer):
+            if process is None:
+                continue
+            process.join(JOIN_TIMEOUT)
+            if process.is_alive():
+                logger.error(f"The {process.name} process [{process.pid}] did not stop in time")
+                process.kill()
+        self.drain_stats()
@@ -0,0 +1,108 @@
+from __future__ import annotations
+from contextlib import contextmanager
+from typing import Iterator, Optional
+import threading
+import time
+import logging
+from psycopg2._psycopg import connection as pg_connection
+import psycopg2
+import cfg
+
+logger = logging.getLogger("connection")
+
+
+# Long-lived connection shared by the database reporter. Failed connections are
+# retried with an exponential backoff, failing fast in between attempts.
+class ConnectionPool():
+
+    def __init__(self: ConnectionPool):
+        self.dsn: str = cfg.config.postgres_dsn()
+        self.idle_timeout: float = cfg.config.getfloat('Database', 'idle_timeout')
+        self.health_check_interval: float = cfg.config.getfloat('Database',
+                                                                'health_check_interval')
+        self.min_delay: float = cfg.config.getfloat('Database', 'reconnect_min_delay')
+        self.max_delay: float = cfg.config.getfloat('Database', 'reconnect_max_delay')
+        self.db_connection: Optional[pg_connection] = None
+        self.last_used: float = 0.0
+        self.retry_delay: float = 0.0
+        self.next_attempt: float = 0.0
+        self.lock = threading.RLock()
+
+    @contextmanager
+    def connection(self: ConnectionPool) -> Iterator[pg_connection]:
+        with self.lock:
+            db_connection = self._acquire()
+            try:
+                yield db_connection
+            except BaseException:
+                self._recover(db_connection)
+                raise
+            finally:
+                self.last_used = time.monotonic()
+
+    def _acquire(self: ConnectionPool) -> pg_connection:
+        now = time.monotonic()
+        if self.db_connection is not None and self.db_connection.closed:
+            logger.warning("Database connection was lost")
+            self.db_connection = None
+
+        if self.db_connection is not None and now - self.last_used > self.health_check_interval:
+            if not self._is_healthy(self.db_connection):
+                logger.warning("Database connection failed health check")
+                self.close()
+
+        if self.db_connection is None:
+            self.db_connection = self._connect(now)
+        return self.db_connection
+
+    def _connect(self: ConnectionPool, now: float) -> pg_connection:
+        if now < self.next_attempt:
+            raise psycopg2.OperationalError(f"Database unavailable, next connection attempt in "
+                                            f"{self.next_attempt - now:.1f}s")
+        try:
+            logger.info("Opening database connection")
+            db_connection: pg_connection = psycopg2.connect(self.dsn)
+        except psycopg2.OperationalError:
+            self.retry_delay = min(max(self.retry_delay * 2, self.min_delay), self.max_delay)
+            self.next_attempt = time.monotonic() + self.retry_delay
+            logger.warning(f"Database connection failed, retrying in {self.retry_delay:.1f}s")
+            raise
+        self.retry_delay = 0.0
+        self.next_attempt = 0.0
+        return db_connection
+
+    @staticmethod
+    def _is_healthy(db_connection: pg_connection) -> bool:
+        try:
+            with db_connection.cursor() as db_cursor:
+                db_cursor.execute("SELECT 1;")
+            db_connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _recover(self: ConnectionPool, db_connection: pg_connection) -> None:
+        # Drop broken connections, reset the transaction of healthy ones
+        if db_connection.closed:
+            self.db_connection = None
+            return
+        try:
+            db_connection.rollback()
+        except psycopg2.Error:
+            self.close()
+
+    def close_idle(self: ConnectionPool) -> None:
+        with self.lock:
+            if (self.db_connection is not None
+                    and time.monotonic() - self.last_used > self.idle_timeout):
+                logger.debug("Closing idle database connection")
+                self.close()
+
+    def close(self: ConnectionPool) -> None:
+        with self.lock:
+            if self.db_connection is not None:
+                try:
+                    self.db_connection.close()
+                except psycopg2.Error:
+                    pass
+                self.db_connection = None
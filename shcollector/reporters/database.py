@@ -1,35 +1,114 @@
 from __future__ import annotations
+from datetime import date, datetime, timezone
 from queue import Queue
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 import sys
+import time
 import logging
 from psycopg2 import DatabaseError
-from psycopg2._psycopg import connection
+from psycopg2.extras import execute_values
+from psycopg2.extensions import cursor
 import psycopg2
 from manager import Manager
+from reporters.connection import ConnectionPool
+from reporters.file import Spool
 from sensors.metrics import Types
 from sensors.measure import Measure
+from sensors.sensor import AGGREGATES, SensorDefinition
+from utils.instrumentation import registry
 import cfg
 
 logger = logging.getLogger("database")
 
+written_rows = registry.counter('shcollector_rows_written', 'Measures written to the database')
+flush_duration = registry.histogram('shcollector_flush_duration_seconds',
+                                    'Duration of measure flushes to the database')
+
+ON_CONFLICT = {
+    'nothing': " ON CONFLICT ({key}) DO NOTHING",
+    'update': " ON CONFLICT ({key}) DO UPDATE SET data=excluded.data",
+    'error': ""
+}
+
+SCHEMA_VERSIONS = (1, 2)
+
+
+def metric_names() -> List[str]:
+    # Names stored in the metric column, see Measure.metric_name
+    return [metric.name for metric in Types] + [f"{metric.name}_{aggregate.upper()}"
+                                                for metric in Types for aggregate in AGGREGATES]
+
+
+def month_start(time: datetime) -> date:
+    return time.astimezone(timezone.utc).date().replace(day=1)
+
+
+def next_month(month: date) -> date:
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
 
 class Database():
 
     def __init__(self: Database, measure_queue: Queue[Measure]):
         self.schema = cfg.config.get('Database', 'schema')
-        self.add_sensordata = (
-            "INSERT INTO " + self.schema + ".sensors_data "
+        self.schema_version = cfg.config.getint('Database', 'schema_version')
+        if self.schema_version not in SCHEMA_VERSIONS:
+            raise ValueError(f"Unknown schema version {self.schema_version}, "
+                             f"expected one of {SCHEMA_VERSIONS}")
+        on_conflict = ON_CONFLICT[cfg.config.get('Database', 'on_conflict')]
+        if self.schema_version == 1:
+            self.add_sensordata = (
+                "INSERT INTO " + self.schema + ".sensors_data "
+                " (time, idsensor, metric, data) "
+                " VALUES %s"
+                + on_conflict.format(key='time, idsensor, metric') +
+                ";")
+            self.sensordata_template = "(%(time)s, %(idsensor)s, %(metric)s, %(data)s)"
+        else:
+            # Sensors and metrics stored as smallint keys, in monthly partitions
+            self.add_sensordata = (
+                "INSERT INTO " + self.schema + ".sensors_data_v2 "
+                " (time, sensorkey, idmetric, data) "
+                " VALUES %s"
+                + on_conflict.format(key='sensorkey, idmetric, time') +
+                ";")
+            self.sensordata_template = "(%(time)s, %(sensorkey)s, %(idmetric)s, %(data)s)"
+        self.add_quarantine = (
+            "INSERT INTO " + self.schema + ".sensors_quarantine "
             " (time, idsensor, metric, data) "
-            " VALUES (%(time)s, %(idsensor)s, %(metric)s, %(data)s)"
+            " VALUES %s"
+            " ON CONFLICT (time, idsensor, metric) DO NOTHING"
             ";")
+        self.quarantine_template = "(%(time)s, %(idsensor)s, %(metric)s, %(data)s)"
+        self.batch_size = cfg.config.getint('Database', 'batch_size')
         self.add_sensor = (
-            "INSERT INTO " + self.schema + ".sensors"
+            "INSERT INTO " + self.schema + ".sensors (idsensor, name, location)"
             "  VALUES (%(database_id)s, %(name)s, %(location)s)"
             "  ON CONFLICT (idsensor) DO "
             "       UPDATE SET name=excluded.name,"
             "                  location=excluded.location"
             ";")
         self.measure_queue = measure_queue
+        self.rejected_rows: int = 0
+        # Definitions added again once the database lost them, see insert_rows
+        self.sensor_definitions: List[SensorDefinition] = []
+        self.sensors_missing: bool = False
+        # Schema v2 keys, loaded from the database
+        self.sensor_keys: Dict[str, int] = {}
+        self.metric_ids: Dict[str, int] = {}
+        # Months with a partition, none are created when sensors_data_v2 is a hypertable
+        self.partitioned: bool = True
+        self.partitions: Set[date] = set()
+        # Watermarks of the rollups, lowered when writing older measures
+        self.rollup_watermarks: List[str] = []
+        self.lower_watermarks = (
+            "UPDATE " + self.schema + ".rollup_watermarks SET time = %(time)s"
+            "  WHERE name = ANY(%(names)s) AND time > %(time)s"
+            ";")
+        self.pool: ConnectionPool = ConnectionPool()
+        self.spool: Optional[Spool] = None
+        if cfg.config.getboolean('Spool', 'enabled'):
+            self.spool = Spool()
 
     @staticmethod
     def log_psycopg2_exception(error: DatabaseError) -> None:
@@ -58,8 +137,7 @@ class Database():
     def check_structure(self: Database) -> None:
         try:
             logger.info("connecting to database to update table structure")
-            db_connection: connection = psycopg2.connect(cfg.config.postgres_dsn())
-            with db_connection.cursor() as db_cursor:
+            with self.pool.connection() as db_connection, db_connection.cursor() as db_cursor:
 
                 TABLES = {}
                 TABLES['sensors'] = (
@@ -68,10 +146,19 @@ class Database():
                     "  \"name\" text NOT NULL,"
                     "  \"location\" text"
                     ");")
-                TABLES['sensors_data'] = (
-                    "CREATE TABLE IF NOT EXISTS " + self.schema + ".sensors_data ("
-                    "  \"time\" timestamp  with time zone NOT NULL DEFAULT CURRENT_TIMESTAMP,"
-                    "  \"idsensor\" text REFERENCES " + self.schema + ".sensors,"
+                if self.schema_version == 1:
+                    TABLES['sensors_data'] = (
+                        "CREATE TABLE IF NOT EXISTS " + self.schema + ".sensors_data ("
+                        "  \"time\" timestamp  with time zone NOT NULL DEFAULT CURRENT_TIMESTAMP,"
+                        "  \"idsensor\" text REFERENCES " + self.schema + ".sensors,"
+                        "  \"metric\" text not null,"
+                        "  \"data\" real NOT NULL,"
+                        "  PRIMARY KEY (time, idsensor, metric)"
+                        ");")
+                TABLES['sensors_quarantine'] = (
+                    "CREATE TABLE IF NOT EXISTS " + self.schema + ".sensors_quarantine ("
+                    "  \"time\" timestamp  with time zone NOT NULL,"
+                    "  \"idsensor\" text,"
                     "  \"metric\" text not null,"
                     "  \"data\" real NOT NULL,"
                     "  PRIMARY KEY (time, idsensor, metric)"
@@ -80,50 +167,309 @@ class Database():
                 for name, ddl in TABLES.items():
                     logger.debug(f"Checking table {name}")
                     db_cursor.execute(ddl)
+                if self.schema_version == 2:
+                    self.check_structure_v2(db_cursor)
                 db_connection.commit()
-            db_connection.close()
         except psycopg2.DatabaseError as error:
             Database.log_psycopg2_exception(error)
 
+    def check_structure_v2(self: Database, db_cursor: cursor) -> None:
+        logger.debug("Checking schema v2 tables")
+        # Compact sensor keys, the text id stays the sensors primary key
+        db_cursor.execute(
+            "ALTER TABLE " + self.schema + ".sensors"
+            "  ADD COLUMN IF NOT EXISTS \"sensorkey\" smallint"
+            "  GENERATED BY DEFAULT AS IDENTITY UNIQUE;")
+        db_cursor.execute(
+            "CREATE TABLE IF NOT EXISTS " + self.schema + ".metrics ("
+            "  \"idmetric\" smallint GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,"
+            "  \"name\" text NOT NULL UNIQUE"
+            ");")
+        db_cursor.execute(
+            "INSERT INTO " + self.schema + ".metrics (name)"
+            "  SELECT unnest(%(names)s)"
+            "  ON CONFLICT (name) DO NOTHING;", {'names': metric_names()})
+
+        db_cursor.execute("SELECT EXISTS (SELECT FROM pg_extension WHERE extname = 'timescaledb');")
+        row = db_cursor.fetchone()
+        timescaledb = row is not None and row[0]
+        # The primary key serves the latest value of each sensor and metric
+        db_cursor.execute(
+            "CREATE TABLE IF NOT EXISTS " + self.schema + ".sensors_data_v2 ("
+            "  \"time\" timestamp with time zone NOT NULL,"
+            "  \"sensorkey\" smallint NOT NULL,"
+            "  \"idmetric\" smallint NOT NULL,"
+            "  \"data\" real NOT NULL,"
+            "  PRIMARY KEY (sensorkey, idmetric, time)"
+            ")" + ("" if timescaledb else " PARTITION BY RANGE (time)") + ";")
+        if timescaledb:
+            logger.info("TimescaleDB available, sensors_data_v2 is a hypertable")
+            db_cursor.execute(
+                "SELECT create_hypertable(%(table)s, 'time',"
+                "  chunk_time_interval => interval '1 month',"
+                "  create_default_indexes => FALSE, if_not_exists => TRUE);",
+                {'table': self.schema + ".sensors_data_v2"})
+        # Rows are appended in time order, a BRIN index is enough for time ranges
+        db_cursor.execute(
+            "CREATE INDEX IF NOT EXISTS sensors_data_v2_time_idx"
+            "  ON " + self.schema + ".sensors_data_v2 USING brin (time);")
+
     def check_sensors_definition(self: Database, manager: Manager) -> None:
+        self.sensor_definitions = [sensor.get_sensor_definition()
+                                   for sensor in manager.sensors.values()]
         try:
             logger.info("connecting to database to update sensors definition")
-            db_connection: connection = psycopg2.connect(cfg.config.postgres_dsn())
-            with db_connection.cursor() as db_cursor:
-
-                for sensor in manager.sensors.values():
-                    definition = sensor.get_sensor_definition()
-                    logger.debug(f"Checking sensor {definition.database_id}")
-                    db_cursor.execute(self.add_sensor, vars(definition))
+            with self.pool.connection() as db_connection, db_connection.cursor() as db_cursor:
+                self.add_sensor_definitions(db_cursor)
                 db_connection.commit()
-            db_connection.close()
+                if self.schema_version == 2:
+                    self.load_keys(db_cursor)
+                    db_connection.rollback()
+        except psycopg2.DatabaseError as error:
+            Database.log_psycopg2_exception(error)
+
+    def add_sensor_definitions(self: Database, db_cursor: cursor) -> None:
+        for definition in self.sensor_definitions:
+            logger.debug(f"Checking sensor {definition.database_id}")
+            db_cursor.execute(self.add_sensor, vars(definition))
+
+    def load_keys(self: Database, db_cursor: cursor) -> None:
+        db_cursor.execute("SELECT idsensor, sensorkey FROM " + self.schema + ".sensors;")
+        self.sensor_keys = dict(db_cursor.fetchall())
+        db_cursor.execute("SELECT name, idmetric FROM " + self.schema + ".metrics;")
+        self.metric_ids = dict(db_cursor.fetchall())
+        db_cursor.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = %(table)s::regclass;",
+                          {'table': self.schema + ".sensors_data_v2"})
+        row = db_cursor.fetchone()
+        self.partitioned = row is not None and row[0]
+        logger.debug(f"Loaded {len(self.sensor_keys)} sensor keys and "
+                     f"{len(self.metric_ids)} metric ids")
+
+    def ensure_partitions(self: Database, db_cursor: cursor, times: Iterable[datetime]) -> None:
+        # Monthly partitions are created as measures of a new month arrive, replays and
+        # migrations included
+        for month in sorted(set(month_start(time) for time in times) - self.partitions):
+            name = f"sensors_data_v2_{month:%Y%m}"
+            logger.info(f"Checking partition {name}")
+            db_cursor.execute(
+                "CREATE TABLE IF NOT EXISTS " + self.schema + "." + name +
+                "  PARTITION OF " + self.schema + ".sensors_data_v2"
+                "  FOR VALUES FROM (%(start)s) TO (%(end)s);",
+                {'start': datetime(month.year, month.month, 1, tzinfo=timezone.utc),
+                 'end': datetime.combine(next_month(month), datetime.min.time(), timezone.utc)})
+            self.partitions.add(month)
+
+    def load_latest_values(self: Database, manager: Manager) -> None:
+        # One index lookup per configured sensor and metric, over a bounded time range: the
+        # sensors_data primary key, led by time, is walked backwards from now, the one of
+        # sensors_data_v2 is searched by sensor and metric
+        if self.schema_version == 1:
+            query = (
+                "SELECT latest.time, pairs.idsensor, pairs.metric, latest.data"
+                "  FROM unnest(%(sensors)s::text[], %(metrics)s::text[]) AS pairs(idsensor, metric)"
+                "  JOIN LATERAL ("
+                "    SELECT d.time, d.data FROM " + self.schema + ".sensors_data d"
+                "    WHERE d.idsensor = pairs.idsensor AND d.metric = pairs.metric"
+                "      AND d.time > now() - make_interval(hours => %(hours)s)"
+                "    ORDER BY d.time DESC LIMIT 1"
+                "  ) latest ON true"
+                ";")
+        else:
+            query = (
+                "SELECT latest.time, pairs.idsensor, pairs.metric, latest.data"
+                "  FROM unnest(%(sensors)s::text[], %(metrics)s::text[]) AS pairs(idsensor, metric)"
+                "  JOIN " + self.schema + ".sensors s ON s.idsensor = pairs.idsensor"
+                "  JOIN " + self.schema + ".metrics m ON m.name = pairs.metric"
+                "  JOIN LATERAL ("
+                "    SELECT d.time, d.data FROM " + self.schema + ".sensors_data_v2 d"
+                "    WHERE d.sensorkey = s.sensorkey AND d.idmetric = m.idmetric"
+                "      AND d.time > now() - make_interval(hours => %(hours)s)"
+                "    ORDER BY d.time DESC LIMIT 1"
+                "  ) latest ON true"
+                ";")
+        pairs = [(sensor.database_id, metric.name) for sensor in manager.sensors.values()
+                 for metric in sensor.get_sensor_metric_types()]
+        parameters = {
+            'hours': cfg.config.getint('Database', 'warm_start_hours'),
+            'sensors': [idsensor for idsensor, _ in pairs],
+            'metrics': [metric for _, metric in pairs]
+        }
+        try:
+            logger.info("connecting to database to load latest values")
+            with self.pool.connection() as db_connection, db_connection.cursor() as db_cursor:
+                db_cursor.execute(query, parameters)
+                measures = [Measure(time, idsensor, Types[metric], data)
+                            for time, idsensor, metric, data in db_cursor.fetchall()]
+                db_connection.rollback()
+            manager.seed_latest_values(measures)
         except psycopg2.DatabaseError as error:
             Database.log_psycopg2_exception(error)
 
-    def write_measures(self: Database) -> None:
-        success: bool = True
+    def drain_measures(self: Database) -> List[Measure]:
+        chunk: List[Measure] = []
+        while len(chunk) < self.batch_size and not self.measure_queue.empty():
+            measure: Measure = self.measure_queue.get()
+            if measure.metric == Types.BATTERY:
+                continue
+            chunk.append(measure)
+        return chunk
+
+    def insert_measures(self: Database, db_cursor: cursor, measures: List[Measure]) -> int:
+        # Returns the number of rows inserted, quarantined ones aside
+        # A statement may not upsert the same key twice, keep the latest value
+        rows: Dict[Tuple[object, ...], Dict[str, object]] = {}
+        quarantined: Dict[Tuple[object, ...], Dict[str, object]] = {}
+        for measure in measures:
+            key = (measure.time, measure.database_id, measure.metric_name())
+            if measure.quarantined:
+                quarantined[key] = measure.sql_value()
+                continue
+            row = self.row_value(db_cursor, measure)
+            if row is not None:
+                rows[key] = row
+        logger.debug(f"Write {len(rows)} measures and {len(quarantined)} quarantined ones")
+        inserted: int = 0
+        if len(rows) > 0:
+            if self.schema_version == 2 and self.partitioned:
+                self.ensure_partitions(db_cursor, (measure.time for measure in measures))
+            values = list(rows.values())
+            # One statement per batch, so that its row count is the number of rows inserted
+            for start in range(0, len(values), self.batch_size):
+                inserted += self.insert_rows(db_cursor, self.add_sensordata,
+                                             values[start:start + self.batch_size],
+                                             self.sensordata_template)
+            if len(self.rollup_watermarks) > 0:
+                db_cursor.execute(self.lower_watermarks,
+                                  {'time': min(measure.time for measure in measures),
+                                   'names': self.rollup_watermarks})
+        if len(quarantined) > 0:
+            values = list(quarantined.values())
+            for start in range(0, len(values), self.batch_size):
+                self.insert_rows(db_cursor, self.add_quarantine,
+                                 values[start:start + self.batch_size], self.quarantine_template)
+        return inserted
+
+    def row_value(self: Database, db_cursor: cursor,
+                  measure: Measure) -> Optional[Dict[str, object]]:
+        if self.schema_version == 1:
+            return measure.sql_value()
+        if measure.database_id not in self.sensor_keys or len(self.metric_ids) == 0:
+            # Keys could not be loaded at startup, or the sensor is missing from the database
+            self.add_sensor_definitions(db_cursor)
+            self.load_keys(db_cursor)
+        sensorkey = self.sensor_keys.get(measure.database_id)
+        if sensorkey is None:
+            # As the foreign key violation of schema v1: spooled or put back, not rejected
+            self.sensors_missing = True
+            raise psycopg2.errors.ForeignKeyViolation(f"Unknown sensor {measure.database_id}")
+        idmetric = self.metric_ids.get(measure.metric_name())
+        if idmetric is None:
+            self.rejected_rows += 1
+            logger.error(f"Rejected {measure} : unknown metric")
+            return None
+        return {
+            'time': measure.time,
+            'sensorkey': sensorkey,
+            'idmetric': idmetric,
+            'data': measure.data
+        }
+
+    def insert_rows(self: Database, db_cursor: cursor, sql: str,
+                    rows: List[Dict[str, object]], template: str) -> int:
+        # Rows are inserted under a savepoint: a rejected row is isolated by splitting
+        # the batch in halves instead of aborting the whole transaction. Returns the number
+        # of rows inserted, without those rejected or skipped by the conflict clause.
+        db_cursor.execute("SAVEPOINT insert_rows;")
+        inserted: int = 0
         try:
-            # Open connection
-            logger.debug("connecting to database to write measures...")
-            db_connection: connection = psycopg2.connect(cfg.config.postgres_dsn())
-            with db_connection.cursor() as db_cursor:
-
-                while not self.measure_queue.empty():
-                    measure: Measure = self.measure_queue.get()
-                    success = False
-                    if measure.metric == Types.BATTERY:
-                        continue
-                    logger.debug(f"Write measure {measure}")
-                    db_cursor.execute(self.add_sensordata, measure.sql_value())
-                    success = True
-
-                # Make sure data is committed to the database
-                db_connection.commit()
-            db_connection.close()
+            execute_values(db_cursor,
+                           sql,
+                           rows,
+                           template=template,
+                           page_size=len(rows))
+            inserted = db_cursor.rowcount
+        except psycopg2.errors.ForeignKeyViolation:
+            # Sensors missing from the database, not bad rows: the write fails, measures are
+            # spooled or put back and the definitions are added again before the next one
+            self.sensors_missing = True
+            raise
+        except (psycopg2.IntegrityError, psycopg2.DataError) as error:
+            db_cursor.execute("ROLLBACK TO SAVEPOINT insert_rows;")
+            if len(rows) == 1:
+                self.rejected_rows += 1
+                logger.error(f"Rejected row {rows[0]} : {str(error).strip()}")
+            else:
+                middle = len(rows) // 2
+                inserted += self.insert_rows(db_cursor, sql, rows[:middle], template)
+                inserted += self.insert_rows(db_cursor, sql, rows[middle:], template)
+        db_cursor.execute("RELEASE SAVEPOINT insert_rows;")
+        return inserted
+
+    def write_measures(self: Database) -> bool:
+        # Returns False when the database could not be written to
+        if self.measure_queue.empty() and (self.spool is None or self.spool.is_empty()):
+            return True
+
+        chunk: List[Measure] = []
+        written: int = 0
+        failed: bool = False
+        start: float = time.perf_counter()
+        try:
+            logger.debug("writing measures to database...")
+            with self.pool.connection() as db_connection, db_connection.cursor() as db_cursor:
+
+                if self.sensors_missing:
+                    logger.warning("Sensors missing from the database, adding them again")
+                    self.add_sensor_definitions(db_cursor)
+                    db_connection.commit()
+                    self.sensors_missing = False
+
+                # Spooled measures are older than queued ones, replay them first
+                if self.spool is not None:
+                    def write_segment(measures: List[Measure]) -> None:
+                        nonlocal written
+                        inserted = self.insert_measures(db_cursor, measures)
+                        db_connection.commit()
+                        written += inserted
+                    self.spool.replay(write_segment)
+
+                chunk = self.drain_measures()
+                while len(chunk) > 0:
+                    inserted = self.insert_measures(db_cursor, chunk)
+                    # Commit each chunk so a failure only puts back the current one
+                    db_connection.commit()
+                    written += inserted
+                    chunk = self.drain_measures()
             logger.debug("Done writing measures !")
         except psycopg2.DatabaseError as error:
+            failed = True
             Database.log_psycopg2_exception(error)
+            # Partitions and sensor keys created by the rolled back transaction may not exist
+            self.partitions.clear()
+            self.sensor_keys.clear()
         finally:
             # Handle exception during database write
-            if success is False:
+            if failed and self.spool is not None:
+                # Move everything to disk so that a crash during the outage loses nothing
+                try:
+                    chunk.extend(self.drain_measures())
+                    while len(chunk) > 0:
+                        self.spool.append(chunk)
+                        chunk = self.drain_measures()
+                except OSError as os_error:
+                    logger.error(f"Unable to spool measures : {os_error}")
+            for measure in chunk:
                 self.measure_queue.put(measure)
+
+        if written > 0:
+            elapsed = time.perf_counter() - start
+            written_rows.inc(written)
+            flush_duration.observe(elapsed)
+            logger.info(f"Flushed {written} measures in {elapsed:.3f}s "
+                        f"({written / elapsed:.0f} rows/s)")
+        return not failed
+
+    def close(self: Database) -> None:
+        self.pool.close()
+        if self.spool is not None:
+            self.spool.close()
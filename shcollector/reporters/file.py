@@ -0,0 +1,131 @@
+from __future__ import annotations
+from typing import Callable, List, Optional, BinaryIO
+from datetime import datetime
+import json
+import os
+import time
+import logging
+from sensors.metrics import Types
+from sensors.measure import Measure
+import cfg
+
+logger = logging.getLogger("spool")
+
+
+class Spool():
+
+    SEGMENT_PREFIX = "spool-"
+    SEGMENT_SUFFIX = ".jsonl"
+
+    def __init__(self: Spool):
+        self.directory: str = cfg.config.get('Spool', 'directory')
+        self.segment_size: int = cfg.config.getint('Spool', 'segment_size_kb') * 1024
+        self.max_size: int = cfg.config.getint('Spool', 'max_size_mb') * 1024 * 1024
+        self.active: Optional[BinaryIO] = None
+        self.replayed_rows: int = 0
+        self.replay_rate: float = 0.0
+        os.makedirs(self.directory, exist_ok=True)
+        segments = self.segments()
+        self.sequence: int = self.segment_sequence(segments[-1]) if segments else 0
+        if segments:
+            logger.warning(f"Found {len(segments)} spool segments in {self.directory} to replay")
+
+    def segments(self: Spool) -> List[str]:
+        # Segment names embed a zero-padded sequence, lexical order is write order
+        return sorted(os.path.join(self.directory, name)
+                      for name in os.listdir(self.directory)
+                      if name.startswith(Spool.SEGMENT_PREFIX)
+                      and name.endswith(Spool.SEGMENT_SUFFIX))
+
+    @staticmethod
+    def segment_sequence(path: str) -> int:
+        name = os.path.basename(path)
+        return int(name[len(Spool.SEGMENT_PREFIX):-len(Spool.SEGMENT_SUFFIX)])
+
+    def is_empty(self: Spool) -> bool:
+        return len(self.segments()) == 0
+
+    def append(self: Spool, measures: List[Measure]) -> None:
+        if len(measures) == 0:
+            return
+        if self.active is None or self.active.tell() >= self.segment_size:
+            self.rotate()
+        assert self.active is not None
+        self.active.write(b"".join(Spool.serialize(measure) for measure in measures))
+        # One fsync per batch of measures
+        self.active.flush()
+        os.fsync(self.active.fileno())
+        logger.warning(f"Spooled {len(measures)} measures to {self.active.name}")
+        self.enforce_size_cap()
+
+    def rotate(self: Spool) -> None:
+        self.close()
+        self.sequence += 1
+        path = os.path.join(self.directory,
+                            f"{Spool.SEGMENT_PREFIX}{self.sequence:012d}{Spool.SEGMENT_SUFFIX}")
+        self.active = open(path, 'ab')
+
+    def enforce_size_cap(self: Spool) -> None:
+        segments = self.segments()
+        total = sum(os.path.getsize(segment) for segment in segments)
+        # Never drop the segment being written
+        for segment in segments[:-1]:
+            if total <= self.max_size:
+                break
+            total -= os.path.getsize(segment)
+            os.remove(segment)
+            logger.error(f"Spool exceeds {self.max_size} bytes, dropped {segment}")
+
+    def replay(self: Spool, write: Callable[[List[Measure]], None]) -> None:
+        # Close the active segment so that new failures go to a fresh one
+        self.close()
+        for segment in self.segments():
+            start = time.perf_counter()
+            measures = Spool.read(segment)
+            # write() raises on failure, keeping the segment for the next attempt
+            write(measures)
+            os.remove(segment)
+            elapsed = time.perf_counter() - start
+            self.replayed_rows += len(measures)
+            self.replay_rate = len(measures) / elapsed if elapsed > 0 else 0.0
+            logger.info(f"Replayed {len(measures)} spooled measures from {segment} "
+                        f"in {elapsed:.3f}s ({self.replay_rate:.0f} rows/s)")
+
+    @staticmethod
+    def read(segment: str) -> List[Measure]:
+        measures: List[Measure] = []
+        with open(segment, 'rb') as segment_file:
+            for line in segment_file:
+                try:
+                    measures.append(Spool.deserialize(line))
+                except (ValueError, KeyError):
+                    # Most likely a partial line written during a crash
+                    logger.warning(f"Skipping corrupted spool line in {segment} : {line!r}")
+        return measures
+
+    @staticmethod
+    def serialize(measure: Measure) -> bytes:
+        return json.dumps({
+            'time': measure.time.isoformat(),
+            'idsensor': measure.database_id,
+            'metric': measure.metric.name,
+            'aggregate': measure.aggregate,
+            'quarantined': measure.quarantined,
+            'data': measure.data
+        }).encode() + b"\n"
+
+    @staticmethod
+    def deserialize(line: bytes) -> Measure:
+        value = json.loads(line)
+        measure = Measure(datetime.fromisoformat(value['time']),
+                          value['idsensor'],
+                          Types[value['metric']],
+                          value['data'],
+                          value.get('aggregate'))
+        measure.quarantined = value.get('quarantined', False)
+        return measure
+
+    def close(self: Spool) -> None:
+        if self.active is not None:
+            self.active.close()
+            self.active = None
@@ -0,0 +1,251 @@
+from __future__ import annotations
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+import math
+import time
+import logging
+from psycopg2.extensions import cursor
+import psycopg2
+from reporters.connection import ConnectionPool
+from reporters.database import Database, month_start, next_month
+import cfg
+
+logger = logging.getLogger("rollup")
+
+# Name and width in seconds of each rollup, each one is computed from the previous one
+LEVELS: List[Tuple[str, int]] = [('5m', 300), ('1h', 3600), ('1d', 86400)]
+
+
+def floor_time(moment: datetime, width: int) -> datetime:
+    # Buckets are aligned on the epoch, days are UTC days
+    return datetime.fromtimestamp(math.floor(moment.timestamp() / width) * width, timezone.utc)
+
+
+def ceil_time(moment: datetime, width: int) -> datetime:
+    start = floor_time(moment, width)
+    return start if start == moment else start + timedelta(seconds=width)
+
+
+# Min, max, average and count of measures per sensor and metric over 5 minutes, an hour
+# and a day. Each rollup has a watermark before which it is up to date: the database
+# writer lowers it when writing older measures (spool replays, late receivers), and only
+# buckets from the watermark on are computed again. Raw measures older than the retention
+# are deleted once rolled up, and buckets they belonged to are not computed again.
+class Rollups():
+
+    # Buckets computed per rollup and run, so that catching up does not hold locks for long
+    MAX_BUCKETS = 2016
+
+    def __init__(self: Rollups, database: Database):
+        self.database: Database = database
+        self.schema: str = database.schema
+        if database.schema_version == 1:
+            self.raw_table: str = 'sensors_data'
+            self.keys: str = 'idsensor, metric'
+            self.key_type: str = 'text'
+        else:
+            self.raw_table = 'sensors_data_v2'
+            self.keys = 'sensorkey, idmetric'
+            self.key_type = 'smallint'
+        self.retention_days: int = cfg.config.getint('Rollup', 'raw_retention_days')
+        self.retention_batch: int = cfg.config.getint('Rollup', 'retention_batch')
+        # Aggregations are long queries, they must not hold the writer's connection
+        self.pool: ConnectionPool = ConnectionPool()
+        # Lowered by the writer along with its inserts
+        database.rollup_watermarks = [self.watermark_name(level) for level, _ in LEVELS]
+
+    def table(self: Rollups, level: str) -> str:
+        return f"{self.schema}.{self.raw_table}_{level}"
+
+    def watermark_name(self: Rollups, level: str) -> str:
+        return f"{self.raw_table}_{level}"
+
+    def check_structure(self: Rollups) -> None:
+        try:
+            logger.info("connecting to database to update rollup tables")
+            with self.pool.connection() as db_connection, db_connection.cursor() as db_cursor:
+                db_cursor.execute(
+                    "CREATE TABLE IF NOT EXISTS " + self.schema + ".rollup_watermarks ("
+                    "  \"name\" text PRIMARY KEY,"
+                    "  \"time\" timestamp with time zone"
+                    ");")
+                key_columns = "".join(f"  \"{key.strip()}\" {self.key_type} NOT NULL,"
+                                      for key in self.keys.split(','))
+                db_cursor.execute(
+                    "INSERT INTO " + self.schema + ".rollup_watermarks (name)"
+                    "  VALUES (%(name)s) ON CONFLICT (name) DO NOTHING;",
+                    {'name': self.watermark_name('retention')})
+                for level, _ in LEVELS:
+                    logger.debug(f"Checking table {self.table(level)}")
+                    db_cursor.execute(
+                        "CREATE TABLE IF NOT EXISTS " + self.table(level) + " ("
+                        "  \"time\" timestamp with time zone NOT NULL,"
+                        + key_columns +
+                        "  \"min\" real NOT NULL,"
+                        "  \"max\" real NOT NULL,"
+                        "  \"avg\" real NOT NULL,"
+                        "  \"count\" integer NOT NULL,"
+                        "  PRIMARY KEY (" + self.keys + ", time)"
+                        ");")
+                    db_cursor.execute(
+                        "INSERT INTO " + self.schema + ".rollup_watermarks (name)"
+                        "  VALUES (%(name)s) ON CONFLICT (name) DO NOTHING;",
+                        {'name': self.watermark_name(level)})
+                db_connection.commit()
+        except psycopg2.DatabaseError as error:
+            Database.log_psycopg2_exception(error)
+
+    def watermark(self: Rollups, db_cursor: cursor, level: str) -> Optional[datetime]:
+        db_cursor.execute(
+            "SELECT time FROM " + self.schema + ".rollup_watermarks WHERE name = %(name)s;",
+            {'name': self.watermark_name(level)})
+        row = db_cursor.fetchone()
+        return None if row is None else row[0]
+
+    def update(self: Rollups) -> None:
+        try:
+            with self.pool.connection() as db_connection, db_connection.cursor() as db_cursor:
+                source = self.schema + "." + self.raw_table
+                source_watermark: Optional[datetime] = datetime.now(timezone.utc)
+                for level, width in LEVELS:
+                    assert source_watermark is not None
+                    source_watermark = self.update_level(db_cursor, level, width, source,
+                                                         source_watermark)
+                    db_connection.commit()
+                    if source_watermark is None:
+                        # Nothing to roll up yet
+                        break
+                    source = self.table(level)
+        except psycopg2.DatabaseError as error:
+            Database.log_psycopg2_exception(error)
+
+    def update_level(self: Rollups, db_cursor: cursor, level: str, width: int, source: str,
+                     source_watermark: datetime) -> Optional[datetime]:
+        # Returns the watermark of the rollup, None while its source is empty
+        watermark = self.watermark(db_cursor, level)
+        start = watermark
+        if start is None:
+            # First run, from the oldest measure
+            db_cursor.execute("SELECT min(time) FROM " + source + ";")
+            row = db_cursor.fetchone()
+            start = None if row is None else row[0]
+            if start is None:
+                return None
+        start = floor_time(start, width)
+        raw = source == self.schema + "." + self.raw_table
+        retention = self.watermark(db_cursor, 'retention')
+        if raw and retention is not None:
+            # Buckets partly deleted would be overwritten with what is left of them
+            start = max(start, ceil_time(retention, width))
+        # Only complete buckets, which the previous rollup is up to date for
+        end = min(floor_time(source_watermark, width),
+                  start + timedelta(seconds=width * Rollups.MAX_BUCKETS))
+        if end <= start:
+            return start
+
+        if raw:
+            aggregates = "min(data), max(data), avg(data), count(*)"
+        else:
+            aggregates = ("min(\"min\"), max(\"max\"), sum(\"avg\" * \"count\") / sum(\"count\"),"
+                          " sum(\"count\")")
+        started = time.perf_counter()
+        db_cursor.execute(
+            "INSERT INTO " + self.table(level) +
+            "  (time, " + self.keys + ", \"min\", \"max\", \"avg\", \"count\")"
+            "  SELECT to_timestamp(floor(extract(epoch FROM time) / %(width)s) * %(width)s),"
+            "         " + self.keys + ", " + aggregates +
+            "  FROM " + source +
+            "  WHERE time >= %(start)s AND time < %(end)s"
+            "  GROUP BY 1, " + self.keys +
+            "  ON CONFLICT (" + self.keys + ", time) DO UPDATE"
+            "    SET \"min\" = excluded.min, \"max\" = excluded.max,"
+            "        \"avg\" = excluded.avg, \"count\" = excluded.count;",
+            {'width': width, 'start': start, 'end': end})
+        buckets = db_cursor.rowcount
+        # Unless the writer lowered the watermark meanwhile, then the next run starts over
+        db_cursor.execute(
+            "UPDATE " + self.schema + ".rollup_watermarks SET time = %(end)s"
+            "  WHERE name = %(name)s AND time IS NOT DISTINCT FROM %(watermark)s;",
+            {'end': end, 'name': self.watermark_name(level), 'watermark': watermark})
+        if db_cursor.rowcount == 0:
+            logger.info(f"Rollup {level} watermark moved during the update, kept")
+            end = start
+        logger.info(f"Rolled up {buckets} {level} buckets from {start} to {end} "
+                    f"in {time.perf_counter() - started:.3f}s")
+        return end
+
+    def apply_retention(self: Rollups) -> None:
+        if self.retention_days <= 0:
+            return
+        cutoff = datetime.now(timezone.utc) - timedelta(days=self.retention_days)
+        try:
+            with self.pool.connection() as db_connection, db_connection.cursor() as db_cursor:
+                # Raw measures are only deleted once rolled up
+                watermark = self.watermark(db_cursor, LEVELS[0][0])
+                db_connection.rollback()
+                if watermark is None:
+                    logger.warning("Raw measures kept until the first rollup")
+                    return
+                cutoff = min(cutoff, watermark)
+                # Published before deleting, rollups no longer compute older buckets
+                db_cursor.execute(
+                    "UPDATE " + self.schema + ".rollup_watermarks"
+                    "  SET time = greatest(time, %(cutoff)s) WHERE name = %(name)s;",
+                    {'cutoff': cutoff, 'name': self.watermark_name('retention')})
+                db_connection.commit()
+                if self.database.schema_version == 2:
+                    self.drop_partitions(db_cursor, cutoff)
+                    db_connection.commit()
+                self.delete_raw(db_connection, db_cursor, cutoff)
+        except psycopg2.DatabaseError as error:
+            Database.log_psycopg2_exception(error)
+
+    def drop_partitions(self: Rollups, db_cursor: cursor, cutoff: datetime) -> None:
+        # Whole months are dropped instead of deleted row by row
+        db_cursor.execute("SELECT EXISTS (SELECT FROM pg_extension WHERE extname = 'timescaledb');")
+        row = db_cursor.fetchone()
+        if row is not None and row[0]:
+            db_cursor.execute("SELECT drop_chunks(%(table)s, older_than => %(cutoff)s);",
+                              {'table': self.schema + "." + self.raw_table, 'cutoff': cutoff})
+            logger.info(f"Dropped {db_cursor.rowcount} chunks older than {cutoff}")
+            return
+        db_cursor.execute(
+            "SELECT child.relname FROM pg_inherits"
+            "  JOIN pg_class child ON child.oid = pg_inherits.inhrelid"
+            "  WHERE pg_inherits.inhparent = %(table)s::regclass;",
+            {'table': self.schema + "." + self.raw_table})
+        limit = month_start(cutoff)
+        for (name,) in db_cursor.fetchall():
+            try:
+                month = datetime.strptime(name[-6:], '%Y%m').date()
+            except ValueError:
+                continue
+            if next_month(month) <= limit:
+                logger.warning(f"Dropping partition {name}, older than {cutoff}")
+                db_cursor.execute("DROP TABLE " + self.schema + "." + name + ";")
+                self.database.partitions.discard(month)
+
+    def delete_raw(self: Rollups, db_connection: psycopg2.extensions.connection,
+                   db_cursor: cursor, cutoff: datetime) -> None:
+        # Small batches, each committed, not to hold locks or bloat the WAL
+        deleted = 0
+        started = time.perf_counter()
+        table = self.schema + "." + self.raw_table
+        while True:
+            db_cursor.execute(
+                "DELETE FROM " + table +
+                "  WHERE (" + self.keys + ", time) IN ("
+                "    SELECT " + self.keys + ", time FROM " + table +
+                "    WHERE time < %(cutoff)s LIMIT %(limit)s);",
+                {'cutoff': cutoff, 'limit': self.retention_batch})
+            count = db_cursor.rowcount
+            db_connection.commit()
+            deleted += count
+            if count < self.retention_batch:
+                break
+        if deleted > 0:
+            logger.info(f"Deleted {deleted} raw measures older than {cutoff} "
+                        f"in {time.perf_counter() - started:.3f}s")
+
+    def close(self: Rollups) -> None:
+        self.pool.close()
@@ -1,85 +1,228 @@
 from __future__ import annotations
-import subprocess
-import json
 import threading
 import logging
+import re
+import time
+from collections import Counter
 from datetime import datetime
-from typing import Dict, Any, List
+from functools import partial
+from typing import Callable, Dict, Any, Hashable, List, Optional, Set
 from queue import Queue
+from sources import (FileSource, ProcessSource, Recorder, RecordingSource, Source,
+                     parse_recorded_time, parse_speed)
+from utils import jsondecoder
+from utils.dedup import DuplicateFilter
 import cfg
 
 logger = logging.getLogger('sdr')
 
 
-class SignalReader(threading.Thread):
-
-    def __init__(self: SignalReader, message_queue: Queue[Dict[str, Any]]):
-        threading.Thread.__init__(self)
-        self.message_queue: Queue[Dict[str, Any]] = message_queue
-
-    def get_command_line(self: SignalReader) -> List[str]:
-        arguments = [cfg.config.get('RTL433', 'executable')]
-        arguments.extend(["-C", cfg.config.get('RTL433', 'units')])
-        arguments.extend(["-f", cfg.config.get('RTL433', 'frequency')])
-        arguments.extend(["-F", "json"])
-        arguments.extend(["-M", cfg.config.get('RTL433', 'timezone')])
-        for device in cfg.config.get('RTL433', 'devices').split(','):
-            arguments.extend(["-R", device.strip()])
-        if cfg.config.has_option('RTL433', 'other_args'):
-            other_args = cfg.config.get('RTL433', 'other_args').split(' ')
-            arguments.extend(other_args)
-        return arguments
+class MessageParser():
+
+    MODEL_FIELD = re.compile(rb'"model"\s*:\s*"([^"]*)"')
+    CHANNEL_FIELD = re.compile(rb'"channel"\s*:\s*"?([^",}]*)')
+    ID_FIELD = re.compile(rb'"id"\s*:\s*"?([^",}]*)')
+    # Fields which differ between repeats of the same frame
+    VOLATILE_FIELDS = frozenset(['time', 'rssi', 'snr', 'noise', 'freq', 'freq1', 'freq2', 'mod'])
+
+    def __init__(self: MessageParser, known_radio_ids: Optional[Set[str]] = None,
+                 duplicates: Optional[DuplicateFilter] = None,
+                 recorded_time: Optional[Callable[[str], datetime]] = None):
+        # Messages from other emitters are dropped before being decoded
+        self.known_radio_ids: Optional[Set[str]] = known_radio_ids
+        self.unknown_emitters: Counter[str] = Counter()
+        self.duplicates: Optional[DuplicateFilter] = duplicates
+        self.recorded_time: Optional[Callable[[str], datetime]] = recorded_time
+        # Throughput statistics
+        self.lines: int = 0
+        self.messages: int = 0
+        # Lines which are not JSON or lack a model
+        self.invalid: int = 0
+        self.started: float = time.monotonic()
+
+    def parse(self: MessageParser, line: bytes,
+              received: Optional[datetime] = None) -> Optional[Dict[str, Any]]:
+        self.lines += 1
+        if not line.startswith(b"{"):
+            # this is a message from RTL_433, log it
+            logger.info(line.decode(errors='replace').rstrip())
+            return None
+
+        if self.known_radio_ids is not None:
+            radio_id = MessageParser.peek_radio_id(line)
+            if radio_id is not None and radio_id not in self.known_radio_ids:
+                if radio_id not in self.unknown_emitters:
+                    logger.info(f"Discovered unknown emitter {radio_id}")
+                self.unknown_emitters[radio_id] += 1
+                return None
+
+        # This is Json data, load it
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(line.decode(errors='replace').rstrip())
+
+        try:
+            message: Dict[str, Any] = jsondecoder.loads(line)
+        except ValueError:
+            self.invalid += 1
+            logger.warning(f"Invalid JSON line : {line!r}")
+            return None
+        if not isinstance(message.get("model"), str):
+            self.invalid += 1
+            logger.warning(f"Message without model : {line!r}")
+            return None
+        model: str = MessageParser.sanitize(message["model"])
+
+        if "channel" in message:
+            message['radio_id'] = f"{model}.CH={message['channel']}"
+        elif "id" in message:
+            message['radio_id'] = f"{model}.ID={message['id']}"
+        else:
+            message['radio_id'] = model
+
+        acquisition_date = self.get_acquisition_date(message, received)
+        # Replayed repeats are detected on the recorded time line, whatever the replay speed
+        now = acquisition_date.timestamp() if self.recorded_time is not None else None
+
+        if self.duplicates is not None:
+            if not self.duplicates.accept(message['radio_id'], MessageParser.fingerprint(message),
+                                          now):
+                return None
+
+        message['acquisition_date'] = acquisition_date
+        self.messages += 1
+        return message
+
+    def get_acquisition_date(self: MessageParser, message: Dict[str, Any],
+                             received: Optional[datetime] = None) -> datetime:
+        if self.recorded_time is not None and 'time' in message:
+            try:
+                return self.recorded_time(message['time'])
+            except (TypeError, ValueError):
+                logger.warning(f"Invalid recorded time : {message['time']}")
+        # Lines read by another process are dated when they were received
+        if received is not None:
+            return received
+        return datetime.now().astimezone()
+
+    def stats(self: MessageParser) -> str:
+        elapsed = time.monotonic() - self.started
+        return (f"{self.lines} lines ({self.lines / elapsed:.1f}/s), "
+                f"{self.messages} messages ({self.messages / elapsed:.1f}/s), "
+                f"{sum(self.unknown_emitters.values())} from unknown emitters, "
+                f"{self.invalid} invalid")
 
-    def run(self: SignalReader) -> None:
-        logger.info("Starting sub process " + ' '.join(self.get_command_line()))
+    @staticmethod
+    def fingerprint(message: Dict[str, Any]) -> Hashable:
+        payload = tuple((key, value) for key, value in message.items()
+                        if key not in MessageParser.VOLATILE_FIELDS)
+        try:
+            return hash(payload)
+        except TypeError:
+            # Some decoders emit lists
+            return repr(payload)
 
-        # Launch the command as subprocess.
-        self.process = subprocess.Popen(self.get_command_line(),
-                                        bufsize=1,
-                                        shell=False,
-                                        stdout=subprocess.PIPE,
-                                        stderr=subprocess.STDOUT,
-                                        text=True)
+    @staticmethod
+    def peek_radio_id(line: bytes) -> Optional[str]:
+        # Build the radio_id from a few fields without decoding the whole line
+        model = MessageParser.MODEL_FIELD.search(line)
+        if model is None:
+            return None
+        label = MessageParser.sanitize(model.group(1).decode(errors='replace'))
+        channel = MessageParser.CHANNEL_FIELD.search(line)
+        if channel is not None:
+            return f"{label}.CH={channel.group(1).strip().decode(errors='replace')}"
+        device_id = MessageParser.ID_FIELD.search(line)
+        if device_id is not None:
+            return f"{label}.ID={device_id.group(1).strip().decode(errors='replace')}"
+        return label
 
-        if self.process.stdout is None:
-            self.close()
-            return
+    @staticmethod
+    def sanitize(text: str) -> str:
+        return text.replace(" ", "_")
 
-        for line in iter(self.process.stdout.readline, ''):
 
-            if not line.startswith("{"):
-                # this is a message from RTL_433, log it
-                logger.info(line.rstrip())
-            else:
-                # This is Json data, load it
-                logger.debug(line.rstrip())
+class SignalReader(threading.Thread):
 
-                message: Dict[str, Any] = json.loads(line)
-                label: str = SignalReader.sanitize(message["model"])
-                acquisition_date: datetime = datetime.now()
+    def __init__(self: SignalReader, section: str, message_queue: Queue[Dict[str, Any]],
+                 parser: MessageParser):
+        threading.Thread.__init__(self, name=section)
+        self.section: str = section
+        self.message_queue: Queue[Dict[str, Any]] = message_queue
+        self.parser: MessageParser = parser
+        self.source: Source = SignalReader.create_source(section)
 
-                if "channel" in message:
-                    label += ".CH=" + str(message["channel"])
-                elif "id" in message:
-                    label += ".ID=" + str(message["id"])
+    @staticmethod
+    def receiver_sections() -> List[str]:
+        # [RTL433:<name>] sections each define a receiver, [RTL433] holds their defaults
+        sections = [section for section in cfg.config.sections() if section.startswith('RTL433:')]
+        return sections if sections else ['RTL433']
 
-                message['radio_id'] = label
-                message['acquisition_date'] = acquisition_date
+    @staticmethod
+    def option(section: str, name: str) -> str:
+        return cfg.config.get(section, name, fallback=cfg.config.get('RTL433', name))
 
-                self.message_queue.put(message)
+    @staticmethod
+    def get_command_line(section: str = 'RTL433') -> List[str]:
+        arguments = [SignalReader.option(section, 'executable')]
+        arguments.extend(["-C", SignalReader.option(section, 'units')])
+        arguments.extend(["-f", SignalReader.option(section, 'frequency')])
+        arguments.extend(["-F", "json"])
+        arguments.extend(["-M", SignalReader.option(section, 'timezone')])
+        for device in SignalReader.option(section, 'devices').split(','):
+            arguments.extend(["-R", device.strip()])
+        other_args = cfg.config.get(section, 'other_args',
+                                    fallback=cfg.config.get('RTL433', 'other_args', fallback=''))
+        if len(other_args) > 0:
+            arguments.extend(other_args.split(' '))
+        return arguments
 
-            if not self.is_alive():
-                self.close()
+    @staticmethod
+    def create_source(section: str) -> Source:
+        source: Source
+        replay = SignalReader.option(section, 'replay')
+        if len(replay) > 0:
+            source = FileSource(section,
+                                replay,
+                                parse_speed(SignalReader.option(section, 'replay_speed')),
+                                SignalReader.option(section, 'timezone') == 'utc')
+        else:
+            source = ProcessSource(section, SignalReader.get_command_line(section))
+        recorder = SignalReader.create_recorder(section)
+        if recorder is not None:
+            source = RecordingSource(source, recorder)
+        return source
 
-        if self.process.poll() is not None:
-            logger.error(f'Return code from RTL_433 [{self.process.pid}]: {self.process.poll()}')
-            self.close()
+    @staticmethod
+    def create_recorder(section: str) -> Optional[Recorder]:
+        directory = SignalReader.option(section, 'record')
+        if len(directory) == 0:
+            return None
+        return Recorder(section,
+                        directory,
+                        int(float(SignalReader.option(section, 'record_rotate_mb')) * 1024 * 1024),
+                        int(SignalReader.option(section, 'record_max_files')))
 
     @staticmethod
-    def sanitize(text: str) -> str:
-        return text.replace(" ", "_")
+    def recorded_time(section: str) -> Optional[Callable[[str], datetime]]:
+        # Replayed messages are dated by their recorded timestamp
+        if len(SignalReader.option(section, 'replay')) == 0:
+            return None
+        return partial(parse_recorded_time, utc=SignalReader.option(section, 'timezone') == 'utc')
+
+    def run(self: SignalReader) -> None:
+        logger.info(f"[{self.section}] Starting reader (JSON backend : {jsondecoder.BACKEND})")
+        parse = self.parser.parse
+        put = self.message_queue.put
+        for line in self.source.lines():
+            message = parse(line)
+            if message is not None:
+                put(message)
+
+    def restart(self: SignalReader) -> SignalReader:
+        # Threads can't be restarted, start a new one keeping the statistics
+        reader = SignalReader(self.section, self.message_queue, self.parser)
+        reader.start()
+        return reader
 
     def close(self: SignalReader) -> None:
-        # Terminate subprocess
-        if hasattr(self, 'process') and self.process is not None and self.process.poll() is None:
-            self.process.terminate()
+        self.source.close()
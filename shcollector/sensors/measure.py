@@ -1,27 +1,38 @@
 from __future__ import annotations
 from sensors.metrics import Types
 from datetime import datetime
-from typing import Dict
+from typing import Dict, Optional, Tuple
 
 
 class Measure(object):
 
-    def __init__(self: Measure, time: datetime, database_id: str, metric: Types, data: float):
+    def __init__(self: Measure, time: datetime, database_id: str, metric: Types, data: float,
+                 aggregate: Optional[str] = None):
         self.time: datetime = time
         self.database_id: str = database_id
         self.metric: Types = metric
         self.data: float = data
+        # Secondary aggregate (min, max...) of the metric, None for the metric's value itself
+        self.aggregate: Optional[str] = aggregate
+        # Rejected by the outlier filter, stored apart from valid data
+        self.quarantined: bool = False
 
     def __str__(self: Measure) -> str:
-        return f"Measure taken at {self.time} by {self.database_id} of {self.metric} = {self.data}"
+        return (f"Measure taken at {self.time} by {self.database_id} "
+                f"of {self.metric_name()} = {self.data}")
+
+    def metric_name(self: Measure) -> str:
+        if self.aggregate is None:
+            return self.metric.name
+        return f"{self.metric.name}_{self.aggregate.upper()}"
 
     def sql_value(self: Measure) -> Dict[str, object]:
         return {
                 'time': self.time,
                 'idsensor': self.database_id,
-                'metric': self.metric.name,  # Here we handle enum to str conversion
+                'metric': self.metric_name(),  # Here we handle enum to str conversion
                 'data': self.data
                }
 
-    def get_cache_key(self: Measure) -> int:
-        return hash((self.database_id, self.metric))
+    def get_cache_key(self: Measure) -> Tuple[str, str]:
+        return (self.database_id, self.metric.name)
@@ -17,3 +17,11 @@ class Types(Enum):
             return 50
         else:
             return 99
+
+    def deadband(self: Types) -> float:
+        if self == Types.TEMPERATURE:
+            return 0.1
+        elif self == Types.HUMIDITY:
+            return 1
+        else:
+            return 0
@@ -0,0 +1,63 @@
+from __future__ import annotations
+from typing import Any, Callable, Dict, List, Tuple
+from sensors.metrics import Types
+import logging
+import cfg
+
+logger = logging.getLogger("registry")
+
+CONVERSIONS: Dict[str, Callable[[Any], Any]] = {
+    'float': float,
+    'int': int,
+    'bool': bool
+}
+
+
+class SensorModel():
+
+    def __init__(self: SensorModel, name: str, fields: List[Tuple[str, Types, str]]):
+        self.name: str = name
+        self.metric_types: List[Types] = [metric for _, metric, _ in fields]
+        # Extraction plan : (json field, index in the sensor's values, conversion)
+        self.plan: Tuple[Tuple[str, int, Callable[[Any], Any]], ...] = tuple(
+            (field, index, CONVERSIONS[conversion])
+            for index, (field, _, conversion) in enumerate(fields))
+
+
+BUILTIN_MODELS: List[SensorModel] = [
+    SensorModel("LaCrosse-TX29IT", [("temperature_C", Types.TEMPERATURE, 'float'),
+                                    ("battery_ok", Types.BATTERY, 'int')]),
+    SensorModel("LaCrosse-TX35", [("temperature_C", Types.TEMPERATURE, 'float'),
+                                  ("humidity", Types.HUMIDITY, 'int'),
+                                  ("battery_ok", Types.BATTERY, 'int')]),
+    SensorModel("ThermoPro-TX2C", [("temperature_C", Types.TEMPERATURE, 'float'),
+                                   ("humidity", Types.HUMIDITY, 'int'),
+                                   ("battery_ok", Types.BATTERY, 'int')])
+]
+
+
+def load_models() -> Dict[str, SensorModel]:
+    models = {model.name: model for model in BUILTIN_MODELS}
+
+    # [model:<type>] sections declare other models :
+    # fields = temperature_C:TEMPERATURE:float, humidity:HUMIDITY:int
+    for section_name in cfg.config.sections():
+        if section_name.startswith("model:"):
+            name = section_name[len("model:"):]
+            fields: List[Tuple[str, Types, str]] = []
+            for definition in cfg.config.get(section_name, 'fields').split(','):
+                parts = [part.strip() for part in definition.split(':')]
+                if len(parts) not in (2, 3):
+                    raise ValueError(f"Invalid field {definition.strip()} in {section_name}, "
+                                     f"expected json_field:METRIC[:conversion]")
+                if parts[1] not in Types.__members__:
+                    raise ValueError(f"Unknown metric {parts[1]} in {section_name}, "
+                                     f"expected one of {tuple(Types.__members__)}")
+                conversion = parts[2] if len(parts) > 2 else 'float'
+                if conversion not in CONVERSIONS:
+                    raise ValueError(f"Unknown conversion {conversion} in {section_name}, "
+                                     f"expected one of {tuple(CONVERSIONS)}")
+                fields.append((parts[0], Types[parts[1]], conversion))
+            models[name] = SensorModel(name, fields)
+            logger.debug(f"Registered sensor model : {name}")
+    return models
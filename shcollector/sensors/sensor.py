@@ -1,25 +1,103 @@
 from __future__ import annotations
-from typing_extensions import Protocol
-from typing import Dict, List, Type, Any
+from typing import Dict, List, Any, Optional, Sequence
 from sensors.metrics import Types
 from sensors.measure import Measure
+from sensors.registry import SensorModel
 from datetime import datetime
+import logging
 
+logger = logging.getLogger('sensor')
 
-class Sensor(Protocol):
+AGGREGATES = ('last', 'mean', 'min', 'max', 'count')
+
+
+class Sensor(object):
+
+    __slots__ = ('model', 'radio_id', 'database_id', 'sensor_definition',
+                 'count', 'total', 'minimum', 'maximum', 'last', 'last_date', 'invalid')
+
+    def __init__(self: Sensor, model: SensorModel, radio_id: str, database_id: str, name: str,
+                 location: str):
+        self.model: SensorModel = model
+        self.radio_id: str = radio_id
+        self.database_id: str = database_id
+        self.sensor_definition: SensorDefinition = SensorDefinition(radio_id,
+                                                                    database_id,
+                                                                    name,
+                                                                    location)
+        # Running accumulators of the current window, indexed as the model's extraction plan
+        size = len(model.plan)
+        self.count: List[int] = [0] * size
+        self.total: List[float] = [0.0] * size
+        self.minimum: List[float] = [0.0] * size
+        self.maximum: List[float] = [0.0] * size
+        self.last: List[float] = [0.0] * size
+        self.last_date: List[Optional[datetime]] = [None] * size
+        # Fields skipped as their value could not be converted
+        self.invalid: int = 0
 
     def get_sensor_definition(self: Sensor) -> SensorDefinition:
-        pass
+        return self.sensor_definition
 
-    @classmethod
-    def get_sensor_metric_types(cls: Type[Sensor]) -> List[Types]:
-        pass
+    def get_sensor_metric_types(self: Sensor) -> List[Types]:
+        return self.model.metric_types
 
     def process_incoming_message(self: Sensor, message: Dict[str, Any]) -> None:
-        pass
+        acquisition_date = message.get('acquisition_date')
+        for field, index, conversion in self.model.plan:
+            value = message.get(field)
+            if value is None:
+                continue
+            try:
+                value = conversion(value)
+            except (TypeError, ValueError):
+                # A garbled value only loses its field, other fields and sensors go on
+                self.invalid += 1
+                logger.debug(f"[{self.database_id}] Invalid {field} value : {value!r}")
+                continue
+            if self.count[index] == 0:
+                self.total[index] = value
+                self.minimum[index] = value
+                self.maximum[index] = value
+            else:
+                self.total[index] += value
+                if value < self.minimum[index]:
+                    self.minimum[index] = value
+                if value > self.maximum[index]:
+                    self.maximum[index] = value
+            self.count[index] += 1
+            self.last[index] = value
+            self.last_date[index] = acquisition_date
 
-    def get_measures(self: Sensor, timestamp: datetime) -> List[Measure]:
-        pass
+    def get_measures(self: Sensor, timestamp: datetime, primary: str = 'last',
+                     extras: Sequence[str] = ()) -> List[Measure]:
+        # The primary aggregate is published under the metric itself, followed by extras.
+        # Last values are stamped with their acquisition date, others with the window end.
+        measures: List[Measure] = []
+        for index, metric in enumerate(self.model.metric_types):
+            count = self.count[index]
+            if count == 0:
+                continue
+            values = {
+                'last': self.last[index],
+                'mean': self.total[index] / count,
+                'min': self.minimum[index],
+                'max': self.maximum[index],
+                'count': count
+            }
+            last_date = self.last_date[index] or timestamp
+            measures.append(Measure(last_date if primary == 'last' else timestamp,
+                                    self.database_id,
+                                    metric,
+                                    values[primary]))
+            for aggregate in extras:
+                measures.append(Measure(last_date if aggregate == 'last' else timestamp,
+                                        self.database_id,
+                                        metric,
+                                        values[aggregate],
+                                        aggregate))
+            self.count[index] = 0
+        return measures
 
 
 class SensorDefinition(object):
@@ -0,0 +1,215 @@
+from __future__ import annotations
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from typing import BinaryIO, Iterator, List, Optional
+import glob
+import gzip
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+import logging
+
+logger = logging.getLogger('sources')
+
+
+def parse_recorded_time(text: str, utc: bool) -> datetime:
+    # rtl_433 writes "2021-03-14 08:00:03" in UTC with -M utc, in local time otherwise
+    recorded = datetime.fromisoformat(text)
+    if recorded.tzinfo is not None:
+        return recorded
+    return recorded.replace(tzinfo=timezone.utc) if utc else recorded.astimezone()
+
+
+def parse_speed(speed: str) -> float:
+    # realtime, fast (no pacing) or a factor such as x10
+    if speed == 'realtime':
+        return 1.0
+    if speed == 'fast':
+        return 0.0
+    factor = float(speed[1:] if speed.startswith('x') else speed)
+    if factor <= 0:
+        raise ValueError(f"Invalid replay speed {speed}")
+    return factor
+
+
+# Lines of rtl_433 output, read by SignalReader
+class Source(ABC):
+
+    # Sources which can be started again once exhausted
+    restartable: bool = False
+
+    @abstractmethod
+    def lines(self: Source) -> Iterator[bytes]:
+        pass
+
+    def close(self: Source) -> None:
+        pass
+
+
+class ProcessSource(Source):
+
+    BUFFER_SIZE = 64 * 1024
+    restartable = True
+
+    def __init__(self: ProcessSource, name: str, command_line: List[str]):
+        self.name: str = name
+        self.command_line: List[str] = command_line
+        self.process: Optional[subprocess.Popen[bytes]] = None
+
+    def lines(self: ProcessSource) -> Iterator[bytes]:
+        logger.info(f"[{self.name}] Starting sub process " + ' '.join(self.command_line))
+        # Launch the command as subprocess, reading raw bytes through a large buffer
+        self.process = subprocess.Popen(self.command_line,
+                                        bufsize=ProcessSource.BUFFER_SIZE,
+                                        shell=False,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT)
+        if self.process.stdout is None:
+            return
+        yield from self.process.stdout
+
+        return_code = self.process.wait()
+        logger.error(f'[{self.name}] Return code from RTL_433 [{self.process.pid}]: '
+                     f'{return_code}')
+
+    def close(self: ProcessSource) -> None:
+        # Terminate subprocess
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+
+
+# Replays recordings (plain or gzipped, a glob or a directory of them) or stdin,
+# paced by the recorded timestamps
+class FileSource(Source):
+
+    TIME_FIELD = re.compile(rb'"time"\s*:\s*"([^"]*)"')
+
+    def __init__(self: FileSource, name: str, path: str, speed: float, utc: bool):
+        self.name: str = name
+        self.path: str = path
+        self.speed: float = speed
+        self.utc: bool = utc
+        self.closed = threading.Event()
+
+    def files(self: FileSource) -> List[str]:
+        if os.path.isdir(self.path):
+            return sorted(glob.glob(os.path.join(self.path, '*.jsonl*')))
+        return sorted(glob.glob(self.path))
+
+    @staticmethod
+    def open(path: str) -> BinaryIO:
+        if path.endswith('.gz'):
+            return gzip.open(path, 'rb')  # type: ignore
+        return open(path, 'rb')
+
+    def lines(self: FileSource) -> Iterator[bytes]:
+        if self.path == '-':
+            yield from self.pace(sys.stdin.buffer)
+            return
+        files = self.files()
+        if len(files) == 0:
+            logger.error(f"[{self.name}] No recording found at {self.path}")
+        for path in files:
+            logger.info(f"[{self.name}] Replaying {path}")
+            with FileSource.open(path) as recording:
+                try:
+                    yield from self.pace(recording)
+                except EOFError:
+                    logger.warning(f"[{self.name}] Truncated recording {path}")
+            if self.closed.is_set():
+                return
+        logger.warning(f"[{self.name}] Replay done")
+
+    def pace(self: FileSource, recording: BinaryIO) -> Iterator[bytes]:
+        # Recorded time and wall clock time of the first timestamped line
+        origin: Optional[float] = None
+        started: float = 0.0
+        for line in recording:
+            if self.closed.is_set():
+                return
+            if self.speed > 0:
+                recorded = self.recorded_timestamp(line)
+                if recorded is not None:
+                    if origin is None:
+                        origin, started = recorded, time.monotonic()
+                    delay = started + (recorded - origin) / self.speed - time.monotonic()
+                    if delay > 0 and self.closed.wait(delay):
+                        return
+            yield line
+
+    def recorded_timestamp(self: FileSource, line: bytes) -> Optional[float]:
+        match = FileSource.TIME_FIELD.search(line)
+        if match is None:
+            return None
+        try:
+            return parse_recorded_time(match.group(1).decode(), self.utc).timestamp()
+        except ValueError:
+            return None
+
+    def close(self: FileSource) -> None:
+        self.closed.set()
+
+
+# Tees the raw JSON lines to gzipped files, rotated by size
+class Recorder():
+
+    def __init__(self: Recorder, name: str, directory: str, rotate_size: int, max_files: int):
+        # Receiver sections are named RTL433:<name>
+        self.prefix: str = f"{name.replace(':', '-').lower()}-"
+        self.directory: str = directory
+        self.rotate_size: int = rotate_size
+        self.max_files: int = max_files
+        self.active: Optional[BinaryIO] = None
+        self.written: int = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def write(self: Recorder, line: bytes) -> None:
+        if not line.startswith(b"{"):
+            return
+        if self.active is None or self.written >= self.rotate_size:
+            self.rotate()
+        assert self.active is not None
+        self.active.write(line)
+        self.written += len(line)
+
+    def rotate(self: Recorder) -> None:
+        self.close()
+        path = os.path.join(self.directory,
+                            f"{self.prefix}{datetime.now():%Y%m%d-%H%M%S-%f}.jsonl.gz")
+        self.active = gzip.open(path, 'wb')  # type: ignore
+        self.written = 0
+        logger.info(f"Recording to {path}")
+        if self.max_files == 0:
+            return
+        recordings = sorted(glob.glob(os.path.join(self.directory, f"{self.prefix}*.jsonl.gz")))
+        for recording in recordings[:max(0, len(recordings) - self.max_files)]:
+            os.remove(recording)
+            logger.info(f"Removed old recording {recording}")
+
+    def close(self: Recorder) -> None:
+        if self.active is not None:
+            self.active.close()
+            self.active = None
+
+
+class RecordingSource(Source):
+
+    def __init__(self: RecordingSource, source: Source, recorder: Recorder):
+        self.source: Source = source
+        self.recorder: Recorder = recorder
+        self.restartable = source.restartable
+
+    def lines(self: RecordingSource) -> Iterator[bytes]:
+        write = self.recorder.write
+        try:
+            for line in self.source.lines():
+                write(line)
+                yield line
+        finally:
+            self.recorder.close()
+
+    def close(self: RecordingSource) -> None:
+        self.source.close()
@@ -0,0 +1,81 @@
+from __future__ import annotations
+from queue import Empty, Queue
+from typing import Any, Dict
+import threading
+import time
+import logging
+from manager import Manager
+from reporters.database import Database
+
+logger = logging.getLogger('streaming')
+
+
+# Event-driven alternative to the process and store cron jobs: messages are dispatched and
+# published as they arrive, measures are written once flush_size are waiting or the oldest
+# waited flush_latency seconds, whichever comes first.
+class StreamingPipeline():
+
+    def __init__(self: StreamingPipeline, manager: Manager, database: Database,
+                 message_queue: Queue[Dict[str, Any]], flush_size: int, flush_latency: float):
+        self.manager: Manager = manager
+        self.database: Database = database
+        self.message_queue: Queue[Dict[str, Any]] = message_queue
+        self.flush_size: int = flush_size
+        self.flush_latency: float = flush_latency
+        self.published = threading.Condition()
+        self.stopped = threading.Event()
+        self.consumer = threading.Thread(target=self.consume, name="consumer")
+        self.writer = threading.Thread(target=self.write, name="writer")
+
+    def start(self: StreamingPipeline) -> None:
+        self.consumer.start()
+        self.writer.start()
+
+    def consume(self: StreamingPipeline) -> None:
+        get = self.message_queue.get
+        while not self.stopped.is_set():
+            try:
+                message = get(timeout=0.5)
+            except Empty:
+                continue
+            try:
+                sensor = self.manager.dispatch_message(message)
+                if sensor is None:
+                    continue
+                self.manager.publish_sensor_measures(sensor, message['acquisition_date'])
+            except Exception:
+                logger.exception(f"Unable to process message {message}")
+                continue
+            with self.published:
+                self.published.notify()
+
+    def pending(self: StreamingPipeline) -> int:
+        return self.database.measure_queue.qsize()
+
+    def write(self: StreamingPipeline) -> None:
+        while not self.stopped.is_set():
+            with self.published:
+                # Wait for a first measure, then for the size or latency trigger
+                while not self.stopped.is_set() and self.pending() == 0:
+                    self.published.wait()
+                deadline = time.monotonic() + self.flush_latency
+                while not self.stopped.is_set() and self.pending() < self.flush_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.published.wait(remaining)
+            if self.stopped.is_set():
+                break
+            if not self.database.write_measures():
+                # Measures were spooled or put back, do not retry before the next window
+                self.stopped.wait(self.flush_latency)
+
+    def close(self: StreamingPipeline) -> None:
+        self.stopped.set()
+        with self.published:
+            self.published.notify_all()
+        for thread in (self.consumer, self.writer):
+            if thread.is_alive():
+                thread.join()
+        # Measures published since the last flush
+        self.database.write_measures()
@@ -1,40 +1,106 @@
 from __future__ import annotations
-from typing import Callable, List, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Dict, Any, Optional
 from croniter import croniter
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
 import sched
+import threading
 import time
 import logging
+from utils.instrumentation import registry
 
 logger = logging.getLogger('cron')
 timezone = pytz.timezone('Europe/Paris')
 
+MISSED_POLICIES = ('skip', 'coalesce')
 
+
+# Run dates follow the wall clock (cron expressions) but waits use the monotonic clock, so
+# that clock jumps cannot stall the scheduler. Runs later than misfire_grace seconds (after
+# a suspend or a stall) are either skipped or coalesced into a single run, and the next
+# run is always the next future slot.
 class CronScheduler():
 
-    def __init__(self: CronScheduler):
-        self.scheduler = sched.scheduler(time.time, time.sleep)
+    def __init__(self: CronScheduler, workers: int = 0, missed: str = 'coalesce',
+                 misfire_grace: float = 1.0):
+        if missed not in MISSED_POLICIES:
+            raise ValueError(f"Unknown missed runs policy {missed}, expected {MISSED_POLICIES}")
+        self.clock: Callable[[], float] = time.monotonic
+        self.wakeup = threading.Event()
+        self.scheduler = sched.scheduler(self.clock, self.wait)
         self.jobs: List[Job] = []
         self.started: bool = False
+        self.missed: str = missed
+        self.misfire_grace: float = misfire_grace
+        # Without workers, jobs run inline on the scheduler thread
+        self.executor: Optional[ThreadPoolExecutor] = None
+        if workers > 0:
+            self.executor = ThreadPoolExecutor(workers, thread_name_prefix='job')
+        # Reentrant, a signal handler may cancel while the main thread holds it
+        self.lock = threading.RLock()
+        self.cancelled: bool = False
+
+    def wait(self: CronScheduler, delay: float) -> None:
+        # Interrupted by cancel()
+        if self.wakeup.wait(delay):
+            self.wakeup.clear()
 
     def schedule(self: CronScheduler, job: Job) -> None:
         self.jobs.append(job)
         if self.started:
             self._run(job)
+            self.wakeup.set()
 
     def _run(self: CronScheduler, job: Job) -> None:
-        run_date = job.cron.get_next(datetime)
-        while run_date <= timezone.localize(datetime.now()):
-            run_date = job.cron.get_next(datetime)
-            logger.debug("Oops too late")
-        runtime = run_date.timestamp()
+        now = timezone.localize(datetime.now())
+        run_date = job.next_run(now)
+        delay = max(0.0, (run_date - now).total_seconds())
         logger.debug(f"Scheduling {job.name} run at {str(run_date)}")
+        self.scheduler.enterabs(self.clock() + delay, job.priority, self._fire,
+                                argument=(job, run_date))
+
+    def _fire(self: CronScheduler, job: Job, run_date: datetime) -> None:
+        with self.lock:
+            # Cancelled from another thread while this run was due
+            if self.cancelled:
+                return
+            if self.started:
+                self._run(job)
+        lateness = (timezone.localize(datetime.now()) - run_date).total_seconds()
+        job.lateness.observe(max(0.0, lateness))
+        if lateness > self.misfire_grace:
+            if self.missed == 'skip':
+                job.missed.inc()
+                logger.warning(f"Skipping {job.name} run of {str(run_date)}, "
+                               f"{lateness:.1f}s late")
+                return
+            logger.warning(f"Running {job.name} run of {str(run_date)} {lateness:.1f}s late")
+
         kwargs = job.args.copy()
         if job.inject_run_date:
             kwargs['run_date'] = run_date
-        self.scheduler.enterabs(runtime, job.priority, job.call, kwargs=kwargs)
-        self.scheduler.enterabs(runtime, 1000 + job.priority, self._run, argument=(job,))
+        with self.lock:
+            # Never run a job twice at once, a run still going on skips the next one
+            if job.running:
+                job.overlapped.inc()
+                logger.warning(f"Skipping {job.name} run of {str(run_date)}, "
+                               f"previous run still in progress")
+                return
+            job.running = True
+            if self.executor is not None:
+                # Submitted under the lock, cancel() shuts the executor down after it
+                self.executor.submit(self.execute, job, kwargs)
+                return
+        self.execute(job, kwargs)
+
+    def execute(self: CronScheduler, job: Job, kwargs: Dict[str, Any]) -> None:
+        try:
+            job.execute(**kwargs)
+        except Exception:
+            logger.exception(f"Job {job.name} failed")
+        finally:
+            job.running = False
 
     def start(self: CronScheduler) -> None:
         logger.debug("Starting scheduler")
@@ -44,22 +110,65 @@ class CronScheduler():
             self._run(job)
         self.scheduler.run()
 
-    def cancel(self: CronScheduler) -> None:
-        self.started = False
-        # Cancel all futur events
-        for event in self.scheduler.queue:
-            logger.debug(f"Canceling {event}")
-            self.scheduler.cancel(event)
+    def cancel(self: CronScheduler, wait: bool = False) -> None:
+        with self.lock:
+            self.started = False
+            self.cancelled = True
+            # Cancel all futur events
+            for event in self.scheduler.queue:
+                logger.debug(f"Canceling {event}")
+                try:
+                    self.scheduler.cancel(event)
+                except ValueError:
+                    # Already run meanwhile
+                    pass
+        self.wakeup.set()
+        if self.executor is not None:
+            # Runs in progress complete, the interpreter waits for them on exit
+            # unless waited for here
+            self.executor.shutdown(wait=wait, cancel_futures=True)
 
 
 class Job():
 
+    EARLY_TOLERANCE = timedelta(seconds=1)
+
     def __init__(self: Job, name: str, expression: str, priority: int,
-                 call: Callable[..., None], args: Dict[str, Any], inject_run_date: bool):
+                 call: Callable[..., object], args: Dict[str, Any], inject_run_date: bool):
         self.name = name
         self.expression = expression
         self.priority = priority
         self.call = call
         self.args = args
         self.inject_run_date = inject_run_date
-        self.cron = croniter(expression, timezone.localize(datetime.now()))
+        self.last_run_date: Optional[datetime] = None
+        self.running: bool = False
+        labels = {'job': name}
+        self.duration = registry.histogram('shcollector_job_duration_seconds',
+                                           'Runtime of scheduled jobs', labels)
+        self.lateness = registry.histogram('shcollector_job_lateness_seconds',
+                                           'Delay between the planned and actual start of jobs',
+                                           labels)
+        self.missed = registry.counter('shcollector_job_missed',
+                                       'Runs skipped for being too late', labels)
+        self.overlapped = registry.counter('shcollector_job_overlapped',
+                                           'Runs skipped as the previous one was still running',
+                                           labels)
+
+    def next_run(self: Job, now: datetime) -> datetime:
+        # Next future slot, jumping over any missed one. A run fired slightly early
+        # does not plan its own slot again.
+        start = now
+        if (self.last_run_date is not None
+                and timedelta(0) < self.last_run_date - now < Job.EARLY_TOLERANCE):
+            start = self.last_run_date
+        run_date: datetime = croniter(self.expression, start).get_next(datetime)
+        self.last_run_date = run_date
+        return run_date
+
+    def execute(self: Job, **kwargs: Any) -> None:
+        start = time.perf_counter()
+        try:
+            self.call(**kwargs)
+        finally:
+            self.duration.observe(time.perf_counter() - start)
@@ -0,0 +1,40 @@
+from __future__ import annotations
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional, Tuple
+import threading
+import time
+
+
+class DuplicateFilter():
+
+    def __init__(self: DuplicateFilter, window: float, max_entries: int,
+                 clock: Callable[[], float] = time.monotonic):
+        self.window: float = window
+        self.max_entries: int = max_entries
+        self.clock: Callable[[], float] = clock
+        # Insertion ordered, hence also ordered by first sighting time
+        self.entries: OrderedDict[Tuple[str, Hashable], float] = OrderedDict()
+        self.suppressed: int = 0
+        self.lock = threading.Lock()
+
+    def accept(self: DuplicateFilter, radio_id: str, fingerprint: Hashable,
+               now: Optional[float] = None) -> bool:
+        if now is None:
+            now = self.clock()
+        key = (radio_id, fingerprint)
+        with self.lock:
+            self.expire(now)
+            if key in self.entries:
+                self.suppressed += 1
+                return False
+            self.entries[key] = now
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return True
+
+    def expire(self: DuplicateFilter, now: float) -> None:
+        while self.entries:
+            first_seen = next(iter(self.entries.values()))
+            if now - first_seen <= self.window:
+                break
+            self.entries.popitem(last=False)
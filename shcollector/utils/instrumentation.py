@@ -0,0 +1,232 @@
+from __future__ import annotations
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+import threading
+import logging
+
+logger = logging.getLogger('metrics')
+
+Labels = Dict[str, str]
+Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+# Type, description and samples of each metric, as collected in another process
+Snapshot = Dict[Key, Tuple[str, str, List[str]]]
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0)
+
+
+def format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels.items())
+    if extra is not None:
+        items.append(extra)
+    if len(items) == 0:
+        return ""
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in items)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(items, escaped)) + "}"
+
+
+# Metrics are plain attribute updates on the hot paths, all formatting happens on scrape
+class Counter():
+
+    TYPE = "counter"
+
+    def __init__(self: Counter, name: str, labels: Labels):
+        self.name: str = name
+        self.labels: Labels = labels
+        self.value: float = 0
+
+    def inc(self: Counter, amount: float = 1) -> None:
+        self.value += amount
+
+    def samples(self: Counter) -> List[str]:
+        return [f"{self.name}_total{format_labels(self.labels)} {self.value}"]
+
+
+class Gauge():
+
+    TYPE = "gauge"
+
+    def __init__(self: Gauge, name: str, labels: Labels):
+        self.name: str = name
+        self.labels: Labels = labels
+        self.value: float = 0
+
+    def set(self: Gauge, value: float) -> None:
+        self.value = value
+
+    def samples(self: Gauge) -> List[str]:
+        return [f"{self.name}{format_labels(self.labels)} {self.value}"]
+
+
+class Histogram():
+
+    TYPE = "histogram"
+
+    def __init__(self: Histogram, name: str, labels: Labels, buckets: Sequence[float]):
+        self.name: str = name
+        self.labels: Labels = labels
+        self.buckets: Tuple[float, ...] = tuple(sorted(buckets))
+        # One more slot for +Inf
+        self.counts: List[int] = [0] * (len(self.buckets) + 1)
+        self.count: int = 0
+        self.sum: float = 0.0
+
+    def observe(self: Histogram, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def samples(self: Histogram) -> List[str]:
+        samples: List[str] = []
+        cumulated = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulated += count
+            le = "+Inf" if bound == float('inf') else repr(bound)
+            samples.append(f"{self.name}_bucket{format_labels(self.labels, ('le', le))} "
+                           f"{cumulated}")
+        samples.append(f"{self.name}_count{format_labels(self.labels)} {self.count}")
+        samples.append(f"{self.name}_sum{format_labels(self.labels)} {self.sum}")
+        return samples
+
+
+# Values owned by other objects (queue sizes, parser statistics) are only read on scrape
+class Callback():
+
+    def __init__(self: Callback, name: str, labels: Labels, kind: str,
+                 function: Callable[[], float]):
+        self.name: str = name
+        self.labels: Labels = labels
+        self.TYPE: str = kind
+        self.function: Callable[[], float] = function
+
+    def samples(self: Callback) -> List[str]:
+        suffix = "_total" if self.TYPE == "counter" else ""
+        return [f"{self.name}{suffix}{format_labels(self.labels)} {self.function()}"]
+
+
+# Samples collected in another process, see Registry.merge
+class Samples():
+
+    def __init__(self: Samples, name: str, labels: Labels, kind: str, lines: List[str]):
+        self.name: str = name
+        self.labels: Labels = labels
+        self.TYPE: str = kind
+        self.lines: List[str] = lines
+
+    def samples(self: Samples) -> List[str]:
+        return self.lines
+
+
+class Registry():
+
+    def __init__(self: Registry):
+        self.metrics: Dict[Key, Any] = {}
+        self.descriptions: Dict[str, str] = {}
+        self.lock = threading.Lock()
+
+    def register(self: Registry, metric: Any, description: str) -> Any:
+        key = (metric.name, tuple(sorted(metric.labels.items())))
+        with self.lock:
+            # Registering twice returns the existing metric
+            if key not in self.metrics:
+                self.metrics[key] = metric
+                self.descriptions[metric.name] = description
+            return self.metrics[key]
+
+    def counter(self: Registry, name: str, description: str,
+                labels: Optional[Labels] = None) -> Counter:
+        counter: Counter = self.register(Counter(name, labels or {}), description)
+        return counter
+
+    def gauge(self: Registry, name: str, description: str,
+              labels: Optional[Labels] = None) -> Gauge:
+        gauge: Gauge = self.register(Gauge(name, labels or {}), description)
+        return gauge
+
+    def histogram(self: Registry, name: str, description: str, labels: Optional[Labels] = None,
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        histogram: Histogram = self.register(Histogram(name, labels or {}, buckets), description)
+        return histogram
+
+    def callback(self: Registry, name: str, description: str, kind: str,
+                 function: Callable[[], float], labels: Optional[Labels] = None) -> None:
+        # Callbacks replace the previous one, e.g. when a reader is restarted
+        metric = Callback(name, labels or {}, kind, function)
+        with self.lock:
+            self.metrics[(name, tuple(sorted(metric.labels.items())))] = metric
+            self.descriptions[name] = description
+
+    def snapshot(self: Registry) -> Snapshot:
+        with self.lock:
+            metrics = list(self.metrics.items())
+        snapshot: Snapshot = {}
+        for key, metric in metrics:
+            try:
+                snapshot[key] = (metric.TYPE, self.descriptions[metric.name], metric.samples())
+            except Exception:
+                logger.exception(f"Unable to collect {metric.name}")
+        return snapshot
+
+    def merge(self: Registry, snapshot: Snapshot) -> None:
+        # Metrics of another process replace the local ones, which it owns
+        with self.lock:
+            for (name, labels), (kind, description, lines) in snapshot.items():
+                self.metrics[(name, labels)] = Samples(name, dict(labels), kind, lines)
+                self.descriptions[name] = description
+
+    def render(self: Registry) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        families: Dict[str, List[Any]] = {}
+        for metric in metrics:
+            families.setdefault(metric.name, []).append(metric)
+
+        lines: List[str] = []
+        for name, family in sorted(families.items()):
+            lines.append(f"# TYPE {name} {family[0].TYPE}")
+            lines.append(f"# HELP {name} {self.descriptions[name]}")
+            for metric in family:
+                try:
+                    lines.extend(metric.samples())
+                except Exception:
+                    logger.exception(f"Unable to collect {name}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+registry: Registry = Registry()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self: MetricsHandler) -> None:
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self: MetricsHandler, format: str, *args: Any) -> None:
+        logger.debug(format % args)
+
+
+class MetricsServer(threading.Thread):
+
+    def __init__(self: MetricsServer, address: str, port: int):
+        threading.Thread.__init__(self, name="metrics", daemon=True)
+        self.server = ThreadingHTTPServer((address, port), MetricsHandler)
+
+    def run(self: MetricsServer) -> None:
+        address, port = self.server.server_address[:2]
+        logger.info(f"Serving metrics on http://{address!s}:{port}/metrics")
+        self.server.serve_forever()
+
+    def close(self: MetricsServer) -> None:
+        self.server.shutdown()
+        self.server.server_close()
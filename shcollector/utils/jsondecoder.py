@@ -0,0 +1,22 @@
+from __future__ import annotations
+from typing import Any, Callable
+import json
+
+# Use the fastest JSON backend available, all of them raise ValueError on invalid input
+loads: Callable[[bytes], Any]
+try:
+    import orjson
+    loads = orjson.loads
+    BACKEND = "orjson"
+except ImportError:
+    try:
+        import simdjson  # type: ignore
+        loads = simdjson.loads
+        BACKEND = "simdjson"
+    except ImportError:
+        # Reusing one decoder skips json.loads' argument handling and encoding detection
+        _decoder = json.JSONDecoder()
+
+        def loads(data: bytes) -> Any:
+            return _decoder.decode(data.decode())
+        BACKEND = "json"
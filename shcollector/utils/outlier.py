@@ -0,0 +1,58 @@
+from __future__ import annotations
+from collections import deque
+from statistics import median
+from typing import Deque, Iterable
+
+# Scales the median absolute deviation to a standard deviation for normal data
+MAD_SCALE = 1.4826
+
+
+class RollingOutlierFilter():
+
+    def __init__(self: RollingOutlierFilter, window: int, k: float, min_deviation: float,
+                 threshold: float, recovery: int):
+        RollingOutlierFilter.check(window, recovery)
+        self.k: float = k
+        self.min_deviation: float = min_deviation
+        self.threshold: float = threshold
+        self.min_samples: int = max(3, window // 3)
+        self.accepted: Deque[float] = deque(maxlen=window)
+        # Consecutive rejected values, a stable run of them is a genuine step change
+        self.rejected: Deque[float] = deque(maxlen=recovery)
+
+    @staticmethod
+    def check(window: int, recovery: int) -> None:
+        # Statistics need three accepted values, and a step change at least one rejected value
+        if window < 3:
+            raise ValueError(f"Outlier window {window} too small, expected at least 3")
+        if recovery < 1:
+            raise ValueError(f"Outlier recovery {recovery} too small, expected at least 1")
+
+    def seed(self: RollingOutlierFilter, values: Iterable[float]) -> None:
+        self.accepted.extend(values)
+
+    def accept(self: RollingOutlierFilter, value: float) -> bool:
+        if self.is_coherent(value):
+            self.accepted.append(value)
+            self.rejected.clear()
+            return True
+
+        self.rejected.append(value)
+        if len(self.rejected) == self.rejected.maxlen and self.is_stable(self.rejected):
+            # Restart from the new level instead of rejecting it forever
+            self.accepted.clear()
+            self.accepted.extend(self.rejected)
+            self.rejected.clear()
+            return True
+        return False
+
+    def is_coherent(self: RollingOutlierFilter, value: float) -> bool:
+        if len(self.accepted) < self.min_samples:
+            # Not enough history for statistics, compare with the latest value
+            return len(self.accepted) == 0 or abs(value - self.accepted[-1]) <= self.threshold
+        center = median(self.accepted)
+        deviation = median(abs(accepted - center) for accepted in self.accepted)
+        return abs(value - center) <= max(self.k * MAD_SCALE * deviation, self.min_deviation)
+
+    def is_stable(self: RollingOutlierFilter, values: Deque[float]) -> bool:
+        return max(values) - min(values) <= self.min_deviation
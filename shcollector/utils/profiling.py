@@ -0,0 +1,106 @@
+from __future__ import annotations
+from collections import Counter
+from datetime import datetime
+from types import FrameType
+from typing import List, Optional
+import os
+import sys
+import threading
+import tracemalloc
+import logging
+
+logger = logging.getLogger('profiling')
+
+
+def output_path(directory: str, kind: str, extension: str) -> str:
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"{kind}-{datetime.now():%Y%m%d-%H%M%S}.{extension}")
+
+
+# Samples the stacks of every thread from a background thread, nothing runs until started.
+# Stacks are written in the collapsed format understood by flamegraph.pl and speedscope.
+class SamplingProfiler():
+
+    def __init__(self: SamplingProfiler, directory: str, interval: float):
+        self.directory: str = directory
+        self.interval: float = interval
+        self.stacks: Counter[str] = Counter()
+        self.samples: int = 0
+        self.thread: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+
+    def running(self: SamplingProfiler) -> bool:
+        return self.thread is not None
+
+    def toggle(self: SamplingProfiler) -> Optional[str]:
+        if self.running():
+            return self.stop()
+        self.start()
+        return None
+
+    def start(self: SamplingProfiler) -> None:
+        self.stacks.clear()
+        self.samples = 0
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.sample, name="profiler", daemon=True)
+        self.thread.start()
+        logger.warning(f"Profiling started, sampling every {self.interval * 1000:.0f}ms")
+
+    def stop(self: SamplingProfiler) -> str:
+        assert self.thread is not None
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        path = output_path(self.directory, "profile", "collapsed")
+        with open(path, 'w') as profile_file:
+            for stack, count in self.stacks.most_common():
+                profile_file.write(f"{stack} {count}\n")
+        logger.warning(f"Profiling stopped, {self.samples} samples written to {path}")
+        return path
+
+    def sample(self: SamplingProfiler) -> None:
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = SamplingProfiler.collapse(frame)
+                self.stacks[f"{names.get(thread_id, thread_id)};{stack}"] += 1
+            self.samples += 1
+
+    @staticmethod
+    def collapse(frame: Optional[FrameType]) -> str:
+        functions: List[str] = []
+        while frame is not None:
+            code = frame.f_code
+            functions.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:"
+                             f"{frame.f_lineno})")
+            frame = frame.f_back
+        return ";".join(reversed(functions))
+
+
+# Memory allocations are only traced between two calls, tracing is off otherwise
+class MemoryTracer():
+
+    def __init__(self: MemoryTracer, directory: str, top: int):
+        self.directory: str = directory
+        self.top: int = top
+
+    def toggle(self: MemoryTracer) -> Optional[str]:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            logger.warning("Memory tracing started, signal again to dump a snapshot")
+            return None
+
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        path = output_path(self.directory, "memory", "txt")
+        with open(path, 'w') as memory_file:
+            memory_file.write(f"Traced memory: {current} bytes, peak {peak} bytes\n")
+            for statistic in snapshot.statistics('traceback')[:self.top]:
+                memory_file.write(f"\n{statistic}\n")
+                memory_file.writelines(f"    {line}\n" for line in statistic.traceback.format())
+        logger.warning(f"Memory tracing stopped, snapshot written to {path}")
+        return path
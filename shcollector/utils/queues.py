@@ -0,0 +1,116 @@
+from __future__ import annotations
+from collections import OrderedDict
+from queue import Queue
+from typing import Callable, Dict, Generic, Hashable, Optional, TypeVar
+import logging
+
+logger = logging.getLogger('queues')
+
+T = TypeVar('T')
+
+POLICIES = ('block', 'drop_oldest', 'drop_newest', 'coalesce')
+
+
+# Queue holding at most capacity items (0 for no limit). When full, producers either block,
+# drop the oldest or the newest item, or replace the queued item with the same key.
+class BoundedQueue(Queue[T], Generic[T]):
+
+    def __init__(self: BoundedQueue[T], name: str, capacity: int, policy: str,
+                 high_water: float = 0.8):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown queue policy {policy}, expected one of {POLICIES}")
+        self.name: str = name
+        self.capacity: int = capacity
+        self.policy: str = policy
+        self.dropped: int = 0
+        self.max_depth: int = 0
+        # Warned once above the high-water mark, again after falling below half of it
+        self.high_water: int = int(capacity * high_water)
+        self.overloaded: bool = False
+        Queue.__init__(self, capacity if policy == 'block' else 0)
+
+    def put(self: BoundedQueue[T], item: T, block: bool = True,
+            timeout: Optional[float] = None) -> None:
+        if self.policy == 'block' or self.capacity <= 0:
+            Queue.put(self, item, block, timeout)
+        else:
+            with self.mutex:
+                if self._qsize() >= self.capacity:
+                    self.dropped += 1
+                    if not self.overflow(item):
+                        return
+                else:
+                    self.unfinished_tasks += 1
+                    self._put(item)
+                self.not_empty.notify()
+        self.check_depth()
+
+    def overflow(self: BoundedQueue[T], item: T) -> bool:
+        # Called under the mutex with a full queue, returns whether the item was queued
+        if self.policy == 'drop_newest':
+            return False
+        self._get()
+        self._put(item)
+        return True
+
+    def check_depth(self: BoundedQueue[T]) -> None:
+        depth = self.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+        if self.capacity <= 0:
+            return
+        if not self.overloaded and depth >= self.high_water:
+            self.overloaded = True
+            logger.warning(f"Queue {self.name} above its high-water mark : {depth} of "
+                           f"{self.capacity} items, {self.dropped} dropped so far "
+                           f"({self.policy})")
+        elif self.overloaded and depth < self.high_water // 2:
+            self.overloaded = False
+            logger.info(f"Queue {self.name} back to {depth} items, {self.dropped} dropped")
+
+
+# Keeps insertion order, an item replaces the queued one with the same key once full
+class CoalescingQueue(BoundedQueue[T]):
+
+    def __init__(self: CoalescingQueue[T], name: str, capacity: int,
+                 key: Callable[[T], Hashable], high_water: float = 0.8):
+        self.key: Callable[[T], Hashable] = key
+        BoundedQueue.__init__(self, name, capacity, 'coalesce', high_water)
+
+    def _init(self: CoalescingQueue[T], maxsize: int) -> None:
+        self.items: OrderedDict[int, T] = OrderedDict()
+        # Position of the newest queued item of each key
+        self.latest: Dict[Hashable, int] = {}
+        self.sequence: int = 0
+
+    def _qsize(self: CoalescingQueue[T]) -> int:
+        return len(self.items)
+
+    def _put(self: CoalescingQueue[T], item: T) -> None:
+        self.sequence += 1
+        self.items[self.sequence] = item
+        self.latest[self.key(item)] = self.sequence
+
+    def _get(self: CoalescingQueue[T]) -> T:
+        sequence, item = self.items.popitem(last=False)
+        key = self.key(item)
+        if self.latest.get(key) == sequence:
+            del self.latest[key]
+        return item
+
+    def overflow(self: CoalescingQueue[T], item: T) -> bool:
+        sequence = self.latest.get(self.key(item))
+        if sequence is not None:
+            # Replaced in place, the queue keeps its order
+            self.items[sequence] = item
+        else:
+            self._get()
+            self._put(item)
+        return True
+
+
+def create_queue(name: str, capacity: int, policy: str, key: Callable[[T], Hashable],
+                 high_water: float = 0.8) -> BoundedQueue[T]:
+    if policy == 'coalesce':
+        return CoalescingQueue(name, capacity, key, high_water)
+    return BoundedQueue(name, capacity, policy, high_water)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Modules of the collector import each other from the shcollector directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'shcollector'))
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# Stand-alone benchmarks of the SignalReader -> Manager -> Database pipeline
+#
+#   python3 tests/benchmark.py -o before.json
+#   python3 tests/benchmark.py -o after.json --compare before.json
+#
+# The database is replaced by an in-process fake cursor, only the collector's own work is timed.
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from configparser import ConfigParser
+from datetime import datetime, timedelta, timezone
+from queue import Queue
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'shcollector'))
+
+import cfg  # noqa: E402
+from fakes import FakePool  # noqa: E402
+from manager import Manager  # noqa: E402
+from reporters.database import Database, metric_names  # noqa: E402
+from sdr import MessageParser  # noqa: E402
+from sensors.measure import Measure  # noqa: E402
+from sensors.metrics import Types  # noqa: E402
+from utils import jsondecoder  # noqa: E402
+from utils.dedup import DuplicateFilter  # noqa: E402
+
+CORPUS = os.path.join(ROOT, 'tests', 'corpus.jsonl')
+CORPUS_CONFIG = os.path.join(ROOT, 'tests', 'debug.ini')
+
+
+def configure_sensors(count):
+    for section in cfg.config.sections():
+        if section.startswith('sensor:'):
+            cfg.config.remove_section(section)
+    for index in range(count):
+        cfg.config[f'sensor:bench{index}'] = {
+            'type': 'LaCrosse-TX29IT',
+            'radio_id': f'LaCrosse-TX29IT.ID={index}',
+            'database_id': f'BENCH{index}',
+            'name': f'Benchmark sensor {index}',
+            'location': 'Benchmark'
+        }
+
+
+def configure_corpus_sensors():
+    configure_sensors(0)
+    debug_config = ConfigParser(inline_comment_prefixes=('#'))
+    debug_config.read(CORPUS_CONFIG)
+    for section in debug_config.sections():
+        if section.startswith('sensor:'):
+            cfg.config[section] = dict(debug_config[section])
+
+
+def read_corpus():
+    with open(CORPUS, 'rb') as corpus_file:
+        return corpus_file.readlines()
+
+
+def synthetic_messages(count, now):
+    return [{'model': 'LaCrosse-TX29IT', 'id': index, 'battery_ok': 1,
+             'temperature_C': 20.0 + (index % 10) / 10,
+             'radio_id': f'LaCrosse-TX29IT.ID={index}', 'acquisition_date': now}
+            for index in range(count)]
+
+
+def drain(queue):
+    while not queue.empty():
+        queue.get_nowait()
+
+
+# Each benchmark returns a function timing one round, and the operations done per round
+def bench_parse(known_ids):
+    lines = read_corpus() * 20
+    known_radio_ids = {'LaCrosse-TX29IT.ID=0', 'LaCrosse-TX29IT.ID=7', 'Thermopro-TX2C.CH=2'}
+
+    def run():
+        parser = MessageParser(known_radio_ids if known_ids else None)
+        parse = parser.parse
+        start = time.perf_counter()
+        for line in lines:
+            parse(line)
+        return time.perf_counter() - start
+    return run, len(lines)
+
+
+def bench_measure():
+    now = datetime.now(timezone.utc)
+    count = 100000
+
+    def run():
+        start = time.perf_counter()
+        for index in range(count):
+            Measure(now, 'BENCH', Types.TEMPERATURE, 20.5)
+        return time.perf_counter() - start
+    return run, count
+
+
+def bench_manager(sensors, step):
+    configure_sensors(sensors)
+    manager = Manager(Queue(), Queue())
+    # At least a few thousand messages per round, spread evenly over the sensors
+    repeats = max(1, 5000 // sensors)
+    run_date = [datetime.now(timezone.utc)]
+
+    def run():
+        run_date[0] += timedelta(seconds=10)
+        messages = synthetic_messages(sensors, run_date[0]) * repeats
+        for message in messages:
+            manager.message_queue.put(message)
+        start = time.perf_counter()
+        manager.dispatch_messages()
+        dispatched = time.perf_counter()
+        manager.publish_measures(run_date[0])
+        published = time.perf_counter()
+        drain(manager.measure_queue)
+        return dispatched - start if step == 'dispatch' else published - dispatched
+    return run, sensors * repeats if step == 'dispatch' else sensors
+
+
+def bench_write(schema_version):
+    measure_queue = Queue()
+    cfg.config.set('Database', 'schema_version', str(schema_version))
+    database = Database(measure_queue)
+    cfg.config.set('Database', 'schema_version', '1')
+    database.pool = FakePool()
+    # Keys the fake cursor cannot load
+    database.sensor_keys = {f'BENCH{index}': index for index in range(100)}
+    database.metric_ids = {name: index for index, name in enumerate(metric_names())}
+    now = datetime.now(timezone.utc)
+    count = 10000
+
+    def run():
+        for index in range(count):
+            measure_queue.put(Measure(now + timedelta(seconds=index), f'BENCH{index % 100}',
+                                      Types.TEMPERATURE, 20.5))
+        start = time.perf_counter()
+        database.write_measures()
+        return time.perf_counter() - start
+    return run, count
+
+
+def bench_end_to_end():
+    configure_corpus_sensors()
+    lines = read_corpus()
+    message_queue = Queue()
+    measure_queue = Queue()
+    manager = Manager(message_queue, measure_queue)
+    database = Database(measure_queue)
+    database.pool = FakePool()
+    known_radio_ids = set(manager.sensors.keys())
+    run_date = [datetime.now(timezone.utc)]
+
+    def run():
+        run_date[0] += timedelta(seconds=10)
+        # A fresh duplicate filter, the corpus is replayed within its window
+        parser = MessageParser(known_radio_ids, DuplicateFilter(2, 4096))
+        start = time.perf_counter()
+        for line in lines:
+            message = parser.parse(line)
+            if message is not None:
+                message_queue.put(message)
+        manager.messages_to_measures(run_date[0])
+        database.write_measures()
+        return time.perf_counter() - start
+    return run, len(lines)
+
+
+BENCHMARKS = {
+    'parse': lambda: bench_parse(False),
+    'parse_drop_unknown': lambda: bench_parse(True),
+    'measure': bench_measure,
+    'dispatch_10': lambda: bench_manager(10, 'dispatch'),
+    'dispatch_100': lambda: bench_manager(100, 'dispatch'),
+    'dispatch_10000': lambda: bench_manager(10000, 'dispatch'),
+    'publish_10': lambda: bench_manager(10, 'publish'),
+    'publish_100': lambda: bench_manager(100, 'publish'),
+    'publish_10000': lambda: bench_manager(10000, 'publish'),
+    'write_measures': lambda: bench_write(1),
+    'write_measures_v2': lambda: bench_write(2),
+    'end_to_end': bench_end_to_end,
+}
+
+
+def run_benchmark(name, rounds):
+    run, operations = BENCHMARKS[name]()
+    # Warm up caches and lazily built structures
+    run()
+    timings = [run() for _ in range(rounds)]
+    median = statistics.median(timings)
+    return {
+        'operations': operations,
+        'rounds': rounds,
+        'min_s': min(timings),
+        'median_s': median,
+        'ops_per_s': operations / median
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, reference_file, threshold):
+    with open(reference_file) as reference:
+        previous = json.load(reference)['results']
+    regressions = 0
+    print(f"\n{'benchmark':<20} {'before':>14} {'after':>14} {'change':>8}")
+    for name, result in results.items():
+        if name not in previous:
+            continue
+        before = previous[name]['ops_per_s']
+        after = result['ops_per_s']
+        change = after / before - 1
+        flag = ''
+        if change < -threshold:
+            flag = ' REGRESSION'
+            regressions += 1
+        print(f"{name:<20} {before:>14,.0f} {after:>14,.0f} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the collection pipeline')
+    parser.add_argument('-o', '--output', help='Save results to this JSON file')
+    parser.add_argument('-c', '--compare', help='Compare to results saved in this JSON file')
+    parser.add_argument('-r', '--rounds', type=int, default=5, help='Timed rounds per benchmark')
+    parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                        help='Slowdown reported as a regression (default 0.1 = 10%%)')
+    parser.add_argument('benchmarks', nargs='*',
+                        help=f"Benchmarks to run among {', '.join(BENCHMARKS)}, all by default")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name}")
+
+    # The collector's own logs would be timed too
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = {}
+    for name in args.benchmarks or BENCHMARKS:
+        results[name] = run_benchmark(name, args.rounds)
+        print(f"{name:<20} {results[name]['ops_per_s']:>14,.0f} ops/s "
+              f"(median {results[name]['median_s'] * 1000:.2f}ms "
+              f"for {results[name]['operations']} ops)")
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({
+                'date': datetime.now().astimezone().isoformat(),
+                'revision': git_revision(),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'json_backend': jsondecoder.BACKEND,
+                'results': results
+            }, output, indent=2)
+
+    if args.compare and compare(results, args.compare, args.threshold) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
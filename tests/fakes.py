@@ -0,0 +1,91 @@
+# In-process stand-ins of psycopg2 connections, for tests and benchmarks
+from contextlib import contextmanager
+from psycopg2.extensions import adapt
+
+
+def quote(value):
+    return adapt(value).getquoted().decode()
+
+
+class FakeCursor():
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.statements = 0
+        self.size = 0
+        self.rowcount = 0
+
+    def mogrify(self, template, args):
+        if isinstance(template, bytes):
+            template = template.decode()
+        if isinstance(args, dict):
+            return (template % {key: quote(value) for key, value in args.items()}).encode()
+        return (template % tuple(quote(value) for value in args)).encode()
+
+    def execute(self, statement, args=None):
+        self.statements += 1
+        self.size += len(statement)
+        if self.connection.errors:
+            text = statement if isinstance(statement, bytes) else statement.encode()
+            for marker, error in self.connection.errors.items():
+                if marker in text:
+                    raise error
+        # Rows of a multi-row insert as built by execute_values, all inserted
+        text = statement if isinstance(statement, bytes) else statement.encode()
+        self.rowcount = text.count(b"),(") + 1 if text.startswith(b"INSERT") else 0
+        if self.connection.executed is not None:
+            self.connection.executed.append((statement, args))
+
+    def fetchone(self):
+        return self.connection.results.pop(0)
+
+    def fetchall(self):
+        return self.connection.results.pop(0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class FakeConnection():
+
+    encoding = 'UTF8'
+    closed = 0
+
+    def __init__(self, record=False):
+        # Statements and their arguments, only kept when asked not to slow benchmarks down
+        self.executed = [] if record else None
+        # Rows returned by the next fetches
+        self.results = []
+        # Errors raised by statements containing a marker, as rejected rows would
+        self.errors = {}
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class FakePool():
+
+    def __init__(self, connection=None):
+        self.fake_connection = connection or FakeConnection()
+
+    @contextmanager
+    def connection(self):
+        yield self.fake_connection
+
+    def close(self):
+        pass
+
+    def close_idle(self):
+        pass
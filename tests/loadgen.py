@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# Synthetic rtl_433 load generator, to find where the collector breaks
+#
+# As a fake rtl_433, set as [RTL433] executable, rtl_433's own arguments are ignored :
+#   [RTL433]
+#   executable = ./tests/loadgen.py
+#   other_args = --devices 5000 --rate 2000 --repeats 2
+#
+# Generate the matching configuration, tests/debug.ini being used for everything but sensors :
+#   python3 tests/loadgen.py config --devices 5000 --rate 2000 > /tmp/load.ini
+#
+# Run the reader, manager and database writer (against a fake cursor) and report :
+#   python3 tests/loadgen.py stress --devices 5000 --rate 2000 --duration 30
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from configparser import ConfigParser
+from datetime import datetime, timezone
+from queue import Empty, Queue
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LOADGEN = os.path.abspath(__file__)
+BASE_CONFIG = os.path.join(ROOT, 'tests', 'debug.ini')
+
+# (sensor type, rtl_433 model, radio id field)
+MODELS = [
+    ('LaCrosse-TX29IT', 'LaCrosse-TX29IT', 'id'),
+    ('LaCrosse-TX35', 'LaCrosse-TX35DTHIT', 'id'),
+    ('ThermoPro-TX2C', 'Thermopro-TX2C', 'channel'),
+]
+
+NOISE = [
+    b'[pulse_demod_pcm] short pulse detected\n',
+    b'[R82XX] PLL not locked!\n',
+    b'Allocating 15 zero-copy buffers\n',
+]
+
+
+def device_model(index):
+    return MODELS[index % len(MODELS)]
+
+
+def radio_id(index):
+    _, model, field = device_model(index)
+    return f"{model}.{'CH' if field == 'channel' else 'ID'}={index}"
+
+
+def frame(index, temperature, humidity):
+    sensor_type, model, _ = device_model(index)
+    # rtl_433 -M utc -M time:usec, the microseconds are used to measure latency
+    message = {'time': datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f'),
+               'model': model}
+    if sensor_type == 'ThermoPro-TX2C':
+        message.update({'subtype': 9, 'id': index % 256, 'channel': index, 'battery_ok': 1,
+                        'temperature_C': temperature, 'humidity': humidity, 'button': 0})
+    else:
+        message.update({'brand': 'LaCrosse', 'id': index, 'battery_ok': 1, 'newbattery': 0,
+                        'temperature_C': temperature})
+        if sensor_type == 'LaCrosse-TX35':
+            message['humidity'] = humidity
+        message['mic'] = 'CRC'
+    return json.dumps(message, separators=(', ', ' : ')).encode() + b'\n'
+
+
+def emit_arguments(parser):
+    parser.add_argument('--devices', type=int, default=100, help='Configured emitters')
+    parser.add_argument('--unknown', type=int, default=0, help='Unconfigured emitters')
+    parser.add_argument('--rate', type=float, default=100, help='Frames per second')
+    parser.add_argument('--repeats', type=int, default=1, help='Transmissions of each frame')
+    parser.add_argument('--noise', type=float, default=0.0,
+                        help='Ratio of rtl_433 log lines per frame')
+    parser.add_argument('--invalid', type=float, default=0.0,
+                        help='Ratio of truncated JSON lines per frame')
+    parser.add_argument('--duration', type=float, default=0, help='Seconds to run, 0 forever')
+    parser.add_argument('--seed', type=int, default=433)
+    parser.add_argument('--stats', help='Write emission statistics to this JSON file on exit')
+
+
+def emit(args):
+    generator = random.Random(args.seed)
+    count = args.devices + args.unknown
+    temperatures = [generator.uniform(5, 25) for _ in range(count)]
+    humidities = [generator.randint(30, 80) for _ in range(count)]
+    output = sys.stdout.buffer
+    stats = {'frames': 0, 'known_frames': 0, 'lines': 0, 'noise': 0, 'invalid': 0}
+
+    start = time.monotonic()
+    device = 0
+    try:
+        while args.duration <= 0 or time.monotonic() - start < args.duration:
+            # Frames due since the start, written in batches every 10ms
+            due = int((time.monotonic() - start) * args.rate) - stats['frames']
+            lines = []
+            for _ in range(due):
+                # Values always change, identical frames would be taken for repeats
+                temperatures[device] += generator.choice((-0.1, 0.1))
+                humidities[device] = min(95, max(20, humidities[device]
+                                                 + generator.randint(-1, 1)))
+                line = frame(device, round(temperatures[device], 1), humidities[device])
+                lines.extend([line] * args.repeats)
+                stats['frames'] += 1
+                if device < args.devices:
+                    stats['known_frames'] += 1
+                if generator.random() < args.noise:
+                    lines.append(generator.choice(NOISE))
+                    stats['noise'] += 1
+                if generator.random() < args.invalid:
+                    lines.append(line[:generator.randint(1, len(line) - 2)] + b'\n')
+                    stats['invalid'] += 1
+                device = (device + 1) % count
+            output.writelines(lines)
+            output.flush()
+            stats['lines'] += len(lines)
+            time.sleep(0.01)
+    except (BrokenPipeError, KeyboardInterrupt):
+        pass
+    finally:
+        stats['elapsed'] = time.monotonic() - start
+        stats['rate'] = stats['frames'] / stats['elapsed']
+        if args.stats:
+            with open(args.stats, 'w') as stats_file:
+                json.dump(stats, stats_file)
+
+
+def other_args(args):
+    return ' '.join([f'--devices {args.devices}', f'--unknown {args.unknown}',
+                     f'--rate {args.rate}', f'--repeats {args.repeats}',
+                     f'--noise {args.noise}', f'--invalid {args.invalid}',
+                     f'--duration {args.duration}', f'--seed {args.seed}']
+                    + ([f'--stats {args.stats}'] if args.stats else []))
+
+
+def build_config(args):
+    config = ConfigParser(interpolation=None, inline_comment_prefixes=('#'))
+    config.read(args.base)
+    for section in config.sections():
+        if section.startswith('sensor:'):
+            config.remove_section(section)
+    config['RTL433']['executable'] = LOADGEN
+    config['RTL433']['other_args'] = other_args(args)
+    for index in range(args.devices):
+        config[f'sensor:load{index}'] = {
+            'type': device_model(index)[0],
+            'radio_id': radio_id(index),
+            'database_id': f'LOAD{index}',
+            'name': f'Load sensor {index}',
+            'location': 'Load generator'
+        }
+    return config
+
+
+def percentile(values, ratio):
+    if len(values) == 0:
+        return 0.0
+    return sorted(values)[min(len(values) - 1, int(len(values) * ratio))]
+
+
+def stress(args):
+    # The collector is only imported here, emitting frames must start fast
+    sys.path.insert(0, os.path.join(ROOT, 'shcollector'))
+    import cfg
+    from fakes import FakePool
+    from manager import Manager
+    from reporters.database import Database
+    from sdr import MessageParser, SignalReader
+    from sources import parse_recorded_time
+    from utils.dedup import DuplicateFilter
+
+    stats_file = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+    stats_file.close()
+    args.stats = stats_file.name
+    config = build_config(args)
+    for section in cfg.config.sections():
+        if section.startswith('sensor:'):
+            cfg.config.remove_section(section)
+    cfg.config.read_dict({section: dict(config[section]) for section in config.sections()
+                          if section in ('RTL433', 'Dedup') or section.startswith('sensor:')})
+    cfg.config.set('Spool', 'enabled', 'false')
+    logging.getLogger().setLevel(logging.WARNING)
+
+    message_queue = Queue()
+    measure_queue = Queue()
+    manager = Manager(message_queue, measure_queue)
+    database = Database(measure_queue)
+    database.pool = FakePool()
+    parser = MessageParser(set(manager.sensors.keys()), DuplicateFilter(2, 65536))
+    reader = SignalReader('RTL433', message_queue, parser)
+
+    latencies = []
+    flushes = []
+    depths = []
+    stopped = threading.Event()
+
+    def dispatch():
+        while not stopped.is_set() or not message_queue.empty():
+            try:
+                message = message_queue.get(timeout=0.1)
+            except Empty:
+                continue
+            recorded = parse_recorded_time(message['time'], True).timestamp()
+            latencies.append(time.time() - recorded)
+            manager.dispatch_message(message)
+
+    def publish():
+        start = time.perf_counter()
+        manager.publish_measures(datetime.now(timezone.utc))
+        database.write_measures()
+        flushes.append(time.perf_counter() - start)
+
+    dispatcher = threading.Thread(target=dispatch, name='dispatcher')
+    start = time.monotonic()
+    reader.start()
+    dispatcher.start()
+    next_publish = start + args.publish_interval
+    while reader.is_alive():
+        reader.join(0.5)
+        depths.append(message_queue.qsize())
+        if time.monotonic() >= next_publish:
+            publish()
+            next_publish += args.publish_interval
+    stopped.set()
+    dispatcher.join()
+    publish()
+    elapsed = time.monotonic() - start
+
+    with open(args.stats) as emitted_file:
+        emitted = json.load(emitted_file)
+    os.unlink(args.stats)
+
+    dispatched = len(latencies)
+    report = {
+        'target_rate': args.rate,
+        'emitted_rate': emitted['rate'],
+        'frames': emitted['frames'],
+        'known_frames': emitted['known_frames'],
+        'lines': emitted['lines'],
+        'lines_read': parser.lines,
+        'dispatched': dispatched,
+        'duplicates': parser.duplicates.suppressed,
+        'unknown': sum(parser.unknown_emitters.values()),
+        'throughput_lines_s': parser.lines / elapsed,
+        'throughput_messages_s': dispatched / elapsed,
+        'drop_rate': 1 - dispatched / emitted['known_frames'] if emitted['known_frames'] else 0,
+        'latency_p50_ms': percentile(latencies, 0.5) * 1000,
+        'latency_p99_ms': percentile(latencies, 0.99) * 1000,
+        'latency_max_ms': max(latencies, default=0) * 1000,
+        'max_queue_depth': max(depths, default=0),
+        'flush_mean_ms': statistics.mean(flushes) * 1000,
+        'flush_max_ms': max(flushes) * 1000,
+        'published': manager.published,
+    }
+    for name, value in report.items():
+        print(f"{name:<22} {value:,.3f}" if isinstance(value, float) else f"{name:<22} {value:,}")
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] in ('config', 'stress'):
+        parser = argparse.ArgumentParser(description='rtl_433 load generator')
+        parser.add_argument('command', choices=['config', 'stress'])
+        emit_arguments(parser)
+        parser.add_argument('--base', default=BASE_CONFIG,
+                            help='Configuration the sensors are added to')
+        parser.add_argument('--publish-interval', type=float, default=10,
+                            help='Seconds between publications during stress tests')
+        parser.add_argument('-o', '--output', help='Save the stress report to this JSON file')
+        args = parser.parse_args()
+        if args.command == 'config':
+            build_config(args).write(sys.stdout)
+        else:
+            if args.duration <= 0:
+                parser.error('stress tests need a --duration')
+            stress(args)
+        return
+
+    # Called as rtl_433, its arguments (-C si -F json...) are ignored
+    parser = argparse.ArgumentParser(description='Fake rtl_433 emitting synthetic frames')
+    emit_arguments(parser)
+    args, _ = parser.parse_known_args()
+    emit(args)
+
+
+if __name__ == '__main__':
+    main()
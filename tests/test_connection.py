@@ -0,0 +1,103 @@
+import unittest
+from unittest import mock
+import psycopg2
+import cfg
+from reporters.connection import ConnectionPool
+from tests.fakes import FakeConnection
+
+
+class FakeClock():
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        for option, value in (('reconnect_min_delay', '1'), ('reconnect_max_delay', '5'),
+                              ('health_check_interval', '30'), ('idle_timeout', '300')):
+            self.addCleanup(cfg.config.set, 'Database', option,
+                            cfg.config.get('Database', option))
+            cfg.config.set('Database', option, value)
+        self.clock = FakeClock()
+        clock = mock.patch('reporters.connection.time', self.clock)
+        clock.start()
+        self.addCleanup(clock.stop)
+        connect = mock.patch('reporters.connection.psycopg2.connect')
+        self.connect = connect.start()
+        self.addCleanup(connect.stop)
+        self.pool = ConnectionPool()
+
+    def use(self):
+        with self.pool.connection() as db_connection:
+            return db_connection
+
+    def test_backoff(self):
+        self.connect.side_effect = psycopg2.OperationalError("connection refused")
+        delays = []
+        for _ in range(6):
+            self.assertRaises(psycopg2.OperationalError, self.use)
+            delays.append(self.pool.retry_delay)
+            attempts = self.connect.call_count
+            # Fails fast until the delay expired
+            self.clock.now += self.pool.retry_delay - 0.1
+            self.assertRaises(psycopg2.OperationalError, self.use)
+            self.assertEqual(self.connect.call_count, attempts)
+            self.clock.now += 0.1
+        self.assertEqual(delays, [1, 2, 4, 5, 5, 5])
+
+        # Reset once connected
+        self.connect.side_effect = None
+        self.connect.return_value = FakeConnection()
+        self.assertIs(self.use(), self.connect.return_value)
+        self.assertEqual(self.pool.retry_delay, 0)
+        self.assertEqual(self.pool.next_attempt, 0)
+
+    def test_health_check(self):
+        self.connect.side_effect = [FakeConnection(), FakeConnection()]
+        first = self.use()
+        # Not checked while in use
+        first.errors[b"SELECT 1"] = psycopg2.OperationalError("server closed the connection")
+        self.clock.now += 29
+        self.assertIs(self.use(), first)
+
+        # Checked after health_check_interval of inactivity, replaced when broken
+        self.clock.now += 31
+        second = self.use()
+        self.assertIsNot(second, first)
+        assert first.closed
+        self.clock.now += 31
+        self.assertIs(self.use(), second)
+
+    def test_lost_connection(self):
+        self.connect.side_effect = [FakeConnection(), FakeConnection()]
+        first = self.use()
+        first.close()
+        self.assertIsNot(self.use(), first)
+
+    def test_recover(self):
+        self.connect.side_effect = [FakeConnection(), FakeConnection()]
+        first = self.use()
+        first.rollback = mock.Mock()
+        with self.assertRaises(psycopg2.DataError):
+            with self.pool.connection():
+                raise psycopg2.DataError("invalid value")
+        # The transaction is reset, the connection kept
+        first.rollback.assert_called_once()
+        self.assertIs(self.use(), first)
+
+    def test_close_idle(self):
+        self.connect.side_effect = [FakeConnection(), FakeConnection()]
+        first = self.use()
+        self.clock.now += 299
+        self.pool.close_idle()
+        assert not first.closed
+        self.clock.now += 2
+        self.pool.close_idle()
+        assert first.closed
+        self.assertIsNone(self.pool.db_connection)
+        self.assertIsNot(self.use(), first)
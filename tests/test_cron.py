@@ -1,7 +1,9 @@
+import threading
+import time
 import unittest
 import datetime
 from freezegun import freeze_time
-from shcollector.utils.cron import CronScheduler, Job, timezone
+from utils.cron import CronScheduler, Job, timezone
 
 
 class TestCronScheduler(unittest.TestCase):
@@ -20,6 +22,47 @@ class TestCronScheduler(unittest.TestCase):
         self.cron.schedule(Job('test', "* * * * *", 1, self.check_run_date, {'test': True}, True))
         self.cron.start()
 
+    def test_missed_slots(self):
+        job = Job('test', "* * * * *", 1, print, {}, False)
+        job.next_run(timezone.localize(datetime.datetime(2020, 12, 9, 8, 0, 30)))
+        # Resumed hours later : straight to the next future slot
+        run_date = job.next_run(timezone.localize(datetime.datetime(2020, 12, 9, 21, 34, 59)))
+        self.assertEqual(run_date, timezone.localize(datetime.datetime(2020, 12, 9, 21, 35, 00)))
+
+    def test_late_and_overlapping_runs(self):
+        runs = []
+        job = Job('test_late', "* * * * *", 1, lambda: runs.append(1), {}, False)
+        now = timezone.localize(datetime.datetime.now())
+
+        CronScheduler(missed='skip')._fire(job, now - datetime.timedelta(seconds=10))
+        self.assertEqual((len(runs), job.missed.value), (0, 1))
+
+        CronScheduler(missed='coalesce')._fire(job, now - datetime.timedelta(seconds=10))
+        self.assertEqual(len(runs), 1)
+
+        job.running = True
+        CronScheduler()._fire(job, now)
+        self.assertEqual((len(runs), job.overlapped.value), (1, 1))
+
+    def test_cancel_waits_for_runs(self):
+        cron = CronScheduler(workers=1)
+        started = threading.Event()
+        finished = []
+
+        def slow():
+            started.set()
+            time.sleep(0.2)
+            finished.append(1)
+        cron.schedule(Job('test_slow', "* * * * * *", 1, slow, {}, False))
+        scheduler = threading.Thread(target=cron.start)
+        scheduler.start()
+        assert started.wait(5)
+        # As from the main thread once a job requested the stop
+        cron.cancel(wait=True)
+        self.assertEqual(finished, [1])
+        scheduler.join(5)
+        assert not scheduler.is_alive()
+
 
 if __name__ == '__main__':
     unittest.main()
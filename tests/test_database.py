@@ -0,0 +1,184 @@
+import re
+import unittest
+from datetime import datetime, timedelta, timezone
+from queue import Queue
+import psycopg2
+import psycopg2.errors
+import cfg
+from reporters.database import Database, written_rows
+from sensors.measure import Measure
+from sensors.metrics import Types
+from sensors.sensor import SensorDefinition
+from tests.fakes import FakeConnection, FakePool
+
+START = datetime(2021, 3, 14, 8, 0, 0, tzinfo=timezone.utc)
+VALUE = re.compile(rb"'TEMPERATURE', ([0-9.]+)\)")
+
+
+def measures(values):
+    return [Measure(START + timedelta(seconds=index), 'TEST', Types.TEMPERATURE, value)
+            for index, value in enumerate(values)]
+
+
+class TestDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.connection = FakeConnection(record=True)
+        self.database = self.create_database('nothing')
+
+    def create_database(self, on_conflict):
+        self.addCleanup(cfg.config.set, 'Database', 'on_conflict',
+                        cfg.config.get('Database', 'on_conflict'))
+        cfg.config.set('Database', 'on_conflict', on_conflict)
+        database = Database(Queue())
+        database.pool = FakePool(self.connection)
+        return database
+
+    def inserted(self):
+        # Values of the rows of the successful inserts
+        values = []
+        for statement, _ in self.connection.executed:
+            if isinstance(statement, bytes) and statement.startswith(b"INSERT"):
+                values.extend(float(value) for value in VALUE.findall(statement))
+        return values
+
+    def test_rejected_row_isolated(self):
+        self.connection.errors[b"666.0"] = psycopg2.IntegrityError("invalid value")
+        values = [20.0, 20.1, 20.2, 666.0, 20.4, 20.5, 20.6, 20.7]
+        inserted = self.database.insert_measures(self.connection.cursor(), measures(values))
+        self.assertEqual(sorted(self.inserted()), sorted(set(values) - {666.0}))
+        self.assertEqual(inserted, 7)
+        self.assertEqual(self.database.rejected_rows, 1)
+        # Halves are tried down to the rejected row, each under its savepoint
+        rollbacks = [statement for statement, _ in self.connection.executed
+                     if statement == "ROLLBACK TO SAVEPOINT insert_rows;"]
+        self.assertEqual(len(rollbacks), 4)
+        self.assertEqual(len([statement for statement, _ in self.connection.executed
+                              if statement == "SAVEPOINT insert_rows;"]), 7)
+
+    def test_duplicates_collapsed(self):
+        chunk = measures([20.0, 20.1])
+        chunk.append(Measure(START, 'TEST', Types.TEMPERATURE, 19.5))
+        self.database.insert_measures(self.connection.cursor(), chunk)
+        # A statement may not upsert a key twice, the latest value is kept
+        self.assertEqual(sorted(self.inserted()), [19.5, 20.1])
+
+    def test_written_rows(self):
+        chunk = measures([20.0, 20.1, 666.0])
+        chunk[1].quarantined = True
+        self.connection.errors[b"666.0"] = psycopg2.IntegrityError("invalid value")
+        for measure in chunk:
+            self.database.measure_queue.put(measure)
+        written = written_rows.value
+        assert self.database.write_measures()
+        # Neither the quarantined row nor the rejected one
+        self.assertEqual(written_rows.value - written, 1)
+
+    def test_on_conflict_policies(self):
+        self.assertIn("ON CONFLICT (time, idsensor, metric) DO NOTHING",
+                      self.database.add_sensordata)
+        update = self.create_database('update')
+        self.assertIn("ON CONFLICT (time, idsensor, metric) DO UPDATE SET data=excluded.data",
+                      update.add_sensordata)
+        error = self.create_database('error')
+        self.assertNotIn("ON CONFLICT", error.add_sensordata)
+
+        # Without a conflict clause, rows already stored are rejected one by one
+        self.connection.errors[b"20.1"] = psycopg2.errors.UniqueViolation("duplicate key")
+        error.insert_measures(self.connection.cursor(), measures([20.0, 20.1, 20.2]))
+        self.assertEqual(sorted(self.inserted()), [20.0, 20.2])
+        self.assertEqual(error.rejected_rows, 1)
+
+    def test_missing_sensor_is_transient(self):
+        self.database.sensor_definitions = [SensorDefinition('LaCrosse-TX29IT.ID=7', 'TEST',
+                                                             'Test', 'Test')]
+        self.connection.errors[b"'TEST'"] = psycopg2.errors.ForeignKeyViolation("no sensor")
+        for measure in measures([20.0, 20.1]):
+            self.database.measure_queue.put(measure)
+        assert not self.database.write_measures()
+        # Put back instead of rejected
+        self.assertEqual(self.database.rejected_rows, 0)
+        self.assertEqual(self.database.measure_queue.qsize(), 2)
+
+        # Sensors are added again before writing
+        del self.connection.errors[b"'TEST'"]
+        self.connection.executed.clear()
+        assert self.database.write_measures()
+        statements = [statement for statement, _ in self.connection.executed]
+        self.assertEqual(statements.index(self.database.add_sensor), 0)
+        self.assertEqual(sorted(self.inserted()), [20.0, 20.1])
+        assert not self.database.sensors_missing
+
+
+class TestDatabaseV2(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(cfg.config.set, 'Database', 'schema_version',
+                        cfg.config.get('Database', 'schema_version'))
+        cfg.config.set('Database', 'schema_version', '2')
+        self.connection = FakeConnection(record=True)
+        self.database = Database(Queue())
+        self.database.pool = FakePool(self.connection)
+        self.database.sensor_definitions = [SensorDefinition('LaCrosse-TX29IT.ID=7', 'TEST',
+                                                             'Test', 'Test')]
+        self.database.metric_ids = {'TEMPERATURE': 3}
+
+    def keys_loaded(self, sensor_keys):
+        # Results of the queries of load_keys
+        self.connection.results.extend([sensor_keys, [('TEMPERATURE', 3)], (True,)])
+
+    def statements(self, prefix):
+        return [(statement, args) for statement, args in self.connection.executed
+                if isinstance(statement, str) and statement.startswith(prefix)]
+
+    def inserted(self):
+        return [statement for statement, _ in self.connection.executed
+                if isinstance(statement, bytes) and statement.startswith(b"INSERT")]
+
+    def test_insert_and_partitions(self):
+        self.database.sensor_keys = {'TEST': 1}
+        april = datetime(2021, 4, 1, 0, 0, 0, tzinfo=timezone.utc)
+        chunk = measures([20.0]) + [Measure(april, 'TEST', Types.TEMPERATURE, 21.0)]
+        self.database.insert_measures(self.connection.cursor(), chunk)
+
+        partitions = self.statements("CREATE TABLE IF NOT EXISTS public.sensors_data_v2_")
+        self.assertEqual([statement.split()[5] for statement, _ in partitions],
+                         ["public.sensors_data_v2_202103", "public.sensors_data_v2_202104"])
+        self.assertEqual(partitions[1][1], {'start': april,
+                                            'end': datetime(2021, 5, 1, tzinfo=timezone.utc)})
+        # Rows are stored with the keys of their sensor and metric
+        self.assertEqual(len(self.inserted()), 1)
+        self.assertIn(b"INSERT INTO public.sensors_data_v2", self.inserted()[0])
+        self.assertIn(b"'2021-04-01T00:00:00+00:00'::timestamptz, 1, 3, 21.0)",
+                      self.inserted()[0])
+
+        # Partitions are only created once
+        self.connection.executed.clear()
+        self.database.insert_measures(self.connection.cursor(), measures([22.0]))
+        self.assertEqual(self.statements("CREATE TABLE"), [])
+        self.assertEqual(len(self.inserted()), 1)
+
+    def test_new_sensor_added(self):
+        # Not in the database when keys were loaded at startup
+        self.database.sensor_keys = {'OTHER': 1}
+        self.keys_loaded([('OTHER', 1), ('TEST', 2)])
+        for measure in measures([20.0]):
+            self.database.measure_queue.put(measure)
+        assert self.database.write_measures()
+
+        self.assertEqual(len(self.statements(self.database.add_sensor)), 1)
+        self.assertIn(b", 2, 3, 20.0)", self.inserted()[0])
+        self.assertEqual(self.database.rejected_rows, 0)
+
+    def test_unknown_sensor_is_transient(self):
+        self.database.sensor_keys = {'OTHER': 1}
+        self.keys_loaded([('OTHER', 1)])
+        for measure in measures([20.0, 20.1]):
+            self.database.measure_queue.put(measure)
+        assert not self.database.write_measures()
+        # Put back instead of rejected, keys are loaded again by the next write
+        self.assertEqual(self.database.rejected_rows, 0)
+        self.assertEqual(self.database.measure_queue.qsize(), 2)
+        assert self.database.sensors_missing
+        self.assertEqual(self.database.sensor_keys, {})
+        self.assertEqual(self.inserted(), [])
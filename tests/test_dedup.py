@@ -0,0 +1,33 @@
+import unittest
+from utils.dedup import DuplicateFilter
+
+
+class TestDuplicateFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.filter = DuplicateFilter(2, 3, lambda: self.now)
+
+    def test_repeat_suppressed(self):
+        assert self.filter.accept('LaCrosse-TX29IT.ID=7', 1)
+        assert not self.filter.accept('LaCrosse-TX29IT.ID=7', 1)
+        assert self.filter.accept('LaCrosse-TX29IT.ID=7', 2)
+        assert self.filter.accept('LaCrosse-TX29IT.ID=0', 1)
+        assert self.filter.suppressed == 1
+
+    def test_window_expiry(self):
+        assert self.filter.accept('LaCrosse-TX29IT.ID=7', 1)
+        self.now = 1.5
+        assert not self.filter.accept('LaCrosse-TX29IT.ID=7', 1)
+        self.now = 2.5
+        assert self.filter.accept('LaCrosse-TX29IT.ID=7', 1)
+
+    def test_bounded_memory(self):
+        for fingerprint in range(10):
+            self.filter.accept('LaCrosse-TX29IT.ID=7', fingerprint)
+        assert len(self.filter.entries) == 3
+        assert self.filter.accept('LaCrosse-TX29IT.ID=7', 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
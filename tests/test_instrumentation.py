@@ -0,0 +1,54 @@
+import unittest
+from utils.instrumentation import Registry
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def test_render(self):
+        registry = Registry()
+        counter = registry.counter('test_lines', 'Lines read', {'reader': 'RTL433'})
+        counter.inc(3)
+        registry.callback('test_queue_size', 'Queue size', 'gauge', lambda: 7)
+        # Registering again returns the same metric
+        self.assertIs(counter, registry.counter('test_lines', 'Lines read', {'reader': 'RTL433'}))
+
+        lines = registry.render().splitlines()
+        self.assertIn('# TYPE test_lines counter', lines)
+        self.assertIn('test_lines_total{reader="RTL433"} 3', lines)
+        self.assertIn('test_queue_size 7', lines)
+        self.assertEqual(lines[-1], '# EOF')
+
+    def test_histogram(self):
+        registry = Registry()
+        histogram = registry.histogram('test_duration', 'Duration', buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(2)
+
+        lines = registry.render().splitlines()
+        self.assertIn('test_duration_bucket{le="0.1"} 1', lines)
+        self.assertIn('test_duration_bucket{le="1.0"} 2', lines)
+        self.assertIn('test_duration_bucket{le="+Inf"} 3', lines)
+        self.assertIn('test_duration_count 3', lines)
+        self.assertIn('test_duration_sum 2.55', lines)
+
+    def test_merge(self):
+        # As forwarded by a child process
+        child = Registry()
+        child.counter('test_rows', 'Rows written').inc(5)
+        child.callback('test_queue_size', 'Queue size', 'gauge', lambda: 2)
+
+        registry = Registry()
+        registry.counter('test_rows', 'Rows written')
+        registry.counter('test_lines', 'Lines read').inc(1)
+        registry.merge(child.snapshot())
+        lines = registry.render().splitlines()
+        self.assertIn('test_rows_total 5', lines)
+        self.assertIn('test_queue_size 2', lines)
+        self.assertIn('# TYPE test_queue_size gauge', lines)
+        # Metrics the child did not send are kept
+        self.assertIn('test_lines_total 1', lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+from queue import Queue
+import cfg
+from manager import Manager
+from sensors.metrics import Types
+
+START = datetime(2021, 3, 14, 8, 0, 0, tzinfo=timezone.utc)
+RADIO_ID = 'LaCrosse-TX29IT.ID=7'
+
+
+class TestDeadband(unittest.TestCase):
+
+    def setUp(self):
+        cfg.config['sensor:test'] = {
+            'type': 'LaCrosse-TX29IT',
+            'radio_id': RADIO_ID,
+            'database_id': 'TEST',
+            'name': 'Test',
+            'location': 'Test'
+        }
+        self.addCleanup(cfg.config.remove_section, 'sensor:test')
+        for section, option, value in (('Deadband', 'enabled', 'true'),
+                                       ('Deadband', 'heartbeat', '900'),
+                                       ('Aggregation', 'extra', 'max')):
+            self.addCleanup(cfg.config.set, section, option, cfg.config.get(section, option))
+            cfg.config.set(section, option, value)
+        self.manager = Manager(Queue(), Queue())
+
+    def publish(self, seconds, temperature):
+        # One message per window, published at its end
+        date = START + timedelta(seconds=seconds)
+        self.manager.dispatch_message({'radio_id': RADIO_ID, 'temperature_C': temperature,
+                                       'acquisition_date': date})
+        self.manager.publish_measures(date + timedelta(seconds=1))
+        published = []
+        while not self.manager.measure_queue.empty():
+            measure = self.manager.measure_queue.get_nowait()
+            if measure.metric == Types.TEMPERATURE:
+                published.append((measure.metric_name(), measure.data))
+        return published
+
+    def test_suppression_and_heartbeat(self):
+        self.assertEqual(self.publish(0, 20.0), [('TEMPERATURE', 20.0),
+                                                 ('TEMPERATURE_MAX', 20.0)])
+        # Within the 0.1 deadband of the latest stored value, with its extra aggregates
+        self.assertEqual(self.publish(10, 20.05), [])
+        self.assertEqual(self.publish(20, 20.08), [])
+        self.assertEqual(self.publish(30, 20.3), [('TEMPERATURE', 20.3),
+                                                  ('TEMPERATURE_MAX', 20.3)])
+        self.assertEqual(self.publish(500, 20.3), [])
+        # Stored anyway once the heartbeat expired since the latest stored value
+        self.assertEqual(self.publish(930, 20.3), [('TEMPERATURE', 20.3),
+                                                   ('TEMPERATURE_MAX', 20.3)])
+        self.assertEqual(self.manager.suppressed, 3)
+        self.assertEqual(self.manager.published, 3)
+
+    def test_invalid_field(self):
+        # A bad field neither stops the dispatch nor the other fields of the message
+        date = START + timedelta(seconds=5)
+        self.manager.message_queue.put({'radio_id': RADIO_ID, 'temperature_C': 'garbled',
+                                        'battery_ok': 1, 'acquisition_date': date})
+        self.manager.message_queue.put({'radio_id': RADIO_ID, 'temperature_C': 19.5,
+                                        'acquisition_date': date})
+        self.manager.dispatch_messages()
+        self.manager.publish_measures(date + timedelta(seconds=1))
+        published = set()
+        while not self.manager.measure_queue.empty():
+            published.add(self.manager.measure_queue.get_nowait().metric_name())
+        self.assertEqual(published, {'TEMPERATURE', 'TEMPERATURE_MAX', 'BATTERY',
+                                     'BATTERY_MAX'})
+        self.assertEqual(self.manager.sensors[RADIO_ID].invalid, 1)
+
+    def test_disabled(self):
+        self.manager.deadband_enabled = False
+        for seconds in (0, 10, 20):
+            self.assertEqual(self.publish(seconds, 20.0), [('TEMPERATURE', 20.0),
+                                                           ('TEMPERATURE_MAX', 20.0)])
+
+
+class TestOutlierSettings(unittest.TestCase):
+
+    def setUp(self):
+        cfg.config['sensor:test'] = {
+            'type': 'LaCrosse-TX29IT',
+            'radio_id': RADIO_ID,
+            'database_id': 'TEST',
+            'name': 'Test',
+            'location': 'Test',
+            'outlier_window': '30'
+        }
+        self.addCleanup(cfg.config.remove_section, 'sensor:test')
+
+    def test_sensor_override(self):
+        manager = Manager(Queue(), Queue())
+        self.assertEqual(manager.outlier_settings['TEST'],
+                         (30, cfg.config.getfloat('Outlier', 'k')))
+
+    def test_invalid_override(self):
+        # Rejected when building sensors rather than on their first measure
+        cfg.config.set('sensor:test', 'outlier_window', '0')
+        self.assertRaises(ValueError, Manager, Queue(), Queue())
@@ -0,0 +1,55 @@
+import unittest
+from datetime import datetime, timezone
+from queue import Queue
+import cfg
+from migrate import copy_batch
+from reporters.database import Database
+from tests.fakes import FakeConnection
+
+ROWS = [
+    (datetime(2021, 3, 14, 8, 0, 3, tzinfo=timezone.utc), 'EXTERIEUR', 'TEMPERATURE', 8.5),
+    (datetime(2021, 3, 14, 8, 0, 3, tzinfo=timezone.utc), 'SDB', 'HUMIDITY', 56.0),
+    (datetime(2021, 3, 14, 8, 0, 25, tzinfo=timezone.utc), 'SDB', 'TEMPERATURE', 22.3),
+]
+
+
+class TestMigrate(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(cfg.config.set, 'Database', 'schema_version',
+                        cfg.config.get('Database', 'schema_version'))
+        cfg.config.set('Database', 'schema_version', '2')
+        self.database = Database(Queue())
+        self.database.sensor_keys = {'EXTERIEUR': 1, 'SDB': 2}
+        self.database.metric_ids = {'TEMPERATURE': 1, 'HUMIDITY': 2}
+        self.database.partitioned = False
+        self.connection = FakeConnection(record=True)
+
+    def watermark_updates(self):
+        return [args for statement, args in self.connection.executed
+                if statement == self.database.lower_watermarks]
+
+    def test_copy_lowers_rollup_watermarks(self):
+        # rollup_watermarks exists
+        self.connection.results.append((True,))
+        copy_batch(self.database, self.connection.cursor(), ROWS)
+        assert self.watermark_updates() == [{
+            'time': ROWS[0][0],
+            'names': ['sensors_data_v2_5m', 'sensors_data_v2_1h', 'sensors_data_v2_1d']}]
+        # After the insert, committed along with it and the progress
+        assert self.connection.executed[-1][0] == self.database.lower_watermarks
+
+        # The table is looked up once
+        copy_batch(self.database, self.connection.cursor(), ROWS[2:])
+        assert len(self.watermark_updates()) == 2
+        assert self.watermark_updates()[1]['time'] == ROWS[2][0]
+
+    def test_copy_without_rollups(self):
+        self.connection.results.extend([(False,), (False,)])
+        copy_batch(self.database, self.connection.cursor(), ROWS)
+        copy_batch(self.database, self.connection.cursor(), ROWS)
+        assert self.watermark_updates() == []
+        # Rollups enabled during the migration are found by the next batch
+        self.connection.results.append((True,))
+        copy_batch(self.database, self.connection.cursor(), ROWS)
+        assert len(self.watermark_updates()) == 1
@@ -0,0 +1,182 @@
+import os
+import signal
+import tempfile
+import time
+import unittest
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from queue import Queue
+import cfg
+from multiprocess import (MultiprocessPipeline, decode_line, decode_measures, encode_line,
+                          encode_measures)
+from sdr import MessageParser
+from sensors.measure import Measure
+from sensors.metrics import Types
+from utils.instrumentation import registry
+
+LINES = 50
+
+dispatched_lines = registry.counter('test_multiprocess_dispatched', 'Lines dispatched')
+
+
+class FakePool():
+
+    @contextmanager
+    def connection(self):
+        yield None
+
+    def close(self):
+        pass
+
+    def close_idle(self):
+        pass
+
+
+# Lines dispatched and measures written by the children are appended to files
+class FakeManager():
+
+    def __init__(self, dispatched, failing=None):
+        self.dispatched = dispatched
+        self.failing = failing
+        self.messages = []
+        self.measure_queue = Queue()
+
+    def dispatch_message(self, message):
+        if message['id'] == self.failing:
+            raise ValueError(f"Invalid message {message}")
+        self.messages.append(message)
+        dispatched_lines.inc()
+        with open(self.dispatched, 'a') as output:
+            output.write(f"{message['id']}\n")
+
+    def publish_measures(self, run_date):
+        for message in self.messages:
+            self.measure_queue.put(Measure(message['acquisition_date'], 'TEST',
+                                           Types.TEMPERATURE, float(message['id'])))
+        self.messages = []
+
+    def publish_window(self, run_date):
+        self.publish_measures(run_date)
+
+
+class FakeDatabase():
+
+    def __init__(self, written):
+        self.written = written
+        self.measure_queue = Queue()
+        self.pool = FakePool()
+
+    def write_measures(self):
+        with open(self.written, 'a') as output:
+            while not self.measure_queue.empty():
+                output.write(f"{self.measure_queue.get_nowait().data:.0f}\n")
+
+    def close(self):
+        pass
+
+
+def count_lines(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path) as lines:
+        return len(lines.readlines())
+
+
+class TestFrames(unittest.TestCase):
+
+    def test_line_round_trip(self):
+        line = b'{"model" : "Test", "id" : 7}'
+        before = datetime.now(timezone.utc)
+        received, decoded = decode_line(encode_line(line))
+        self.assertEqual(decoded, line)
+        self.assertLessEqual(abs((received - before).total_seconds()), 1)
+
+    def test_measures_round_trip(self):
+        offset = timezone(timedelta(hours=2))
+        measures = [Measure(datetime(2021, 3, 14, 8, 0, 0, 250000, tzinfo=offset), 'TEST',
+                            Types.TEMPERATURE, 20.5),
+                    Measure(datetime(2021, 3, 14, 6, 0, 10, tzinfo=timezone.utc),
+                            'Sensor-é' * 40, Types.HUMIDITY, 42, 'max')]
+        measures[1].quarantined = True
+        # Longer than a one byte length prefix
+        self.assertGreater(len(measures[1].database_id.encode()), 255)
+
+        decoded = decode_measures(encode_measures(measures))
+        self.assertEqual([(measure.time, measure.time.utcoffset(), measure.database_id,
+                           measure.metric, measure.data, measure.aggregate, measure.quarantined)
+                          for measure in decoded],
+                         [(measure.time, measure.time.utcoffset(), measure.database_id,
+                           measure.metric, measure.data, measure.aggregate, measure.quarantined)
+                          for measure in measures])
+        self.assertEqual(decode_measures(encode_measures([])), [])
+
+
+class TestMultiprocessPipeline(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        recording = os.path.join(self.directory, 'recording.jsonl')
+        with open(recording, 'w') as output:
+            for index in range(LINES):
+                output.write(f'{{"time" : "2021-03-14 08:00:{index % 60:02d}", '
+                             f'"model" : "Test", "id" : {index}}}\n')
+        for option, value in (('replay', recording), ('replay_speed', 'fast')):
+            self.addCleanup(cfg.config.set, 'RTL433', option, cfg.config.get('RTL433', option))
+            cfg.config.set('RTL433', option, value)
+
+    def test_process_group_sigterm(self):
+        dispatched = os.path.join(self.directory, 'dispatched')
+        written = os.path.join(self.directory, 'written')
+        pipeline = MultiprocessPipeline(FakeManager(dispatched), FakeDatabase(written),
+                                        ['RTL433'], lambda section: MessageParser(), False)
+        # Children inherit this until they install their own handlers
+        previous = signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        self.addCleanup(signal.signal, signal.SIGTERM, previous)
+        pipeline.start()
+        deadline = time.monotonic() + 10
+        while count_lines(dispatched) < LINES and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert count_lines(dispatched) == LINES
+
+        # As sent to the whole process group, the parent then closes the pipeline
+        for process in (pipeline.processing, pipeline.writer):
+            os.kill(process.pid, signal.SIGTERM)
+        time.sleep(0.2)
+        pipeline.close()
+        assert pipeline.processing.exitcode == 0
+        assert pipeline.writer.exitcode == 0
+        assert count_lines(written) == LINES
+
+    def test_failing_message_skipped(self):
+        dispatched = os.path.join(self.directory, 'dispatched')
+        written = os.path.join(self.directory, 'written')
+        pipeline = MultiprocessPipeline(FakeManager(dispatched, 7), FakeDatabase(written),
+                                        ['RTL433'], lambda section: MessageParser(), False)
+        pipeline.start()
+        deadline = time.monotonic() + 10
+        while count_lines(dispatched) < LINES - 1 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        pipeline.close()
+        # The processing process went on with the following lines and flushed them
+        assert pipeline.processing.exitcode == 0
+        assert count_lines(written) == LINES - 1
+
+    def test_metrics_forwarded(self):
+        self.addCleanup(cfg.config.set, 'Metrics', 'enabled',
+                        cfg.config.get('Metrics', 'enabled'))
+        cfg.config.set('Metrics', 'enabled', 'true')
+        dispatched = os.path.join(self.directory, 'dispatched')
+        pipeline = MultiprocessPipeline(FakeManager(dispatched),
+                                        FakeDatabase(os.path.join(self.directory, 'written')),
+                                        ['RTL433'], lambda section: MessageParser(), False)
+        pipeline.start()
+        deadline = time.monotonic() + 10
+        while count_lines(dispatched) < LINES and time.monotonic() < deadline:
+            time.sleep(0.05)
+        pipeline.close()
+        # Counted in the processing process, exported by this one
+        self.assertEqual(dispatched_lines.value, 0)
+        self.assertIn(f'test_multiprocess_dispatched_total {LINES}',
+                      registry.render().splitlines())
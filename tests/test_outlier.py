@@ -0,0 +1,36 @@
+import unittest
+from utils.outlier import RollingOutlierFilter
+
+
+class TestRollingOutlierFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.filter = RollingOutlierFilter(window=9, k=4, min_deviation=2, threshold=20, recovery=3)
+
+    def test_spike_rejected(self):
+        for value in [20.0, 20.2, 20.1, 19.9, 20.0, 20.3]:
+            assert self.filter.accept(value)
+        assert not self.filter.accept(35.0)
+        assert self.filter.accept(20.1)
+
+    def test_warm_up_uses_threshold(self):
+        assert self.filter.accept(20.0)
+        assert not self.filter.accept(60.0)
+        assert self.filter.accept(25.0)
+
+    def test_step_change_recovers(self):
+        for value in [20.0, 20.2, 20.1, 19.9, 20.0, 20.3]:
+            assert self.filter.accept(value)
+        assert not self.filter.accept(5.0)
+        assert not self.filter.accept(5.2)
+        assert self.filter.accept(5.1)
+        assert self.filter.accept(5.3)
+        assert not self.filter.accept(20.0)
+
+    def test_invalid_settings(self):
+        self.assertRaises(ValueError, RollingOutlierFilter, 2, 4, 2, 20, 3)
+        self.assertRaises(ValueError, RollingOutlierFilter, 9, 4, 2, 20, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
+from utils.profiling import MemoryTracer, SamplingProfiler
+
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class TestProfiling(unittest.TestCase):
+
+    def test_sampling_profiler(self):
+        with tempfile.TemporaryDirectory() as directory:
+            stop = threading.Event()
+            worker = threading.Thread(target=busy_loop, args=(stop,), name="worker")
+            worker.start()
+            profiler = SamplingProfiler(directory, 0.001)
+            self.assertIsNone(profiler.toggle())
+            time.sleep(0.1)
+            path = profiler.toggle()
+            stop.set()
+            worker.join()
+
+            self.assertFalse(profiler.running())
+            with open(path) as profile_file:
+                stacks = profile_file.read().splitlines()
+            self.assertTrue(any(stack.startswith("worker;") and "busy_loop" in stack
+                                for stack in stacks))
+
+    def test_memory_tracer(self):
+        with tempfile.TemporaryDirectory() as directory:
+            tracer = MemoryTracer(directory, 5)
+            self.assertIsNone(tracer.toggle())
+            path = tracer.toggle()
+            self.assertTrue(os.path.exists(path))
+
+    def test_unwritable_directory(self):
+        with tempfile.NamedTemporaryFile() as not_a_directory:
+            directory = os.path.join(not_a_directory.name, "profiles")
+            profiler = SamplingProfiler(directory, 0.001)
+            profiler.toggle()
+            self.assertRaises(OSError, profiler.toggle)
+            # Stopped anyway, the next signal starts a new session
+            self.assertFalse(profiler.running())
+
+            tracer = MemoryTracer(directory, 5)
+            tracer.toggle()
+            self.assertRaises(OSError, tracer.toggle)
+            self.assertFalse(tracemalloc.is_tracing())
+
+
+if __name__ == '__main__':
+    unittest.main()
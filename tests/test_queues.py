@@ -0,0 +1,48 @@
+import unittest
+from queue import Full
+from utils.queues import create_queue
+
+
+class TestQueues(unittest.TestCase):
+
+    def test_block(self):
+        queue = create_queue('test', 2, 'block', lambda item: item)
+        queue.put(1)
+        queue.put(2)
+        self.assertRaises(Full, queue.put, 3, False)
+        self.assertEqual(queue.dropped, 0)
+
+    def test_drop_oldest(self):
+        queue = create_queue('test', 2, 'drop_oldest', lambda item: item)
+        for item in range(5):
+            queue.put(item)
+        self.assertEqual([queue.get(), queue.get()], [3, 4])
+        self.assertEqual(queue.dropped, 3)
+        self.assertEqual(queue.max_depth, 2)
+
+    def test_drop_newest(self):
+        queue = create_queue('test', 2, 'drop_newest', lambda item: item)
+        for item in range(5):
+            queue.put(item)
+        self.assertEqual([queue.get(), queue.get()], [0, 1])
+        self.assertEqual(queue.dropped, 3)
+
+    def test_coalesce(self):
+        queue = create_queue('test', 2, 'coalesce', lambda item: item[0])
+        queue.put(('a', 1))
+        queue.put(('b', 1))
+        # Full : replaces the queued value of the same key in place
+        queue.put(('a', 2))
+        # Full, new key : the oldest item is dropped
+        queue.put(('c', 1))
+        self.assertEqual(queue.qsize(), 2)
+        self.assertEqual([queue.get(), queue.get()], [('b', 1), ('c', 1)])
+        self.assertEqual(queue.dropped, 2)
+        self.assertTrue(queue.empty())
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, create_queue, 'test', 2, 'spill', lambda item: item)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+import cfg
+from sensors.metrics import Types
+from sensors.registry import load_models
+
+
+class TestRegistry(unittest.TestCase):
+
+    def declare(self, fields):
+        cfg.config['model:Nexus-TH'] = {'fields': fields}
+        self.addCleanup(cfg.config.remove_section, 'model:Nexus-TH')
+
+    def test_builtin_models(self):
+        models = load_models()
+        self.assertEqual(models['ThermoPro-TX2C'].metric_types,
+                         [Types.TEMPERATURE, Types.HUMIDITY, Types.BATTERY])
+        self.assertNotIn('Nexus-TH', models)
+
+    def test_declared_model(self):
+        self.declare('temperature_C:TEMPERATURE, humidity:HUMIDITY:int, battery_ok:BATTERY:bool')
+        model = load_models()['Nexus-TH']
+        self.assertEqual(model.metric_types, [Types.TEMPERATURE, Types.HUMIDITY, Types.BATTERY])
+        # Extraction plan : json field, index of the metric and conversion, float by default
+        self.assertEqual([(field, index, conversion('1')) for field, index, conversion
+                          in model.plan[:2]],
+                         [('temperature_C', 0, 1.0), ('humidity', 1, 1)])
+        self.assertEqual(model.plan[2][:2], ('battery_ok', 2))
+        self.assertIs(model.plan[2][2], bool)
+
+    def test_bad_conversion(self):
+        self.declare('temperature_C:TEMPERATURE:double')
+        self.assertRaisesRegex(ValueError, 'Unknown conversion double', load_models)
+
+    def test_bad_metric(self):
+        self.declare('pressure_hPa:PRESSURE')
+        self.assertRaisesRegex(ValueError, 'Unknown metric PRESSURE', load_models)
+
+    def test_bad_field(self):
+        self.declare('temperature_C')
+        self.assertRaisesRegex(ValueError, 'Invalid field temperature_C', load_models)
@@ -0,0 +1,71 @@
+import os
+import unittest
+from configparser import ConfigParser
+from datetime import datetime, timezone
+from functools import partial
+from queue import Queue
+from croniter import croniter
+import cfg
+from manager import Manager
+from sdr import MessageParser
+from sensors.metrics import Types
+from sources import FileSource, parse_recorded_time
+from utils.dedup import DuplicateFilter
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        debug_config = ConfigParser(inline_comment_prefixes=('#'))
+        debug_config.read(os.path.join(TESTS, 'debug.ini'))
+        for section in debug_config.sections():
+            if section.startswith('sensor:'):
+                cfg.config[section] = dict(debug_config[section])
+                self.addCleanup(cfg.config.remove_section, section)
+        self.expression = cfg.config.get('Cron', 'process_data_cron')
+        self.manager = Manager(Queue(), Queue())
+        self.manager.publish_on_recorded_time(self.expression)
+
+    def replay(self):
+        parser = MessageParser(set(self.manager.sensors.keys()), DuplicateFilter(2, 4096),
+                               partial(parse_recorded_time, utc=True))
+        source = FileSource('RTL433', os.path.join(TESTS, 'corpus.jsonl'), 0, True)
+        messages = []
+        for line in source.lines():
+            message = parser.parse(line)
+            if message is not None:
+                messages.append(message)
+                self.manager.message_queue.put(message)
+            if len(messages) == 100:
+                # The publishing job fires once during the fast replay
+                self.manager.messages_to_measures(datetime.now(timezone.utc))
+        # As flush_and_close at the end of the replay
+        self.manager.dispatch_messages()
+        self.manager.publish_measures(datetime.now(timezone.utc))
+        return messages
+
+    def test_corpus_stored_measures(self):
+        messages = self.replay()
+        stored = []
+        while not self.manager.measure_queue.empty():
+            measure = self.manager.measure_queue.get_nowait()
+            if measure.metric != Types.BATTERY:
+                stored.append(measure)
+
+        # One value per sensor, metric and window of recorded time
+        windows = set()
+        for message in messages:
+            model = self.manager.sensors[message['radio_id']].model
+            window = croniter(self.expression, message['acquisition_date']).get_next(datetime)
+            for field, index, _ in model.plan:
+                if field in message and model.metric_types[index] != Types.BATTERY:
+                    windows.add((message['radio_id'], model.metric_types[index], window))
+        assert len(stored) == len(windows)
+        assert len(stored) > 100
+
+        # Values are dated within their recorded window
+        first = messages[0]['acquisition_date']
+        last = messages[-1]['acquisition_date']
+        assert all(first <= measure.time <= last for measure in stored)
@@ -0,0 +1,103 @@
+import os
+import tempfile
+import unittest
+from queue import Queue
+import cfg
+from sdr import MessageParser, SignalReader
+
+LINES = [
+    b'{"time" : "2021-03-14 08:00:00", "model" : "LaCrosse-TX29IT", "id" : 7, '
+    b'"battery_ok" : 1, "temperature_C" : 20.1}\n',
+    b'{"time" : "2021-03-14 08:00:00", "model" : "Nexus-TH", "id" : 211, "channel" : 1, '
+    b'"temperature_C" : 19.6}\n',
+    b'{"time" : "2021-03-14 08:00:00", "model" : "Oregon Scientific", "channel" : "A", '
+    b'"temperature_C" : 19.6}\n',
+    b'{"model":"Acurite-Tower","id":"0x1A2B","temperature_C":18.0}\n',
+    b'{"time" : "2021-03-14 08:00:00", "model" : "Generic-Remote", "cmd" : 4}\n',
+]
+
+
+class TestMessageParser(unittest.TestCase):
+
+    def test_message_without_model(self):
+        for parser in (MessageParser(), MessageParser({'LaCrosse-TX29IT.ID=7'})):
+            assert parser.parse(b'{"time" : "2021-03-14 08:00:00", "id" : 7}\n') is None
+            assert parser.parse(b'{"model" : null, "id" : 7}\n') is None
+            message = parser.parse(b'{"model" : "LaCrosse-TX29IT", "id" : 7}\n')
+            assert message is not None
+            assert message['radio_id'] == 'LaCrosse-TX29IT.ID=7'
+            assert parser.invalid == 2
+            assert parser.messages == 1
+
+    def test_peek_radio_id(self):
+        # The pre-filter builds the same radio ids as decoded lines
+        parser = MessageParser()
+        for line in LINES:
+            self.assertEqual(MessageParser.peek_radio_id(line), parser.parse(line)['radio_id'])
+        self.assertEqual([MessageParser.peek_radio_id(line) for line in LINES],
+                         ['LaCrosse-TX29IT.ID=7', 'Nexus-TH.CH=1', 'Oregon_Scientific.CH=A',
+                          'Acurite-Tower.ID=0x1A2B', 'Generic-Remote'])
+        self.assertIsNone(MessageParser.peek_radio_id(b'{"time" : "2021-03-14 08:00:00"}\n'))
+
+    def test_unknown_emitters(self):
+        parser = MessageParser({'LaCrosse-TX29IT.ID=7'})
+        with self.assertLogs('sdr', 'INFO') as logs:
+            for line in LINES + LINES:
+                parser.parse(line)
+        self.assertEqual(parser.messages, 2)
+        self.assertEqual(parser.unknown_emitters, {'Nexus-TH.CH=1': 2, 'Oregon_Scientific.CH=A': 2,
+                                                   'Acurite-Tower.ID=0x1A2B': 2,
+                                                   'Generic-Remote': 2})
+        # Each new emitter is logged once
+        discovered = [record.getMessage() for record in logs.records
+                      if record.getMessage().startswith("Discovered")]
+        self.assertEqual(discovered, ['Discovered unknown emitter Nexus-TH.CH=1',
+                                      'Discovered unknown emitter Oregon_Scientific.CH=A',
+                                      'Discovered unknown emitter Acurite-Tower.ID=0x1A2B',
+                                      'Discovered unknown emitter Generic-Remote'])
+
+
+class TestSignalReader(unittest.TestCase):
+
+    def setUp(self):
+        for name, options in (('RTL433:attic', {'frequency': '433.92M', 'devices': '40, 41',
+                                                'other_args': '-g 20'}),
+                              ('RTL433:garden', {'executable': '/opt/rtl_433'})):
+            cfg.config[name] = options
+            self.addCleanup(cfg.config.remove_section, name)
+
+    def test_receiver_sections(self):
+        self.assertEqual(SignalReader.receiver_sections(), ['RTL433:attic', 'RTL433:garden'])
+        # Missing options are taken from [RTL433]
+        self.assertEqual(SignalReader.option('RTL433:attic', 'frequency'), '433.92M')
+        self.assertEqual(SignalReader.option('RTL433:garden', 'frequency'),
+                         cfg.config.get('RTL433', 'frequency'))
+
+    def test_command_lines(self):
+        units = cfg.config.get('RTL433', 'units')
+        timezone = cfg.config.get('RTL433', 'timezone')
+        self.assertEqual(SignalReader.get_command_line('RTL433:attic'),
+                         [cfg.config.get('RTL433', 'executable'), '-C', units, '-f', '433.92M',
+                          '-F', 'json', '-M', timezone, '-R', '40', '-R', '41', '-g', '20'])
+        self.assertEqual(SignalReader.get_command_line('RTL433:garden')[:5],
+                         ['/opt/rtl_433', '-C', units, '-f', cfg.config.get('RTL433', 'frequency')])
+
+    def test_restart_keeps_statistics(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        recording = os.path.join(directory.name, 'recording.jsonl')
+        with open(recording, 'wb') as output:
+            output.writelines(LINES[:2])
+        cfg.config.set('RTL433:attic', 'replay', recording)
+        cfg.config.set('RTL433:attic', 'replay_speed', 'fast')
+
+        message_queue = Queue()
+        reader = SignalReader('RTL433:attic', message_queue, MessageParser())
+        reader.start()
+        reader.join(5)
+        restarted = reader.restart()
+        restarted.join(5)
+        self.assertIsNot(restarted, reader)
+        self.assertIs(restarted.parser, reader.parser)
+        self.assertEqual((restarted.parser.lines, restarted.parser.messages), (4, 4))
+        self.assertEqual(message_queue.qsize(), 4)
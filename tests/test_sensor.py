@@ -0,0 +1,69 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+from sensors.metrics import Types
+from sensors.registry import SensorModel
+from sensors.sensor import Sensor
+
+START = datetime(2021, 3, 14, 8, 0, 0, tzinfo=timezone.utc)
+WINDOW_END = START + timedelta(seconds=10)
+
+
+class TestSensorAggregation(unittest.TestCase):
+
+    def setUp(self):
+        model = SensorModel("Test", [("temperature_C", Types.TEMPERATURE, 'float'),
+                                     ("humidity", Types.HUMIDITY, 'int')])
+        self.sensor = Sensor(model, 'Test.ID=1', 'TEST', 'Test', 'Test')
+        for second, temperature in ((1, 20.0), (4, 21.0), (7, 20.6)):
+            self.sensor.process_incoming_message({'temperature_C': temperature,
+                                                  'acquisition_date': START
+                                                  + timedelta(seconds=second)})
+
+    def values(self, measures):
+        return {measure.metric_name(): (measure.data, measure.time) for measure in measures}
+
+    def test_last(self):
+        measures = self.sensor.get_measures(WINDOW_END)
+        # Last values are stamped with their acquisition date, metrics without value are skipped
+        self.assertEqual(self.values(measures),
+                         {'TEMPERATURE': (20.6, START + timedelta(seconds=7))})
+        # The window is reset
+        self.assertEqual(self.sensor.get_measures(WINDOW_END), [])
+
+    def test_primary_and_extras(self):
+        measures = self.sensor.get_measures(WINDOW_END, 'mean', ['min', 'max', 'last', 'count'])
+        values = self.values(measures)
+        self.assertEqual(list(values), ['TEMPERATURE', 'TEMPERATURE_MIN', 'TEMPERATURE_MAX',
+                                        'TEMPERATURE_LAST', 'TEMPERATURE_COUNT'])
+        self.assertAlmostEqual(values['TEMPERATURE'][0], 20.533333, places=5)
+        self.assertEqual(values['TEMPERATURE'][1], WINDOW_END)
+        self.assertEqual(values['TEMPERATURE_MIN'], (20.0, WINDOW_END))
+        self.assertEqual(values['TEMPERATURE_MAX'], (21.0, WINDOW_END))
+        self.assertEqual(values['TEMPERATURE_LAST'], (20.6, START + timedelta(seconds=7)))
+        self.assertEqual(values['TEMPERATURE_COUNT'], (3, WINDOW_END))
+        # Extras are stored under their own metric name, keyed with the metric itself
+        extra = measures[1]
+        self.assertEqual(extra.aggregate, 'min')
+        self.assertEqual(extra.get_cache_key(), ('TEST', 'TEMPERATURE'))
+
+    def test_windows_are_independent(self):
+        self.sensor.get_measures(WINDOW_END)
+        self.sensor.process_incoming_message({'temperature_C': 25.0, 'humidity': 40,
+                                              'acquisition_date': WINDOW_END})
+        values = self.values(self.sensor.get_measures(WINDOW_END + timedelta(seconds=10),
+                                                      'min', ['max']))
+        self.assertEqual({name: value for name, (value, _) in values.items()},
+                         {'TEMPERATURE': 25.0, 'TEMPERATURE_MAX': 25.0,
+                          'HUMIDITY': 40, 'HUMIDITY_MAX': 40})
+
+    def test_invalid_field_skipped(self):
+        self.sensor.process_incoming_message({'temperature_C': 'garbled', 'humidity': 45,
+                                              'acquisition_date': START
+                                              + timedelta(seconds=8)})
+        self.sensor.process_incoming_message({'temperature_C': None, 'humidity': [40],
+                                              'acquisition_date': START
+                                              + timedelta(seconds=9)})
+        # Only the garbled fields are lost
+        self.assertEqual(self.values(self.sensor.get_measures(WINDOW_END, 'max')),
+                         {'TEMPERATURE': (21.0, WINDOW_END), 'HUMIDITY': (45, WINDOW_END)})
+        self.assertEqual(self.sensor.invalid, 2)
@@ -0,0 +1,76 @@
+import gzip
+import os
+import tempfile
+import time
+import unittest
+from datetime import datetime, timezone
+from sources import FileSource, Recorder, RecordingSource, parse_speed
+
+
+LINES = [
+    b'rtl_433 version 20.11\n',
+    b'{"time" : "2021-03-14 08:00:00", "model" : "LaCrosse-TX29IT", "id" : 7}\n',
+    b'{"time" : "2021-03-14 08:00:02", "model" : "LaCrosse-TX29IT", "id" : 0}\n',
+]
+
+
+class TestSources(unittest.TestCase):
+
+    def test_parse_speed(self):
+        self.assertEqual(parse_speed('realtime'), 1.0)
+        self.assertEqual(parse_speed('fast'), 0.0)
+        self.assertEqual(parse_speed('x10'), 10.0)
+        self.assertRaises(ValueError, parse_speed, 'x0')
+
+    def test_replay_gzip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'capture.jsonl.gz')
+            with gzip.open(path, 'wb') as capture:
+                capture.writelines(LINES)
+
+            self.assertEqual(list(FileSource('test', path, 0.0, True).lines()), LINES)
+
+            # Two recorded seconds replayed 20 times faster
+            start = time.monotonic()
+            self.assertEqual(list(FileSource('test', directory, 20.0, True).lines()), LINES)
+            self.assertGreaterEqual(time.monotonic() - start, 0.1)
+
+    def test_record(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'capture.jsonl')
+            with open(path, 'wb') as capture:
+                capture.writelines(LINES)
+            recordings = os.path.join(directory, 'recordings')
+
+            recorder = Recorder('RTL433:garage', recordings, 1, 1)
+            source = RecordingSource(FileSource('test', path, 0.0, True), recorder)
+            self.assertEqual(list(source.lines()), LINES)
+
+            # Rotated after each line, only the latest recording is kept
+            files = os.listdir(recordings)
+            self.assertEqual(len(files), 1)
+            self.assertTrue(files[0].startswith('rtl433-garage-'))
+            with gzip.open(os.path.join(recordings, files[0]), 'rb') as recording:
+                self.assertEqual(recording.read(), LINES[2])
+
+    def test_record_max_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for max_files, kept in ((2, 2), (0, 4)):
+                recordings = os.path.join(directory, f'recordings-{max_files}')
+                recorder = Recorder('RTL433', recordings, 1, max_files)
+                for line in LINES[1:] * 2:
+                    recorder.write(line)
+                    # Recordings are named after the current time
+                    time.sleep(0.001)
+                recorder.close()
+                self.assertEqual(len(os.listdir(recordings)), kept)
+
+    def test_recorded_time(self):
+        source = FileSource('test', '-', 1.0, True)
+        self.assertEqual(source.recorded_timestamp(LINES[1]),
+                         datetime(2021, 3, 14, 8, tzinfo=timezone.utc).timestamp())
+        self.assertIsNone(source.recorded_timestamp(LINES[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+import cfg
+from reporters.file import Spool
+from sensors.measure import Measure
+from sensors.metrics import Types
+
+START = datetime(2021, 3, 14, 8, 0, 0, tzinfo=timezone.utc)
+
+
+def measures(first, count):
+    return [Measure(START + timedelta(seconds=index), 'TEST', Types.TEMPERATURE, float(index))
+            for index in range(first, first + count)]
+
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.addCleanup(cfg.config.set, 'Spool', 'directory',
+                        cfg.config.get('Spool', 'directory'))
+        cfg.config.set('Spool', 'directory', directory.name)
+        self.spool = self.create_spool()
+        self.replayed = []
+
+    def create_spool(self):
+        spool = Spool()
+        self.addCleanup(spool.close)
+        # A segment holds about two measures
+        spool.segment_size = 2 * len(Spool.serialize(measures(0, 1)[0]))
+        return spool
+
+    def write(self, chunk):
+        self.replayed.extend(measure.data for measure in chunk)
+
+    def test_rotation(self):
+        for first in range(0, 10, 2):
+            self.spool.append(measures(first, 2))
+        self.assertEqual(len(self.spool.segments()), 5)
+        self.assertEqual([Spool.segment_sequence(segment) for segment in self.spool.segments()],
+                         [1, 2, 3, 4, 5])
+        assert not self.spool.is_empty()
+
+    def test_size_cap_drops_oldest(self):
+        segment_size = self.spool.segment_size
+        self.spool.max_size = 3 * segment_size
+        for first in range(0, 10, 2):
+            self.spool.append(measures(first, 2))
+        self.assertEqual([Spool.segment_sequence(segment) for segment in self.spool.segments()],
+                         [3, 4, 5])
+        self.spool.replay(self.write)
+        self.assertEqual(self.replayed, [float(index) for index in range(4, 10)])
+
+    def test_replay_order(self):
+        for first in range(0, 6, 2):
+            self.spool.append(measures(first, 2))
+        self.spool.close()
+        # Segments left by a previous run are replayed first, new ones are numbered after them
+        spool = self.create_spool()
+        spool.append(measures(6, 2))
+        spool.replay(self.write)
+        self.assertEqual(self.replayed, [float(index) for index in range(8)])
+        assert spool.is_empty()
+        self.assertEqual(spool.replayed_rows, 8)
+
+        # A failure after a replay goes to a fresh segment
+        spool.append(measures(8, 1))
+        self.assertEqual([Spool.segment_sequence(segment) for segment in spool.segments()], [5])
+
+    def test_truncated_last_line(self):
+        self.spool.append(measures(0, 2))
+        self.spool.close()
+        segment = self.spool.segments()[-1]
+        # Crash while writing the last measure
+        with open(segment, 'ab') as segment_file:
+            segment_file.write(Spool.serialize(measures(2, 1)[0])[:20])
+        self.spool.replay(self.write)
+        self.assertEqual(self.replayed, [0.0, 1.0])
+        assert self.spool.is_empty()
+
+    def test_failed_replay_keeps_segment(self):
+        self.spool.append(measures(0, 2))
+        self.spool.append(measures(2, 2))
+
+        def fail(chunk):
+            if chunk[0].data == 2.0:
+                raise ConnectionError("database lost")
+            self.write(chunk)
+        self.assertRaises(ConnectionError, self.spool.replay, fail)
+        self.assertEqual(self.replayed, [0.0, 1.0])
+        self.assertEqual(len(self.spool.segments()), 1)
+
+        self.spool.replay(self.write)
+        self.assertEqual(self.replayed, [0.0, 1.0, 2.0, 3.0])
+        assert self.spool.is_empty()
@@ -0,0 +1,72 @@
+import time
+import unittest
+from datetime import datetime, timezone
+from queue import Queue
+import cfg
+from manager import Manager
+from sensors.metrics import Types
+from streaming import StreamingPipeline
+
+
+class FakeDatabase():
+
+    def __init__(self):
+        self.measure_queue = Queue()
+        self.written = []
+
+    def write_measures(self):
+        while not self.measure_queue.empty():
+            self.written.append(self.measure_queue.get_nowait())
+        return True
+
+
+class TestStreamingPipeline(unittest.TestCase):
+
+    def setUp(self):
+        cfg.config['sensor:test'] = {
+            'type': 'LaCrosse-TX29IT',
+            'radio_id': 'LaCrosse-TX29IT.ID=7',
+            'database_id': 'TEST',
+            'name': 'Test',
+            'location': 'Test'
+        }
+        self.addCleanup(cfg.config.remove_section, 'sensor:test')
+        self.database = FakeDatabase()
+        self.message_queue = Queue()
+        self.manager = Manager(self.message_queue, self.database.measure_queue)
+        self.pipeline = self.create_pipeline(self.manager, 1, 0.05)
+
+    def create_pipeline(self, manager, flush_size, flush_latency):
+        pipeline = StreamingPipeline(manager, self.database, self.message_queue, flush_size,
+                                     flush_latency)
+        pipeline.start()
+        self.addCleanup(pipeline.close)
+        return pipeline
+
+    def test_bad_message_skipped(self):
+        now = datetime.now(timezone.utc)
+        self.message_queue.put({'radio_id': 'LaCrosse-TX29IT.ID=7', 'temperature_C': 'garbled',
+                                'acquisition_date': now})
+        self.message_queue.put({'radio_id': 'LaCrosse-TX29IT.ID=7', 'temperature_C': 21.5,
+                                'acquisition_date': now})
+        deadline = time.monotonic() + 5
+        while len(self.database.written) == 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+        assert self.pipeline.consumer.is_alive()
+        assert [(measure.metric, measure.data) for measure in self.database.written] == [
+            (Types.TEMPERATURE, 21.5)]
+
+    def test_close_flushes(self):
+        self.pipeline.close()
+        # Neither the size nor the latency trigger are reached before closing
+        pipeline = self.create_pipeline(self.manager, 100, 60)
+        self.message_queue.put({'radio_id': 'LaCrosse-TX29IT.ID=7', 'temperature_C': 21.5,
+                                'acquisition_date': datetime.now(timezone.utc)})
+        deadline = time.monotonic() + 5
+        while pipeline.pending() == 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert self.database.written == []
+        pipeline.close()
+        assert [(measure.metric, measure.data) for measure in self.database.written] == [
+            (Types.TEMPERATURE, 21.5)]